@@ -1,8 +1,10 @@
 import asyncio
+import functools
 import json
+import os
 import uuid
 import re
-from typing import List, Dict, Any, Callable
+from typing import List, Dict, Any, Callable, Tuple
 from pathlib import Path
 
 from langgraph.graph import StateGraph, END
@@ -15,7 +17,9 @@ from agents.production_agent import ProductionAgent
 from agents.editor_agent import EditorAgent
 from models import Chapter, Scene
 from utils.file_utils import split_novel_by_chapters
-from utils.ollama_client import OllamaClient
+from utils.llm_telemetry import llm_tags
+from utils.model_residency import init_model_residency
+from tools.backends import create_backend
 
 class NovelState(TypedDict):
     """小说处理状态"""
@@ -32,11 +36,14 @@ class NovelProcessingFlow:
     """小说处理流程"""
     
     def __init__(self):
-        self.ollama_client = OllamaClient()
+        # LLM后端（默认Ollama，LLM_BACKEND=stub 时使用本地占位实现）
+        self.ollama_client = create_backend("llm")
         self.script_agent = ScriptAgent(self.ollama_client)
         self.director_agent = DirectorAgent(self.ollama_client)
         self.production_agent = ProductionAgent(self.ollama_client)
         self.editor_agent = EditorAgent(self.ollama_client)
+        # 模型常驻管理：按阶段设置keep_alive，图片阶段内存紧张时暂时卸载LLM
+        self.residency = init_model_residency(self.ollama_client, self.production_agent.pipeline_pool)
         self.status_callback = None
         
         # 构建工作流图
@@ -48,10 +55,10 @@ class NovelProcessingFlow:
         
         # 添加节点
         workflow.add_node("split_chapters", self.split_chapters_node)
-        workflow.add_node("create_scripts", self.create_scripts_node)
-        workflow.add_node("design_scenes", self.design_scenes_node)
-        workflow.add_node("generate_assets", self.generate_assets_node)
-        workflow.add_node("edit_check", self.edit_check_node)
+        workflow.add_node("create_scripts", self.residency.wrap("scripting", self.create_scripts_node))
+        workflow.add_node("design_scenes", self.residency.wrap("designing", self.design_scenes_node))
+        workflow.add_node("generate_assets", self.residency.wrap("generating", self.generate_assets_node))
+        workflow.add_node("edit_check", self.residency.wrap("editing", self.edit_check_node))
         workflow.add_node("finalize", self.finalize_node)
         
         # 设置边
@@ -112,22 +119,52 @@ class NovelProcessingFlow:
         if self.status_callback:
             self.status_callback("scripting", 30, "正在创建剧本...")
         
+        # 流式模式：剧本中每个场景一生成完就开始设计，剧本与场景设计两个阶段重叠
+        streaming = os.getenv("SCRIPT_STREAMING", "0") == "1"
+        # 按 (章节序号, 场景ID) 区分：模型常在每个章节都输出 scene_1 这样的ID
+        design_tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+        
+        async def design(scene: Dict[str, Any], chapter_title: str) -> Dict[str, Any]:
+            # 与剧本并行的场景设计按设计阶段计入模型常驻管理
+            async with self.residency.phase("designing"):
+                return await self.director_agent.design_scene(scene, chapter_title)
+        
+        def schedule_design(chapter_index: int, scene: Dict[str, Any], chapter_title: str):
+            key = (chapter_index, scene["id"])
+            if key not in design_tasks:
+                design_tasks[key] = asyncio.create_task(design(scene, chapter_title))
+        
         try:
             scripts = []
             for i, chapter_content in enumerate(state["chapters"]):
                 print(f"create_scripts_node {i} {len(chapter_content)}: {chapter_content}")
-                script = await self.script_agent.create_script(chapter_content, i)
+                script = await self.script_agent.create_script(
+                    chapter_content, i, on_scene=functools.partial(schedule_design, i) if streaming else None
+                )
                 scripts.append(script)
+                if streaming:
+                    # 流式解析未覆盖的场景（如回退到默认剧本）补充设计
+                    for scene in script.get("scenes", []):
+                        schedule_design(i, scene, script.get("chapter_title", ""))
                 
                 # 更新进度
                 progress = 30 + (i + 1) / len(state["chapters"]) * 20
                 if self.status_callback:
                     self.status_callback("scripting", int(progress), f"已完成 {i+1}/{len(state['chapters'])} 章节剧本")
             
+            if streaming:
+                # 按剧本顺序收集场景设计；未被最终剧本采用的设计取消，不再占用LLM
+                used = [(i, scene["id"]) for i, script in enumerate(scripts) for scene in script.get("scenes", [])]
+                for key in set(design_tasks) - set(used):
+                    design_tasks[key].cancel()
+                state["scene_designs"] = [await design_tasks[key] for key in used]
+            
             state["scripts"] = scripts
             state["current_step"] = "scripts_created"
             return state
         except Exception as e:
+            for task in design_tasks.values():
+                task.cancel()
             state["error_message"] = f"创建剧本失败: {str(e)}"
             raise e
     
@@ -136,10 +173,18 @@ class NovelProcessingFlow:
         if self.status_callback:
             self.status_callback("designing", 50, "正在设计场景...")
         
+        if state["scene_designs"]:
+            # 流式模式下场景设计已与剧本生成并行完成
+            if self.status_callback:
+                self.status_callback("designing", 70, f"已完成 {len(state['scene_designs'])} 个场景设计（与剧本生成并行）")
+            state["current_step"] = "scenes_designed"
+            return state
+        
         try:
             scene_designs = []
             for i, script in enumerate(state["scripts"]):
-                designs = await self.director_agent.design_scenes(script)
+                with llm_tags(chapter=i):
+                    designs = await self.director_agent.design_scenes(script)
                 scene_designs.extend(designs)
                 
                 # 更新进度
@@ -160,16 +205,27 @@ class NovelProcessingFlow:
             self.status_callback("generating", 70, "正在生成素材...")
         
         try:
-            generated_assets = []
-            for i, scene_design in enumerate(state["scene_designs"]):
-                assets = await self.production_agent.generate_assets(scene_design)
-                generated_assets.append(assets)
-                
-                print(f"generate_assets_node {i}: {assets}")
-                # 更新进度
-                progress = 70 + (i + 1) / len(state["scene_designs"]) * 15
+            total = len(state["scene_designs"])
+            
+            def on_images_progress(done: int, count: int):
+                # 更新进度（图片批量阶段占主要耗时）
+                progress = 70 + done / max(count, 1) * 15
                 if self.status_callback:
-                    self.status_callback("generating", int(progress), f"已完成 {i+1}/{len(state['scene_designs'])} 个场景素材")
+                    self.status_callback("generating", int(progress), f"已完成 {done}/{count} 个场景图片")
+            
+            # 先补齐需要LLM生成的动画代码，之后图片阶段不再用LLM，内存紧张时可卸载模型
+            await self.production_agent.prepare_animation_code(state["scene_designs"])
+            await self.residency.release_for_images()
+            
+            # 跨场景批量生成素材，结果按scene_id对应
+            generated_assets = await self.production_agent.generate_assets_batch(
+                state["scene_designs"], progress_callback=on_images_progress
+            )
+            for i, assets in enumerate(generated_assets):
+                print(f"generate_assets_node {i}: {assets}")
+            
+            if self.status_callback:
+                self.status_callback("generating", 85, f"已完成 {total}/{total} 个场景素材")
             
             state["generated_assets"] = generated_assets
             state["current_step"] = "assets_generated"
@@ -230,6 +286,8 @@ class NovelProcessingFlow:
                             description=scene_data.get("description", ""),
                             audioScript=matching_assets.get("audio_script", ""),
                             imageUrl=matching_assets.get("image_url", ""),
+                            imageVersion=matching_assets.get("image_version", 1),
+                            imageVariants=matching_assets.get("image_variants", {}),
                             audioUrl=matching_assets.get("audio_url", ""),
                             animationCode=matching_assets.get("animation_code", ""),
                             duration=matching_assets.get("audio_duration", ""),
@@ -240,7 +298,8 @@ class NovelProcessingFlow:
                 chapter = Chapter(
                     id=str(uuid.uuid4()),
                     title=script.get("chapter_title", f"第 {chapter_index + 1} 章"),
-                    scenes=chapter_scenes
+                    scenes=chapter_scenes,
+                    audioSprite=await self.production_agent.build_audio_sprite(chapter_scenes)
                 )
                 final_chapters.append(chapter)
                 chapter_index += 1
@@ -1,7 +1,11 @@
 import asyncio
 import json
+import os
 import uuid
 from typing import Dict, List, Any
+from models import SceneDesign, llm_output_schema
+from utils.json_repair import chat_json, generate_json, structured_output_enabled
+from utils.llm_telemetry import llm_tags
 
 class DirectorAgent:
     """导演Agent - 负责根据剧本设计关键场景"""
@@ -10,6 +14,16 @@ class DirectorAgent:
         self.ollama_client = ollama_client
         self.model_name = "gemma3n:e4b"
         # self.model_name = "qwen3:4b"
+        # 结构化输出：用场景设计模型的JSON Schema约束生成（LLM_STRUCTURED_OUTPUT=0 关闭）
+        self.output_schema = llm_output_schema(SceneDesign, exclude=("dialogue",)) if structured_output_enabled() else None
+        # 章节会话模式：说明、章节标题和输出格式放在固定的system消息里，同一章节的各场景只发送场景信息，
+        # Ollama可复用相同前缀的KV缓存，不必每个场景重新计算（DIRECTOR_SESSION=0 关闭）
+        self.session_mode = os.getenv("DIRECTOR_SESSION", "1") == "1"
+        # 每次调用的 prompt_eval_count 统计（按模式区分，便于对比会话模式节省的prompt计算量）
+        self.prompt_eval_stats = {
+            mode: {"calls": 0, "prompt_eval_count": 0, "min": None, "max": None}
+            for mode in ("single", "session")
+        }
     
     async def design_scenes(self, script: Dict[str, Any], revision_suggestions: List[Dict] = []) -> List[Dict[str, Any]]:
         """为剧本设计场景（支持修正建议）"""
@@ -17,19 +31,25 @@ class DirectorAgent:
         scene_designs = []
         
         for scene in script.get("scenes", []):
-            try:
-                design = await self._design_single_scene(scene, script.get("chapter_title", ""), revision_suggestions)
-                scene_designs.append(design)
-            except Exception as e:
-                # 如果设计失败，创建默认设计
-                print(f"场景设计失败: {str(e)}")
-                design = self._create_default_scene_design(scene)
-                scene_designs.append(design)
+            design = await self.design_scene(scene, script.get("chapter_title", ""), revision_suggestions)
+            scene_designs.append(design)
         
         return scene_designs
     
+    async def design_scene(self, scene: Dict[str, Any], chapter_title: str, revision_suggestions: List[Dict] = []) -> Dict[str, Any]:
+        """设计单个场景，失败时返回默认设计（剧本流式生成时可逐个场景提前调用）"""
+        try:
+            return await self._design_single_scene(scene, chapter_title, revision_suggestions)
+        except Exception as e:
+            # 如果设计失败，创建默认设计
+            print(f"场景设计失败: {str(e)}")
+            return self._create_default_scene_design(scene)
+    
     async def _design_single_scene(self, scene: Dict[str, Any], chapter_title: str, revision_suggestions: List[Dict] = []) -> Dict[str, Any]:
         """设计单个场景（支持修正建议）"""
+        
+        if self.session_mode:
+            return await self._design_scene_in_session(scene, chapter_title, revision_suggestions)
 
         # Add revision suggestions to prompt if available
         revision_prompt = ""
@@ -57,7 +77,7 @@ class DirectorAgent:
     "css_animation": "CSS动画代码",
     "camera_angle": "镜头角度",
     "mood": "情绪氛围",
-    "color_palette": "色彩调色板",
+    "color_palette": ["色彩调色板中的颜色"],
     "duration": {scene.get('duration', 30)}
 }}
 
@@ -72,20 +92,80 @@ class DirectorAgent:
 请只返回JSON格式，不要包含其他文字。
 """
         
-        response = await self.ollama_client.generate(
-            model=self.model_name,
-            prompt=prompt,
-            stream=False
-        )
+        # 解析失败时先本地修复，仍失败才重新生成
+        with llm_tags(agent="director", scene=scene.get("id")):
+            design_data = await generate_json(
+                self.ollama_client, self.model_name, prompt, schema=self.output_schema,
+                on_response=lambda response: self._record_prompt_eval("single", response)
+            )
+        return self._finish_design(design_data, scene)
+    
+    def _session_system_message(self, chapter_title: str, revision_suggestions: List[Dict] = []) -> str:
+        """章节会话的固定system消息（同一章节内逐字相同，才能命中前缀KV缓存）"""
         
-        # 解析响应
-        design_text = response.get("response", "").strip()
+        revision_prompt = ""
+        if revision_suggestions:
+            revision_prompt = f"\n修正建议：{json.dumps(revision_suggestions, ensure_ascii=False)}（请优先遵循修正建议）"
         
-        print(f"design_text: {design_text}")
-        try:
-            design_data = json.loads(design_text)
-        except json.JSONDecodeError:
-            design_data = self._extract_json_from_text(design_text)
+        return f"""
+作为一个专业的导演，请为用户给出的本章节场景逐个设计详细的视觉效果、动画和呈现方式。{revision_prompt} 
+
+章节标题：{chapter_title}
+
+每条消息包含一个场景的信息，请按照以下JSON格式输出该场景的设计：
+{{
+    "scene_id": "消息中的场景ID",
+    "visual_description": "详细的视觉场景描述，包括环境、光线、色彩、构图等",
+    "image_prompt": "用于生成场景图片的AI提示词（英文）",
+    "dialogue_text": "精炼的对话或旁白文本, 和输入的语言保持一致",
+    "animation_effects": "动画效果描述",
+    "css_animation": "CSS动画代码",
+    "camera_angle": "镜头角度",
+    "mood": "情绪氛围",
+    "color_palette": ["色彩调色板中的颜色"],
+    "duration": 消息中的时长
+}}
+
+要求：
+1. 视觉描述要生动具体，适合AI图像生成
+2. 动画效果要简洁优雅
+3. CSS动画代码要可执行
+4. 镜头角度要有电影感
+5. 色彩搭配要符合情绪
+6. dialogue_text 要和输入的语言保持一致，输入是中文，这个输出也是中文
+
+请只返回JSON格式，不要包含其他文字。
+"""
+    
+    async def _design_scene_in_session(self, scene: Dict[str, Any], chapter_title: str, revision_suggestions: List[Dict] = []) -> Dict[str, Any]:
+        """章节会话模式：固定的system消息 + 只含场景信息的user消息"""
+        
+        scene_message = f"""场景信息：
+- 场景ID：{scene.get('id', '')}
+- 标题：{scene.get('title', '')}
+- 描述：{scene.get('description', '')}
+- 对话：{scene.get('dialogue', '')}
+- 情感：{scene.get('emotion', '')}
+- 设置：{scene.get('setting', '')}
+- 时长：{scene.get('duration', 30)}
+"""
+        messages = [
+            {"role": "system", "content": self._session_system_message(chapter_title, revision_suggestions)},
+            {"role": "user", "content": scene_message}
+        ]
+        with llm_tags(agent="director", scene=scene.get("id")):
+            design_data = await chat_json(
+                self.ollama_client, self.model_name, messages, schema=self.output_schema,
+                on_response=lambda response: self._record_prompt_eval("session", response)
+            )
+        return self._finish_design(design_data, scene)
+    
+    def _finish_design(self, design_data: Any, scene: Dict[str, Any]) -> Dict[str, Any]:
+        """校验模型输出的场景设计并补全scene_id"""
+        
+        print(f"design_data: {json.dumps(design_data, ensure_ascii=False)}")
+        if not isinstance(design_data, dict):
+            raise Exception("场景设计JSON解析失败")
         
         # 确保有scene_id
         if "scene_id" not in design_data:
@@ -93,18 +173,31 @@ class DirectorAgent:
         
         return design_data
     
-    def _extract_json_from_text(self, text: str) -> Dict[str, Any]:
-        """从文本中提取JSON"""
-        import re
-        
-        json_match = re.search(r'\{.*\}', text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group(0))
-            except json.JSONDecodeError:
-                pass
-        
-        return {}
+    def _record_prompt_eval(self, mode: str, response: Dict[str, Any]):
+        """记录单次调用实际计算的prompt token数（命中前缀缓存的部分不计入）"""
+        
+        count = response.get("prompt_eval_count")
+        if count is None:
+            return
+        stats = self.prompt_eval_stats[mode]
+        stats["calls"] += 1
+        stats["prompt_eval_count"] += count
+        stats["min"] = count if stats["min"] is None else min(stats["min"], count)
+        stats["max"] = count if stats["max"] is None else max(stats["max"], count)
+        print(f"场景设计 prompt_eval_count={count}（{mode}）")
+    
+    def prompt_eval_report(self) -> Dict[str, Any]:
+        """各模式的 prompt_eval_count 汇总（平均值越低说明前缀复用越充分）"""
+        
+        return {
+            "session_mode": self.session_mode,
+            **{
+                mode: {
+                    **stats,
+                    "avg": round(stats["prompt_eval_count"] / stats["calls"], 1) if stats["calls"] else None
+                } for mode, stats in self.prompt_eval_stats.items()
+            }
+        }
     
     def _create_default_scene_design(self, scene: Dict[str, Any]) -> Dict[str, Any]:
         """创建默认场景设计"""
@@ -1,6 +1,8 @@
 import asyncio
 import json
 from typing import Dict, List, Any
+from utils.json_repair import parse_llm_json, structured_output_enabled
+from utils.llm_telemetry import llm_tags
 
 class EditorAgent:
     """剪辑Agent - 负责检查剧本和场景的连贯性"""
@@ -59,11 +61,15 @@ class EditorAgent:
             # 构建连贯性检查提示
             prompt = self._build_continuity_prompt(scripts, assets)
             
-            response = await self.ollama_client.generate(
-                model=self.model_name,
-                prompt=prompt,
-                stream=False
-            )
+            # 结构化输出开启时使用Ollama的JSON模式
+            kwargs = {"format": "json"} if structured_output_enabled() else {}
+            with llm_tags(agent="editor"):
+                response = await self.ollama_client.generate(
+                    model=self.model_name,
+                    prompt=prompt,
+                    stream=False,
+                    **kwargs
+                )
             
             # 解析AI的建议
             suggestions = self._parse_continuity_suggestions(response.get("response", ""))
@@ -137,9 +143,10 @@ class EditorAgent:
     
     def _parse_continuity_suggestions(self, response: str) -> Dict[str, Any]:
         """解析连贯性建议"""
-        try:
-            return json.loads(response)
-        except json.JSONDecodeError:
+        suggestions = parse_llm_json(response)
+        if isinstance(suggestions, dict):
+            return suggestions
+        else:
             return {
                 "issues": [],
                 "suggestions": [],
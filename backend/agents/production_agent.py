@@ -2,13 +2,20 @@ import asyncio
 import json
 import uuid
 import os
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Callable
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import base64
-import aiofiles
-import aiohttp
-from tools.generate_audio import generate_audio  # 新增导入
-from tools.generate_image import generate_image  # 新增导入
+from tools.backends import get_backend
+from tools.generate_image import (  # 新增导入
+    generate_image, generate_images_batch, get_image_cache, plan_image_jobs,
+    split_batches, commit_image_job, ImageSettings, draft_settings
+)
+from tools.image_workers import get_image_worker_pool
+from tools.image_variants import submit_image_variants, shutdown_variant_executor
+from tools.inference_profiles import profile_latency
+from tools.pipeline_pool import get_pipeline_pool
+from utils.llm_telemetry import llm_tags
 import asyncio  # 确保已导入
 
 class ProductionAgent:
@@ -25,6 +32,46 @@ class ProductionAgent:
         (self.assets_dir / "images").mkdir(exist_ok=True)
         (self.assets_dir / "audios").mkdir(exist_ok=True)
         (self.assets_dir / "animations").mkdir(exist_ok=True)
+        
+        # 常驻Stable Diffusion管线池（各场景共享，避免重复加载权重）
+        self.pipeline_pool = get_pipeline_pool()
+        # 批量生成图片时每个微批次的图片数量
+        self.image_batch_size = int(os.getenv("IMAGE_BATCH_SIZE", "4"))
+        # 图片工作进程池（IMAGE_WORKERS>0 时启用，生成与API进程隔离）
+        self.image_workers = get_image_worker_pool()
+        # 图片模式：final 直接生成最终图片；draft 先发布草稿图，再由后台精修替换
+        self.image_mode = os.getenv("IMAGE_MODE", "final")
+        # 待精修的草稿图：草稿URL -> 图片提示词
+        self.refine_jobs: Dict[str, str] = {}
+        # 草稿URL -> 尚未取走精修任务的场景数（内容寻址缓存下不同书籍可能得到同一张草稿图）
+        self._refine_waiters: Dict[str, int] = {}
+        # 语音合成（TTS、ffmpeg转码、时长解析）都是阻塞操作，放到独立线程池执行，避免卡住事件循环
+        self.audio_concurrency = max(1, int(os.getenv("AUDIO_CONCURRENCY", "2")))
+        self.audio_timeout = float(os.getenv("AUDIO_TIMEOUT", "300"))
+        self.audio_executor = ThreadPoolExecutor(max_workers=self.audio_concurrency, thread_name_prefix="audio")
+        self.audio_semaphore = asyncio.Semaphore(self.audio_concurrency)
+    
+    async def warmup(self):
+        """预热图片生成管线"""
+        try:
+            if self.image_workers:
+                # 工作进程启动时各自加载管线
+                self.image_workers.start()
+            else:
+                await asyncio.to_thread(get_backend("image").warmup, self.pipeline_pool)
+        except Exception as e:
+            print(f"图片管线预热失败: {e}")
+    
+    def shutdown(self):
+        """释放常驻管线和工作进程"""
+        if self.image_workers:
+            self.image_workers.shutdown()
+        self.pipeline_pool.shutdown()
+        shutdown_variant_executor()
+        self.audio_executor.shutdown(wait=False, cancel_futures=True)
+        audio_backend = get_backend("audio")
+        if hasattr(audio_backend, "shutdown"):
+            audio_backend.shutdown()
     
     async def generate_assets(self, scene_design: Dict[str, Any]) -> Dict[str, Any]:
         """为场景生成所有素材"""
@@ -40,10 +87,67 @@ class ProductionAgent:
         image_url, audio_info, animation_code = await asyncio.gather(
             image_task, audio_task, animation_task
         )
+        image_variants = await self.build_image_variants([image_url])
+        
+        return self._assemble_assets(scene_design, scene_id, image_url, audio_info, animation_code, image_variants.get(image_url))
+    
+    async def generate_assets_batch(self, scene_designs: List[Dict[str, Any]], progress_callback: Callable[[int, int], None] = None) -> List[Dict[str, Any]]:
+        """为多个场景生成素材（图片按微批次统一生成，语音和动画并行生成）"""
+        
+        scene_ids = [
+            design.get("scene_id") or f"scene_{uuid.uuid4().hex[:8]}"
+            for design in scene_designs
+        ]
+        
+        # 图片批量阶段与各场景的语音、动画任务并行
+        image_task = self._generate_scene_images_batch(scene_designs, scene_ids, progress_callback)
+        per_scene_tasks = [
+            asyncio.gather(
+                self._generate_scene_audio(design),
+                self._generate_animation_code(design)
+            )
+            for design in scene_designs
+        ]
+        
+        async def images_with_variants():
+            image_urls = await image_task
+            return image_urls, await self.build_image_variants(list(image_urls.values()))
+        
+        (image_urls, image_variants), per_scene_results = await asyncio.gather(
+            images_with_variants(), asyncio.gather(*per_scene_tasks)
+        )
+        
+        return [
+            self._assemble_assets(
+                design, scene_id, image_urls.get(scene_id, ""), audio_info, animation_code,
+                image_variants.get(image_urls.get(scene_id, ""))
+            )
+            for design, scene_id, (audio_info, animation_code) in zip(scene_designs, scene_ids, per_scene_results)
+        ]
+    
+    async def build_image_variants(self, image_urls: List[str]) -> Dict[str, Dict[str, Any]]:
+        """在进程池中为本地生成的图片编码多尺寸WebP/AVIF派生图，返回 图片URL -> 派生图信息"""
+        local_urls = sorted({url for url in image_urls if url and url.startswith("/assets/images/")})
+        
+        async def build(url: str):
+            image_path = self.assets_dir / "images" / url.rsplit("/", 1)[-1]
+            try:
+                return url, await asyncio.wrap_future(submit_image_variants(str(image_path)))
+            except Exception as e:
+                print(f"派生图生成失败 {url}: {e}")
+                return url, None
         
+        results = await asyncio.gather(*(build(url) for url in local_urls))
+        return {url: variants for url, variants in results if variants}
+    
+    def _assemble_assets(self, scene_design: Dict[str, Any], scene_id: str, image_url: str, audio_info: Dict[str, Any], animation_code: str, image_variants: Dict[str, Any] = None) -> Dict[str, Any]:
+        """组装单个场景的素材结果"""
         return {
             "scene_id": scene_id,
             "image_url": image_url,
+            "image_version": 1,
+            "image_variants": image_variants or {},
+            "image_draft": image_url in self.refine_jobs,
             "audio_url": audio_info["url"],       # 音频路径
             "audio_duration": audio_info["duration"],  # 新增：音频时长（秒）
             "audio_script": scene_design.get("visual_description", ""), 
@@ -51,6 +155,131 @@ class ProductionAgent:
             "assets_generated": True
         }
     
+    async def _generate_scene_images_batch(self, scene_designs: List[Dict[str, Any]], scene_ids: List[str], progress_callback: Callable[[int, int], None] = None) -> Dict[str, str]:
+        """按微批次生成多个场景的图片，返回 scene_id -> 图片URL"""
+        placeholder = "https://via.placeholder.com/800x600/4A90E2/FFFFFF?text=Scene+Image"
+        items = [
+            (scene_id, design.get("image_prompt", "a beautiful girl standing in the forest"))
+            for design, scene_id in zip(scene_designs, scene_ids)
+        ]
+        
+        draft = self.image_mode == "draft"
+        image_urls = await self._render_images(items, draft_settings() if draft else ImageSettings(), progress_callback)
+        
+        if draft:
+            # 记录草稿图，章节发布后由后台精修
+            for scene_id, prompt in items:
+                if image_urls.get(scene_id):
+                    self.refine_jobs[image_urls[scene_id]] = prompt
+                    self._refine_waiters[image_urls[scene_id]] = self._refine_waiters.get(image_urls[scene_id], 0) + 1
+        
+        # 如果生成失败返回默认占位符
+        return {scene_id: image_urls.get(scene_id) or placeholder for scene_id in scene_ids}
+    
+    async def _render_images(self, items: List[tuple], settings: ImageSettings, progress_callback: Callable[[int, int], None] = None) -> Dict[str, str]:
+        """按给定采样参数生成图片（工作进程或API进程内线程），返回 scene_id -> 图片URL"""
+        try:
+            if self.image_workers:
+                return await self._generate_images_in_workers(items, settings, progress_callback)
+            return await asyncio.to_thread(
+                generate_images_batch,
+                items=items,
+                output_dir=self.assets_dir / "images",
+                batch_size=self.image_batch_size,
+                pipeline_pool=self.pipeline_pool,
+                on_batch_done=progress_callback,
+                settings=settings
+            )
+        except Exception as e:
+            print(f"批量图片生成失败: {e}")
+            return {}
+    
+    def image_stats(self) -> Dict[str, Any]:
+        """图片生成统计：推理配置耗时、管线池、缓存和工作进程状态"""
+        return {
+            "profile": ImageSettings().profile,
+            "profile_latency": profile_latency.report(),
+            "pipeline_pool": self.pipeline_pool.stats(),
+            "cache": get_image_cache(self.assets_dir / "images").stats(),
+            "workers": self.image_workers.stats() if self.image_workers else None
+        }
+    
+    async def build_audio_sprite(self, scenes: List[Any]) -> Dict[str, Any]:
+        """AUDIO_SPRITE=1 时把章节各场景旁白合并为一个音频，返回URL和场景偏移表"""
+        if os.getenv("AUDIO_SPRITE", "0") != "1":
+            return {}
+        from tools.audio_sprite import build_chapter_sprite  # 按需导入ffmpeg
+        items = [
+            {"sceneId": scene.id, "audioUrl": scene.audioUrl, "duration": scene.duration}
+            for scene in scenes
+        ]
+        try:
+            return await asyncio.to_thread(build_chapter_sprite, items, self.assets_dir / "audios")
+        except Exception as e:
+            print(f"章节合并音频生成失败: {e}")
+            return {}
+    
+    def audio_stats(self) -> Dict[str, Any]:
+        """语音生成统计（后端不支持统计时返回后端名称）"""
+        audio_backend = get_backend("audio")
+        stats = {"concurrency": self.audio_concurrency, "timeout": self.audio_timeout}
+        if hasattr(audio_backend, "stats"):
+            return {**stats, **audio_backend.stats()}
+        return {**stats, "backend": type(audio_backend).__name__}
+    
+    def take_refine_jobs(self, image_urls: List[str]) -> Dict[str, str]:
+        """
+        取出指定草稿图的精修任务（草稿URL -> 提示词）
+        多本书命中同一张草稿图时各自取得任务（重复的精修命中图片缓存），所有书都取走后才移除
+        """
+        jobs = {}
+        for url in image_urls:
+            if url not in self.refine_jobs:
+                continue
+            jobs[url] = self.refine_jobs[url]
+            self._refine_waiters[url] -= 1
+            if self._refine_waiters[url] <= 0:
+                del self.refine_jobs[url]
+                del self._refine_waiters[url]
+        return jobs
+    
+    async def refine_images(self, refine_jobs: Dict[str, str]) -> Dict[str, str]:
+        """以完整参数重新生成草稿图，返回 草稿URL -> 精修图URL（失败的不包含）"""
+        items = list(refine_jobs.items())
+        image_urls = await self._render_images(items, ImageSettings())
+        return {draft_url: image_urls[draft_url] for draft_url, _ in items if image_urls.get(draft_url)}
+    
+    async def _generate_images_in_workers(self, items: List[tuple], settings: ImageSettings, progress_callback: Callable[[int, int], None] = None) -> Dict[str, str]:
+        """在图片工作进程中生成，各微批次分发到空闲进程并行渲染"""
+        cache = get_image_cache(self.assets_dir / "images")
+        results, jobs = await asyncio.to_thread(plan_image_jobs, items, cache, settings)
+        done = len(items) - sum(len(job["scene_ids"]) for job in jobs)
+        
+        async def run_batch(batch: List[Dict[str, Any]]):
+            nonlocal done
+            batch_scene_ids = [scene_id for job in batch for scene_id in job["scene_ids"]]
+            try:
+                result = await self.image_workers.run({
+                    "prompts": [job["prompt"] for job in batch],
+                    "paths": [job["path"] for job in batch],
+                    "settings": settings.to_dict()
+                })
+                # 工作进程中的耗时统计汇总到API进程
+                profile_latency.record(settings.profile, result["seconds"], len(batch), result["steps"])
+                for job in batch:
+                    image_url = commit_image_job(cache, job, settings)
+                    for scene_id in job["scene_ids"]:
+                        results[scene_id] = image_url
+            except Exception as e:
+                # 工作进程崩溃或超时只影响当前批次
+                print(f"图片工作进程生成失败 {batch_scene_ids}: {e}")
+            done += len(batch_scene_ids)
+            if progress_callback:
+                progress_callback(done, len(items))
+        
+        await asyncio.gather(*(run_batch(batch) for batch in split_batches(jobs, self.image_batch_size)))
+        return results
+    
     async def _generate_scene_image(self, scene_design: Dict[str, Any]) -> str:
         """生成场景图片"""
         try:
@@ -71,12 +300,17 @@ class ProductionAgent:
             print(f"visual_description: {visual_description}")
             print(f"image_prompt: {image_prompt}")
 
-            image_url = await asyncio.to_thread(
-                generate_image,
-                prompt=image_prompt,
-                scene_id=scene_id,
-                output_dir=output_dir
-            )
+            if self.image_workers:
+                image_urls = await self._generate_images_in_workers([(scene_id, image_prompt)], ImageSettings())
+                image_url = image_urls.get(scene_id, "")
+            else:
+                image_url = await asyncio.to_thread(
+                    generate_image,
+                    prompt=image_prompt,
+                    scene_id=scene_id,
+                    output_dir=output_dir,
+                    pipeline_pool=self.pipeline_pool
+                )
             
             # 如果生成失败返回默认占位符
             return image_url or "https://via.placeholder.com/800x600/4A90E2/FFFFFF?text=Scene+Image"
@@ -113,17 +347,34 @@ class ProductionAgent:
             audio_output_dir = self.assets_dir / "audios"
 
             # 调用工具生成语音（返回包含url和duration的字典）
-            audio_info = generate_audio(
-                text=dialogue_text,
-                scene_id=scene_id,
-                output_dir=audio_output_dir
-            )
+            # 信号量限制同时进行的合成数量；排队中的任务被取消时不会占用线程
+            async with self.audio_semaphore:
+                loop = asyncio.get_running_loop()
+                audio_info = await asyncio.wait_for(
+                    loop.run_in_executor(
+                        self.audio_executor, get_backend("audio").generate_audio,
+                        dialogue_text, scene_id, audio_output_dir
+                    ),
+                    timeout=self.audio_timeout if self.audio_timeout > 0 else None
+                )
 
             return audio_info if audio_info else {"url": "", "duration": 0}
+        except asyncio.TimeoutError:
+            print(f"语音生成超时（{self.audio_timeout}秒）: {scene_design.get('scene_id', 'default')}")
+            return {"url": "", "duration": 0}
         except Exception as e:
             print(f"语音生成失败: {e}")
             return {"url": "", "duration": 0}
     
+    async def prepare_animation_code(self, scene_designs: List[Dict[str, Any]]):
+        """为缺少CSS动画的场景预先生成动画代码（写回 css_animation），之后的素材生成不再调用LLM"""
+        missing = [design for design in scene_designs if not design.get("css_animation")]
+        if not missing:
+            return
+        codes = await asyncio.gather(*(self._generate_animation_code(design) for design in missing))
+        for design, code in zip(missing, codes):
+            design["css_animation"] = code
+    
     async def _generate_animation_code(self, scene_design: Dict[str, Any]) -> str:
         """生成动画代码"""
         try:
@@ -159,11 +410,12 @@ class ProductionAgent:
 请只返回CSS代码，不要包含其他文字。
 """
             
-            response = await self.ollama_client.generate(
-                model=self.model_name,
-                prompt=prompt,
-                stream=False
-            )
+            with llm_tags(agent="production", scene=scene_id):
+                response = await self.ollama_client.generate(
+                    model=self.model_name,
+                    prompt=prompt,
+                    stream=False
+                )
             
             animation_code = response.get("response", "").strip()
             
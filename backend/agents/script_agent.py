@@ -1,7 +1,12 @@
 import asyncio
-import json
+import re
 import uuid
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Callable, Optional
+from models import Script, llm_output_schema
+from utils.json_repair import generate_json, parse_llm_json, structured_output_enabled
+from utils.llm_telemetry import llm_tags
+from utils.json_stream import IncrementalJSONParser
+from utils.token_budget import chunk_text, estimate_tokens, script_token_budget
 
 class ScriptAgent:
     """编导Agent - 负责分析小说并创建剧本"""
@@ -10,13 +15,47 @@ class ScriptAgent:
         self.ollama_client = ollama_client
         self.model_name = "gemma3n:e4b" 
         # self.model_name = "qwen3:4b"
+        # 结构化输出：用剧本模型的JSON Schema约束生成（LLM_STRUCTURED_OUTPUT=0 关闭）
+        self.output_schema = llm_output_schema(Script, exclude=("chapter_content",)) if structured_output_enabled() else None
+        # 单次调用中章节正文的token预算（num_ctx 减去提示词模板和输出预留），超出时长章节切块生成
+        overhead = max(estimate_tokens(self._build_prompt("")), estimate_tokens(self._build_prompt("", 0, 2)))
+        self.token_budget = script_token_budget(overhead)
+        if self.token_budget < 256:
+            print(f"⚠️  OLLAMA_NUM_CTX 过小，剧本正文预算只有 {self.token_budget} tokens，按256切块")
+            self.token_budget = 256
     
-    async def create_script(self, chapter_content: str, chapter_index: int) -> Dict[str, Any]:
-        """为单个章节创建剧本"""
+    async def create_script(self, chapter_content: str, chapter_index: int,
+                            on_scene: Optional[Callable[[Dict[str, Any], str], None]] = None) -> Dict[str, Any]:
+        """
+        为单个章节创建剧本
+        :param on_scene: 传入时使用流式生成，每个场景一生成完就回调 on_scene(场景, 章节标题)，
+                         便于导演Agent提前开始设计
+        """
         
-        # 构建提示词
-        prompt = f"""
-作为一个专业的编导，请分析以下小说章节内容，并创建一个详细的剧本。
+        # 章节正文超出token预算时按段落切块，各块并行生成剧本后合并
+        content_tokens = estimate_tokens(chapter_content)
+        if content_tokens > self.token_budget:
+            return await self._create_script_in_chunks(chapter_content, chapter_index, on_scene, content_tokens)
+        
+        try:
+            return await self._generate_script(self._build_prompt(chapter_content), chapter_index, on_scene)
+        except Exception as e:
+            # 如果AI生成失败，返回默认剧本
+            print(f"剧本生成失败，使用默认剧本: {e}")
+            return self._create_default_script(chapter_content, chapter_index)
+    
+    def _build_prompt(self, chapter_content: str, part: Optional[int] = None, parts: int = 1) -> str:
+        """剧本提示词；part 为长章节切块后的块序号（从0开始）"""
+        
+        if part is None:
+            intro = "请分析以下小说章节内容，并创建一个详细的剧本。"
+            scene_hint = "根据章节内容长度划分场景个数，建议每个场景覆盖200-300字，每个章节建议3-8个场景；"
+        else:
+            intro = f"以下是一个较长小说章节的第 {part + 1}/{parts} 部分，请只为这一部分的内容创建详细的剧本，场景按情节先后排列。"
+            scene_hint = "根据这部分内容长度划分场景个数，建议每个场景覆盖200-300字；"
+        
+        return f"""
+作为一个专业的编导，{intro}
 
 章节内容：
 {chapter_content}
@@ -41,7 +80,7 @@ class ScriptAgent:
 }}
 
 要求：
-1. 根据章节内容长度划分场景个数，建议每个场景覆盖200-300字，每个章节建议3-8个场景；
+1. {scene_hint}
 2. 场景要有明确的视觉描述
 3. 对话要简洁有力
 4. 情感基调要准确
@@ -50,55 +89,104 @@ class ScriptAgent:
 
 请只返回JSON格式，不要包含其他文字。
 """
+    
+    async def _generate_script(self, prompt: str, chapter_index: int,
+                               on_scene: Optional[Callable[[Dict[str, Any], str], None]] = None,
+                               part: Optional[int] = None) -> Dict[str, Any]:
+        """调用模型生成剧本，解析失败时抛出异常"""
         
-        try:
-            # 调用Ollama生成剧本
-            response = await self.ollama_client.generate(
-                model=self.model_name,
-                prompt=prompt,
-                stream=False
-            )
-            
-            # 解析响应
-            script_text = response.get("response", "").strip()
-            
-            # 尝试解析JSON
-            try:
-                script_data = json.loads(script_text)
-            except json.JSONDecodeError:
-                # 如果JSON解析失败，尝试提取JSON部分
-                script_data = self._extract_json_from_text(script_text)
-            
-            # 确保每个场景都有唯一ID
-            for i, scene in enumerate(script_data.get("scenes", [])):
-                if "id" not in scene:
-                    scene["id"] = f"scene_{chapter_index}_{i}_{uuid.uuid4().hex[:8]}"
-            
-            return script_data
-            
-        except Exception as e:
-            # 如果AI生成失败，返回默认剧本
-            return self._create_default_script(chapter_content, chapter_index)
+        streamed: List[Dict[str, Any]] = []
+        with llm_tags(agent="script", chapter=chapter_index):
+            if on_scene is None:
+                # 调用Ollama生成剧本（解析失败时先本地修复，仍失败才重新生成）
+                script_data = await generate_json(
+                    self.ollama_client, self.model_name, prompt, schema=self.output_schema
+                )
+            else:
+                parser = await self._stream_script(prompt, chapter_index, on_scene, part)
+                script_data = parse_llm_json(parser.buffer)
+                streamed = parser.items
+                if not isinstance(script_data, dict) and streamed:
+                    # 整体解析失败时保留已流式解析出的场景
+                    script_data = {"chapter_title": parser.fields.get("chapter_title", ""), "scenes": streamed}
+        
+        if not isinstance(script_data, dict):
+            raise Exception("剧本JSON解析失败")
+        
+        if streamed:
+            if not script_data.get("scenes"):
+                script_data["scenes"] = streamed
+            # 已回调的场景沿用相同ID，保证与提前开始的场景设计对应
+            for scene, streamed_scene in zip(script_data["scenes"], streamed):
+                scene["id"] = streamed_scene["id"]
+        
+        # 确保每个场景都有唯一ID（已回调的场景除外）
+        for i, scene in enumerate(script_data.get("scenes", [])):
+            if i >= len(streamed):
+                self._ensure_scene_id(scene, chapter_index, i, part)
+        
+        return script_data
     
-    def _extract_json_from_text(self, text: str) -> Dict[str, Any]:
-        """从文本中提取JSON"""
-        import re
+    async def _create_script_in_chunks(self, chapter_content: str, chapter_index: int,
+                                       on_scene: Optional[Callable[[Dict[str, Any], str], None]],
+                                       content_tokens: int) -> Dict[str, Any]:
+        """长章节：按token预算切块，各块并行生成剧本，再按块顺序合并"""
         
-        # 尝试找到JSON块
-        json_match = re.search(r'\{.*\}', text, re.DOTALL)
-        if json_match:
+        chunks = chunk_text(chapter_content, self.token_budget)
+        print(f"章节 {chapter_index} 正文约 {content_tokens} tokens，超出预算 {self.token_budget}，分 {len(chunks)} 块生成剧本")
+        
+        async def script_part(part: int, chunk: str) -> Dict[str, Any]:
             try:
-                return json.loads(json_match.group(0))
-            except json.JSONDecodeError:
-                pass
+                return await self._generate_script(self._build_prompt(chunk, part, len(chunks)), chapter_index, on_scene, part)
+            except Exception as e:
+                # 单块失败只用默认场景替代这一块，不影响其他块
+                print(f"章节 {chapter_index} 第 {part + 1} 块剧本生成失败，使用默认场景: {e}")
+                fallback = self._create_default_script(chunk, chapter_index)
+                for i, scene in enumerate(fallback["scenes"]):
+                    scene.pop("id")
+                    self._ensure_scene_id(scene, chapter_index, i, part)
+                return fallback
+        
+        parts = await asyncio.gather(*(script_part(part, chunk) for part, chunk in enumerate(chunks)))
+        return self._merge_scripts(parts, chapter_content, chapter_index)
+    
+    def _merge_scripts(self, parts: List[Dict[str, Any]], chapter_content: str, chapter_index: int) -> Dict[str, Any]:
+        """合并各块剧本（不再调用模型）：章节标题取第一块，摘要按块拼接，场景按块顺序排列"""
         
-        # 如果找不到有效JSON，返回空结构
+        scenes = [scene for part in parts for scene in part.get("scenes", [])]
+        for i, scene in enumerate(scenes):
+            # 各块的场景标题都从“场景 1”开始编号，合并后按全章顺序重新编号
+            scene["title"] = re.sub(r"^场景\s*\d+", f"场景 {i + 1}", scene.get("title", "")) or f"场景 {i + 1}"
+        titles = [part.get("chapter_title") for part in parts if part.get("chapter_title")]
+        summaries = [part.get("chapter_summary") for part in parts if part.get("chapter_summary")]
         return {
-            "chapter_title": "未知章节",
-            "chapter_summary": "章节摘要解析失败",
-            "scenes": []
+            "chapter_title": titles[0] if titles else self._create_default_script(chapter_content, chapter_index)["chapter_title"],
+            "chapter_summary": "".join(summaries),
+            "scenes": scenes
         }
     
+    async def _stream_script(self, prompt: str, chapter_index: int,
+                             on_scene: Callable[[Dict[str, Any], str], None],
+                             part: Optional[int] = None) -> IncrementalJSONParser:
+        """流式生成剧本，scenes中的每个场景对象一闭合就回调"""
+        parser = IncrementalJSONParser("scenes")
+        kwargs = {"format": self.output_schema} if self.output_schema else {}
+        async for piece in self.ollama_client.generate_stream(model=self.model_name, prompt=prompt, **kwargs):
+            for scene in parser.feed(piece):
+                self._ensure_scene_id(scene, chapter_index, len(parser.items) - 1, part)
+                on_scene(scene, parser.fields.get("chapter_title", ""))
+        return parser
+    
+    def _ensure_scene_id(self, scene: Dict[str, Any], chapter_index: int, scene_index: int, part: Optional[int] = None):
+        """
+        补全场景ID；长章节切块生成时（part 不为None）各块模型给出的ID可能重复，
+        统一改为包含块序号的ID，合并后按块顺序排列
+        """
+        if part is not None:
+            scene["id"] = f"scene_{chapter_index}_{part}_{scene_index}_{uuid.uuid4().hex[:8]}"
+        elif "id" not in scene:
+            scene["id"] = f"scene_{chapter_index}_{scene_index}_{uuid.uuid4().hex[:8]}"
+    
     def _create_default_script(self, chapter_content: str, chapter_index: int) -> Dict[str, Any]:
         """创建默认剧本（当AI生成失败时使用）"""
         
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+使用占位后端测量 NovelProcessingFlow 的编排开销（不需要Ollama、torch、pyttsx3）
+
+用法: python bench_flow.py [小说文件] [--chapters N] [--image-latency S] [--audio-latency S] [--llm-latency S]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# 添加当前目录到Python路径
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def _sample_novel(chapters: int) -> str:
+    """生成测试用小说文本"""
+    parts = ["书名：基准测试\n作者：占位\n"]
+    for i in range(chapters):
+        parts.append(f"第{i + 1}章 测试章节{i + 1}\n" + "山风吹过村口的老槐树，少年背着柴走回家。" * 20 + "\n")
+    return "\n".join(parts)
+
+
+async def run_benchmark(novel_path: str):
+    from agent_flow import NovelProcessingFlow
+
+    flow = NovelProcessingFlow()
+    stage_times = []
+    start = time.perf_counter()
+
+    def on_status(stage: str, progress: int, message: str):
+        stage_times.append((time.perf_counter() - start, stage, progress, message))
+
+    chapters = await flow.process_novel(novel_path, on_status)
+    total = time.perf_counter() - start
+    flow.production_agent.shutdown()
+
+    scenes = sum(len(chapter.scenes) for chapter in chapters)
+    print("\n阶段耗时:")
+    previous = 0.0
+    for elapsed, stage, progress, message in stage_times:
+        print(f"  {elapsed:8.3f}s (+{elapsed - previous:6.3f}s) [{progress:3d}%] {stage}: {message}")
+        previous = elapsed
+    print(f"\n章节: {len(chapters)}，场景: {scenes}，总耗时: {total:.3f}s")
+    if scenes:
+        print(f"平均每场景: {total / scenes * 1000:.1f}ms")
+    print(f"图片统计: {flow.production_agent.image_stats()['profile_latency']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NovelProcessingFlow 编排开销基准")
+    parser.add_argument("novel", nargs="?", help="小说txt文件（默认生成测试文本）")
+    parser.add_argument("--chapters", type=int, default=5, help="生成测试文本的章节数")
+    parser.add_argument("--image-latency", type=float, default=0.0, help="每张占位图片的模拟耗时（秒）")
+    parser.add_argument("--audio-latency", type=float, default=0.0, help="每段占位语音的模拟耗时（秒）")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="每次占位LLM调用的模拟耗时（秒）")
+    args = parser.parse_args()
+
+    os.environ.setdefault("IMAGE_BACKEND", "stub")
+    os.environ.setdefault("AUDIO_BACKEND", "stub")
+    os.environ.setdefault("LLM_BACKEND", "stub")
+    os.environ["STUB_IMAGE_LATENCY"] = str(args.image_latency)
+    os.environ["STUB_AUDIO_LATENCY"] = str(args.audio_latency)
+    os.environ["STUB_LLM_LATENCY"] = str(args.llm_latency)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        novel_path = args.novel and str(Path(args.novel).resolve())
+        os.chdir(work_dir)  # 素材写入临时目录
+        if not novel_path:
+            novel_path = str(Path(work_dir) / "bench_novel.txt")
+            Path(novel_path).write_text(_sample_novel(args.chapters), encoding="utf-8")
+        asyncio.run(run_benchmark(novel_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,17 @@ from fastapi.responses import StreamingResponse
 import asyncio
 import json
 import os
+import threading
+import time
 import uuid
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any
 import uvicorn
 from pathlib import Path
 
 from agent_flow import NovelProcessingFlow
-from models import Chapter, Scene, ProcessingStatus
+from models import Chapter, Scene, ProcessingStatus, NarrationRequest
+from utils.ollama_client import llm_job, PRIORITY_INTERACTIVE
+from utils.llm_telemetry import llm_telemetry
 from utils.file_utils import extract_author, extract_book_title
 
 app = FastAPI(title="小说动画互动展示系统")
@@ -33,6 +37,32 @@ processing_status = ProcessingStatus(
 )
 chapters_data: List[Chapter] = []
 novel_flow = NovelProcessingFlow()
+# all.json 的读-改-写由上传处理和后台精修共同进行，需要串行化
+_books_index_lock = threading.Lock()
+
+@app.on_event("startup")
+async def warmup_pipelines():
+    """启动时预热图片生成管线（设置 SD_WARMUP=1 开启）"""
+    if os.getenv("SD_WARMUP", "0") == "1":
+        asyncio.create_task(novel_flow.production_agent.warmup())
+
+@app.on_event("startup")
+async def preload_llm_models():
+    """启动时在后台预热LLM模型，第一个请求不必等待模型加载（LLM_PRELOAD=0 关闭）"""
+    if os.getenv("LLM_PRELOAD", "1") == "1":
+        novel_flow.residency.preload_in_background()
+
+@app.on_event("shutdown")
+async def release_pipelines():
+    """关闭时释放常驻管线"""
+    novel_flow.production_agent.shutdown()
+
+@app.on_event("shutdown")
+async def dump_llm_telemetry():
+    """关闭时导出LLM调用遥测（设置 LLM_TELEMETRY_DUMP 为导出文件路径时）"""
+    dump_path = os.getenv("LLM_TELEMETRY_DUMP")
+    if dump_path:
+        llm_telemetry.dump(Path(dump_path))
 
 @app.post("/process-novel")
 async def process_novel(file: UploadFile = File(...)):
@@ -85,7 +115,9 @@ async def process_novel_async(file_path: Path):
         # 处理小说
         print(f"开始处理小说: {str(file_path)}")
         # chapters_data = {}
-        chapters_data = await novel_flow.process_novel(str(file_path), update_status)
+        # 上传触发的处理为交互优先级，同一本书的LLM请求归为一个任务参与公平调度
+        with llm_job(file_path.name, PRIORITY_INTERACTIVE):
+            chapters_data = await novel_flow.process_novel(str(file_path), update_status)
 
         # chapters_data = [Chapter(id='09f07061-e9da-4422-b7e8-486d2336abc7', title='山边小村', scenes=[Scene(id='d3ec8458-fcdf-49ca-b39d-a18063382abf', chapterIndex=0, sceneIndex=0, title='破屋残阳', description='黄昏时分，茅草屋顶在夕阳下泛着暗光，旧棉被上的霉斑如蛛网般蔓延，二愣子蜷缩在泥地上', imageUrl='/assets/images/image_SC001_20250712_174634.png', audioUrl='/assets/audios/audio_SC001_20250712_174607.mp3', animationCode='/* 棉絮飘动动画 */ @keyframes cottonSway { 0% {transform: translate(0,0) scale(1); opacity:1;} 100% {transform: translate(-10px,5px) scale(1.2); opacity:0.2;} } .cottonFibers { animation: cottonSway 15s linear infinite; } /* 霉斑蔓延动画 */ @keyframes moldSpread { 0% {opacity:0.3; transform: scale(1);} 100% {opacity:1; transform: scale(1.2);}} .moldSpots { animation: moldSpread 20s ease-in-out infinite; }', duration=3.25, audioScript='腐烂的棉絮在风中发出细碎声响'), Scene(id='82ddbb7a-4265-4410-8996-979f6b17838f', chapterIndex=0, sceneIndex=1, title='鼾声如雷', description='韩铸的鼾声在泥墙上震颤，打呼声与烟杆吸允声形成不规则节奏，墙缝渗出昏黄光线', imageUrl='/assets/images/image_SC002_20250712_174705.png', audioUrl='/assets/audios/audio_SC002_20250712_174634.mp3', animationCode=' @keyframes wall_light {\n 0% { opacity: 0.3; } \n 50% { opacity: 0.7; } \n 100% { opacity: 0.3; } \n }\n .wall-light { animation: wall_light 15s infinite; }', duration=2.64,audioScript='啪嗒啪嗒的烟杆声混着嘟嘟的鼾声',), Scene(id='f9c9d481-8fdd-4ab2-bee4-d50c1026f7a0', chapterIndex=0, sceneIndex=2, title='姓名密码', description='二愣子盯着褪色的棉被，指尖划过被面裂口，墙缝渗出的霉雾在脸上凝成细小水珠', imageUrl='/assets/images/image_SC003_20250712_174733.png', audioUrl='/assets/audios/audio_SC003_20250712_174705.mp3', animationCode='@keyframes moldFade { from {opacity:0.2} to {opacity:1}} @keyframes waterDrop { 0%{opacity:0} 50%{opacity:1} 100%{opacity:0}} .mold { animation: moldFade 5s linear forwards} .water { animation: waterDrop 1s ease-out forwards} .hand { animation: shake 0.3s ease-out forwards}', duration=2.09,audioScript="'窝头'两个字在舌尖发涩"), Scene(id='e5fb10b7-c15f-4966-ba2f-b3ccdd411821', chapterIndex=0, sceneIndex=3, title='晨光预兆', description='天光从裂缝透入，二愣子突然坐起，手指颤抖着扯开棉被，泥墙上爬满蛛网', imageUrl='/assets/images/image_SC004_20250712_174759.png', audioUrl='/assets/audios/audio_SC004_20250712_174733.mp3', animationCode='@keyframes lightFilter {0%{opacity:0.2;filter:blur(4px);}} 100%{opacity:1;filter:blur(0);} .crack-light {animation: lightFilter 5s ease-in-out infinite;}', duration=2.5,audioScript="'明天要捡柴'的念头刺破昏沉",)])]
         # 定时间隔3s更新status模拟测试状态，state顺序 splitting -> designing -> generating -> editing -> complete
@@ -123,12 +155,15 @@ async def process_novel_async(file_path: Path):
                         "title": scene.title,
                         "description": scene.description,
                         "imageUrl": scene.imageUrl,       # 新增字段
+                        "imageVersion": scene.imageVersion,  # 图片版本（草稿精修后递增）
+                        "imageVariants": scene.imageVariants,  # 多尺寸WebP/AVIF派生图（srcset）
                         "audioUrl": scene.audioUrl,       # 新增字段
                         "audioScript": scene.audioScript,       # 新增字段
                         "animationCode": scene.animationCode,  # 新增字段
                         "duration": scene.duration        # 新增字段
                     } for scene in chapter.scenes
-                ]
+                ],
+                "audioSprite": chapter.audioSprite  # 章节合并音频及各场景起始偏移（AUDIO_SPRITE=1）
             } for chapter in chapters_data
         ]
 
@@ -158,24 +193,21 @@ async def process_novel_async(file_path: Path):
             "name": book_title,
             "author": author,
             "chapters": len(chapters_dict),
-            "cover": chapters_dict[0]["scenes"][0]["imageUrl"]
+            "cover": _cover_url(chapters_dict[0]["scenes"][0]),
+            "coverVariants": chapters_dict[0]["scenes"][0]["imageVariants"]
         }
 
-        # 读取或初始化 all.json
-        if all_json_path.exists():
-            with open(all_json_path, 'r', encoding='utf-8') as f:
-                existing_data = json.load(f)
-        else:
-            existing_data = []
-        
-        existing_data.append(new_book_info)
-
-        # 写入更新后的 all.json
-        with open(all_json_path, 'w', encoding='utf-8') as f:
-            json.dump(existing_data, f, ensure_ascii=False, indent=2)
+        # 追加到 all.json（与后台精修串行、原子写入）
+        await asyncio.to_thread(_update_books_index, all_json_path, lambda books: books.append(new_book_info))
             
         # 清理临时文件
         os.remove(file_path)
+        
+        # 草稿模式：章节已可播放，后台精修图片并原地替换
+        draft_urls = [scene["imageUrl"] for chapter in chapters_dict for scene in chapter["scenes"]]
+        refine_jobs = novel_flow.production_agent.take_refine_jobs(draft_urls)
+        if refine_jobs:
+            asyncio.create_task(refine_book_images(books_dir / f"{safe_filename}.json", refine_jobs, list(chapters_data)))
 
     except Exception as e:
         processing_status.stage = "error"
@@ -184,6 +216,76 @@ async def process_novel_async(file_path: Path):
         processing_status.isComplete = False
         print (f"处理失败: {str(e)}")
 
+def _write_json_atomic(path: Path, data: Any):
+    """先写唯一的临时文件再原子替换，读取方不会看到写了一半的文件"""
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def _update_books_index(all_json_path: Path, update: Callable[[List[Dict[str, Any]]], None]):
+    """在锁内读取 all.json（不存在时为空列表）、修改并原子写回"""
+    with _books_index_lock:
+        if all_json_path.exists():
+            with open(all_json_path, 'r', encoding='utf-8') as f:
+                books = json.load(f)
+        else:
+            books = []
+        update(books)
+        _write_json_atomic(all_json_path, books)
+
+def _cover_url(scene: Dict[str, Any]) -> str:
+    """封面优先使用缩略尺寸的WebP派生图"""
+    return scene.get("imageVariants", {}).get("webp", {}).get("thumb") or scene["imageUrl"]
+
+async def refine_book_images(book_path: Path, refine_jobs: Dict[str, str], chapters: List[Chapter]):
+    """后台精修草稿图：逐批生成完整质量图片，替换书籍JSON中的imageUrl并递增imageVersion"""
+    production_agent = novel_flow.production_agent
+    draft_urls = list(refine_jobs)
+    batch_size = max(1, production_agent.image_batch_size)
+    
+    for start in range(0, len(draft_urls), batch_size):
+        batch = {url: refine_jobs[url] for url in draft_urls[start:start + batch_size]}
+        try:
+            refined = await production_agent.refine_images(batch)
+            if refined:
+                variants = await production_agent.build_image_variants(list(refined.values()))
+                await asyncio.to_thread(_apply_refined_images, book_path, refined, variants, chapters)
+                print(f"图片精修完成 {start + len(batch)}/{len(draft_urls)}: {book_path.name}")
+        except Exception as e:
+            print(f"图片精修失败: {e}")
+
+def _apply_refined_images(book_path: Path, refined: Dict[str, str], variants: Dict[str, Dict[str, Any]], chapters: List[Chapter]):
+    """把精修图URL写回书籍JSON、all.json封面和内存中的章节数据"""
+    with open(book_path, 'r', encoding='utf-8') as f:
+        book = json.load(f)
+    for chapter in book:
+        for scene in chapter["scenes"]:
+            if scene.get("imageUrl") in refined:
+                scene["imageUrl"] = refined[scene["imageUrl"]]
+                scene["imageVersion"] = scene.get("imageVersion", 1) + 1
+                scene["imageVariants"] = variants.get(scene["imageUrl"], {})
+    _write_json_atomic(book_path, book)
+    
+    cover_scene = book[0]["scenes"][0] if book and book[0]["scenes"] else None
+    
+    def update_cover(books: List[Dict[str, Any]]):
+        for info in books:
+            if info.get("path") == f"/books/{book_path.name}" and cover_scene:
+                info["cover"] = _cover_url(cover_scene)
+                info["coverVariants"] = cover_scene.get("imageVariants", {})
+    
+    all_json_path = book_path.parent / "all.json"
+    if all_json_path.exists():
+        _update_books_index(all_json_path, update_cover)
+    
+    for chapter in chapters:
+        for scene in chapter.scenes:
+            if scene.imageUrl in refined:
+                scene.imageUrl = refined[scene.imageUrl]
+                scene.imageVersion += 1
+                scene.imageVariants = variants.get(scene.imageUrl, {})
+
 @app.get("/processing-status")
 async def get_processing_status():
     """获取处理状态的SSE流"""
@@ -200,6 +302,57 @@ async def get_processing_status():
     
     return StreamingResponse(event_stream(), media_type="text/event-stream")
 
+@app.get("/image-stats")
+async def get_image_stats():
+    """图片生成统计（各推理配置的耗时、管线池、缓存命中）"""
+    return novel_flow.production_agent.image_stats()
+
+@app.get("/audio-stats")
+async def get_audio_stats():
+    """语音合成统计（合成耗时 / 每秒音频的合成延迟、TTS工作进程状态）"""
+    return novel_flow.production_agent.audio_stats()
+
+@app.get("/llm-stats")
+async def get_llm_stats():
+    """LLM调度统计（队列深度、排队等待时间、各模型/任务的运行数、场景设计的prompt计算量、模型加载/卸载事件）"""
+    client = novel_flow.ollama_client
+    stats = client.stats() if hasattr(client, "stats") else {}
+    return {
+        **stats,
+        "director": novel_flow.director_agent.prompt_eval_report(),
+        "residency": novel_flow.residency.stats()
+    }
+
+@app.get("/llm-telemetry")
+async def get_llm_telemetry(calls: bool = False):
+    """LLM调用遥测：按Agent汇总的token用量、推理时间占比和生成速度/排队时间/加载时间直方图（calls=true 附带调用明细）"""
+    return llm_telemetry.summary(include_calls=calls)
+
+@app.post("/llm-telemetry/dump")
+async def dump_llm_telemetry_now():
+    """把LLM调用遥测导出为JSON文件"""
+    path = Path("logs") / f"llm_telemetry_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    await asyncio.to_thread(llm_telemetry.dump, path)
+    return {"path": str(path)}
+
+@app.post("/narration")
+async def start_narration(request: NarrationRequest):
+    """分句流式旁白：首句合成完成即返回HLS播放列表地址，其余分句在后台继续追加"""
+    if not request.text.strip():
+        raise HTTPException(status_code=400, detail="朗读文本不能为空")
+    from tools.audio_stream import open_narration_stream  # 按需导入ffmpeg
+    stream = open_narration_stream(request.text, Path("assets") / "audios" / "streams")
+    await asyncio.to_thread(stream.wait_first_segment, float(os.getenv("NARRATION_FIRST_TIMEOUT", "30")))
+    if stream.error and not stream.segments:
+        raise HTTPException(status_code=500, detail=f"旁白生成失败: {stream.error}")
+    return {
+        "playlist": stream.playlist_url,
+        "chunks": len(stream.chunks),
+        "ready": len(stream.segments),
+        "complete": stream.done.is_set(),
+        "firstAudioSeconds": stream.first_audio_seconds
+    }
+
 @app.get("/books")
 async def get_books():
     books_dir = Path("assets") / "books"
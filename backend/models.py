@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Dict, Any
 from dataclasses import dataclass
 
 @dataclass
@@ -24,6 +24,8 @@ class Scene(BaseModel):
     title: str
     description: str
     imageUrl: str
+    imageVersion: int = 1
+    imageVariants: Dict[str, Any] = {}
     audioUrl: str
     audioScript: str
     animationCode: str
@@ -33,15 +35,69 @@ class Chapter(BaseModel):
     id: str
     title: str
     scenes: List[Scene]
+    audioSprite: Dict[str, Any] = {}
+
+class NarrationRequest(BaseModel):
+    text: str
+
+class ScriptScene(BaseModel):
+    """编导Agent输出的单个场景"""
+    id: str
+    title: str
+    description: str
+    dialogue: str
+    emotion: str = "neutral"
+    setting: str = ""
+    characters: List[str] = []
+    key_events: List[str] = []
+    duration: float = 30
 
 class Script(BaseModel):
     chapter_title: str
-    chapter_content: str
-    scenes: List[dict]
+    chapter_summary: str = ""
+    chapter_content: str = ""
+    scenes: List[ScriptScene]
 
 class SceneDesign(BaseModel):
+    """导演Agent输出的场景设计（非必需字段缺失时由下游使用默认值）"""
     scene_id: str
     visual_description: str
-    dialogue: str
-    animation_effects: str
-    duration: float
\ No newline at end of file
+    image_prompt: str
+    dialogue_text: str
+    dialogue: str = ""
+    animation_effects: str = ""
+    css_animation: str = ""
+    camera_angle: str = ""
+    mood: str = ""
+    color_palette: List[str] = []
+    duration: float = 30
+
+def llm_output_schema(model: type, exclude: tuple = ()) -> Dict[str, Any]:
+    """
+    由数据模型生成传给Ollama format参数的JSON Schema
+    内联 $defs 引用（模型的结构化输出对嵌套引用支持有限），并去掉 exclude 中不需要模型生成的字段
+    """
+    schema = model.model_json_schema()
+    defs = schema.pop("$defs", {})
+
+    def resolve(node: Any) -> Any:
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return resolve(defs[node["$ref"].rsplit("/", 1)[-1]])
+            resolved = {}
+            for key, value in node.items():
+                if key == "properties":
+                    resolved[key] = {name: resolve(prop) for name, prop in value.items()}
+                elif key not in ("title", "default"):
+                    resolved[key] = resolve(value)
+            return resolved
+        if isinstance(node, list):
+            return [resolve(item) for item in node]
+        return node
+
+    schema = resolve(schema)
+    for field in exclude:
+        schema["properties"].pop(field, None)
+        if field in schema.get("required", []):
+            schema["required"].remove(field)
+    return schema
\ No newline at end of file
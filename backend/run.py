@@ -11,19 +11,29 @@ sys.path.insert(0, str(Path(__file__).parent))
 async def check_ollama_connection():
     """检查Ollama连接"""
     from utils.ollama_client import OllamaClient
+    from utils.model_residency import preload_models
+    from tools.backends import backend_name
+    
+    if backend_name("llm") != "ollama":
+        print(f"使用 {backend_name('llm')} LLM后端，跳过Ollama连接检查")
+        return True
     
     print("检查Ollama连接...")
     try:
         async with OllamaClient() as client:
             models = await client.list_models()
             print(f"✓ Ollama连接成功，可用模型: {len(models.get('models', []))} 个")
+            for endpoint in client.endpoints.stats():
+                status = "不可用" if endpoint["models"] is None else f"{len(endpoint['models'])} 个模型"
+                print(f"   节点 {endpoint['url']}: {status}")
             
-            # 检查是否有gemma3n:e4b模型
-            if not await client.check_model_exists("gemma3n:e4b"):
-                print("⚠️  警告: 未找到gemma3n:e4b模型")
-                print("   请运行: ollama pull gemma3n:e4b")
-            else:
-                print("✓ gemma3n:e4b 模型已就绪")
+            # 检查需要预热的模型是否都已拉取（服务启动后会在后台预热）
+            for model in preload_models():
+                if not await client.check_model_exists(model):
+                    print(f"⚠️  警告: 未找到{model}模型")
+                    print(f"   请运行: ollama pull {model}")
+                else:
+                    print(f"✓ {model} 模型已就绪")
                 
     except Exception as e:
         print(f"✗ Ollama连接失败: {e}")
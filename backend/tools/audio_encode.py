@@ -0,0 +1,127 @@
+import os
+import struct
+import uuid
+import wave
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# 目标编码：后缀、ffmpeg编码器、容器格式和参数；wav 表示不转码，直接保留TTS输出
+CODECS: Dict[str, Dict[str, Any]] = {
+    "mp3": {"suffix": ".mp3", "acodec": "libmp3lame", "format": "mp3", "options": {"q:a": 4}},
+    "opus": {"suffix": ".ogg", "acodec": "libopus", "format": "ogg", "options": {"b:a": "48k", "application": "voip"}},
+    "wav": {"suffix": ".wav"},
+}
+
+
+def default_codec() -> str:
+    """场景语音的目标编码（AUDIO_CODEC：mp3 / opus / wav）"""
+    codec = os.getenv("AUDIO_CODEC", "mp3")
+    if codec not in CODECS:
+        raise ValueError(f"未知的音频编码: {codec}，可选: {', '.join(CODECS)}")
+    return codec
+
+
+def codec_suffix(codec: str) -> str:
+    return CODECS[codec]["suffix"]
+
+
+def _aiff_duration(path: Path) -> Optional[float]:
+    """读取AIFF/AIFC头部的COMM块计算时长（macOS nsss驱动即使指定.wav也会输出AIFF）"""
+    with open(path, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b"FORM" or header[8:12] not in (b"AIFF", b"AIFC"):
+            return None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, size = chunk[:4], struct.unpack(">I", chunk[4:])[0]
+            if chunk_id != b"COMM":
+                f.seek(size + (size & 1), 1)
+                continue
+            data = f.read(18)
+            frames = struct.unpack(">I", data[2:6])[0]
+            # 采样率是80位扩展精度浮点数
+            exponent = struct.unpack(">H", data[8:10])[0] & 0x7FFF
+            mantissa = struct.unpack(">Q", data[10:18])[0]
+            sample_rate = mantissa * 2.0 ** (exponent - 16383 - 63)
+            return frames / sample_rate if sample_rate else None
+
+
+def audio_duration(path: Path) -> float:
+    """
+    从文件头计算音频时长（秒），无需解码音频数据
+    支持PCM WAV和AIFF，其他格式回退到ffprobe
+    """
+    path = Path(path)
+    try:
+        with wave.open(str(path), "rb") as wav:
+            return wav.getnframes() / float(wav.getframerate())
+    except (wave.Error, EOFError):
+        pass
+    duration = _aiff_duration(path)
+    if duration is not None:
+        return duration
+    import ffmpeg  # 按需导入：WAV/AIFF时长和wav编码不需要ffmpeg
+    probe = ffmpeg.probe(str(path))
+    return float(probe["format"]["duration"])
+
+
+def encode_audio(source_path: Path, target_path: Path, codec: Optional[str] = None) -> Path:
+    """
+    用一次ffmpeg调用把TTS输出编码为目标格式，先写临时文件再原子替换
+    :return: 目标文件路径
+    """
+    codec = codec or default_codec()
+    spec = CODECS[codec]
+    source_path, target_path = Path(source_path), Path(target_path)
+    if "acodec" not in spec:
+        os.replace(source_path, target_path)
+        return target_path
+
+    import ffmpeg
+    # 每次调用使用唯一的临时文件名，同一目标的并发编码不会互相覆盖
+    tmp_path = target_path.with_name(f".{target_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        (
+            ffmpeg.input(str(source_path))
+            .output(str(tmp_path), acodec=spec["acodec"], format=spec["format"], **spec["options"])
+            .overwrite_output()
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+    except ffmpeg.Error as e:
+        tmp_path.unlink(missing_ok=True)
+        stderr = e.stderr.decode("utf-8", errors="ignore") if e.stderr else ""
+        raise Exception(f"FFmpeg编码失败：{stderr[-500:]}")
+    os.replace(tmp_path, target_path)
+    return target_path
+
+
+def concat_audio(source_paths: List[Path], target_path: Path, codec: Optional[str] = None) -> Path:
+    """
+    用ffmpeg concat滤镜把多段音频按顺序拼接并编码为一个文件（各段采样率/声道由ffmpeg自动统一）
+    :return: 目标文件路径
+    """
+    codec = codec or default_codec()
+    spec = CODECS[codec]
+    target_path = Path(target_path)
+    acodec = spec.get("acodec", "pcm_s16le")
+    container = spec.get("format", "wav")
+    options = spec.get("options", {})
+
+    import ffmpeg
+    tmp_path = target_path.with_name(f".{target_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    streams = [ffmpeg.input(str(path)).audio for path in source_paths]
+    try:
+        (
+            ffmpeg.concat(*streams, v=0, a=1)
+            .output(str(tmp_path), acodec=acodec, format=container, **options)
+            .overwrite_output()
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+    except ffmpeg.Error as e:
+        tmp_path.unlink(missing_ok=True)
+        stderr = e.stderr.decode("utf-8", errors="ignore") if e.stderr else ""
+        raise Exception(f"FFmpeg拼接失败：{stderr[-500:]}")
+    os.replace(tmp_path, target_path)
+    return target_path
@@ -0,0 +1,46 @@
+import hashlib
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from tools.audio_encode import audio_duration, codec_suffix, concat_audio, default_codec
+
+
+def build_chapter_sprite(scenes: List[Dict[str, Any]], audio_dir: Path, url_prefix: str = "/assets/audios",
+                         codec: Optional[str] = None) -> Dict[str, Any]:
+    """
+    把章节内各场景的旁白按顺序拼接成一个音频文件，并生成场景起始偏移表
+    :param scenes: [{"sceneId": .., "audioUrl": .., "duration": ..}]，按播放顺序排列
+    :param audio_dir: 场景音频所在目录（合并音频也写入该目录）
+    :return: {"url": .., "duration": .., "cues": [{"sceneId", "start", "duration"}]}；没有可用音频时返回空字典
+    """
+    codec = codec or default_codec()
+    audio_dir = Path(audio_dir)
+    sources = []
+    cues = []
+    offset = 0.0
+    for scene in scenes:
+        audio_url = scene.get("audioUrl") or ""
+        source_path = audio_dir / audio_url.rsplit("/", 1)[-1] if audio_url.startswith(f"{url_prefix}/") else None
+        if source_path is None or not source_path.exists():
+            # 没有旁白的场景在偏移表中时长为0，客户端按场景自身时长展示
+            cues.append({"sceneId": scene["sceneId"], "start": round(offset, 3), "duration": 0.0})
+            continue
+        duration = scene.get("duration") or audio_duration(source_path)
+        sources.append(source_path)
+        cues.append({"sceneId": scene["sceneId"], "start": round(offset, 3), "duration": round(float(duration), 3)})
+        offset += float(duration)
+
+    if not sources:
+        return {}
+
+    # 文件名由场景音频列表决定，相同章节重复处理时直接复用
+    digest = hashlib.sha256("\n".join(path.name for path in sources).encode("utf-8")).hexdigest()
+    sprite_path = audio_dir / f"chapter_{digest[:16]}{codec_suffix(codec)}"
+    if not sprite_path.exists():
+        concat_audio(sources, sprite_path, codec)
+        print(f"章节合并音频生成成功: {sprite_path}（{len(sources)} 段，{offset:.2f}秒）")
+
+    return {
+        "url": f"{url_prefix}/{sprite_path.name}",
+        "duration": round(offset, 3),
+        "cues": cues
+    }
@@ -0,0 +1,213 @@
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from tools.audio_encode import audio_duration, encode_audio
+from tools.backends import get_backend
+from tools.generate_audio import audio_cache_key, normalize_tts_text
+from tools.tts_workers import tts_stats
+
+# 一句话：到句末标点（中英文，含其后的引号括号）为止；英文句点后需跟空白或结尾，避免切开小数
+_SENTENCE = re.compile(r'.+?(?:[。！？!?；;…]+["”’』」）)]*|\.(?=\s|$)|$)', re.S)
+# 句内停顿，句子过长时在这里继续切分
+_CLAUSE_END = re.compile(r'(?<=[，,、：:])')
+
+PLAYLIST_NAME = "index.m3u8"
+
+
+def split_sentences(text: str, max_chars: int = 80, first_max_chars: int = 24) -> List[str]:
+    """
+    按中英文句末标点切分朗读文本
+    :param max_chars: 单段最大字数，超出时按逗号等停顿继续切分
+    :param first_max_chars: 首段最大字数（首段越短，首次出声越快）
+    """
+    text = normalize_tts_text(text)
+    sentences = [s.strip() for s in _SENTENCE.findall(text) if s.strip()]
+    chunks: List[str] = []
+
+    def limit() -> int:
+        return first_max_chars if not chunks else max_chars
+
+    for sentence in sentences:
+        if len(sentence) <= limit():
+            chunks.append(sentence)
+            continue
+        current = ""
+        for clause in (c for c in _CLAUSE_END.split(sentence) if c):
+            if current and len(current) + len(clause) > limit():
+                chunks.append(current.strip())
+                current = ""
+            current += clause
+            # 没有停顿标点的超长片段按字数硬切
+            while len(current) > limit():
+                size = limit()
+                chunks.append(current[:size].strip())
+                current = current[size:]
+        if current.strip():
+            chunks.append(current.strip())
+    return chunks
+
+
+class NarrationStream:
+    """分句流式旁白
+
+    - 文本按句切分后依次提交给TTS工作进程，按原顺序编码为MP3分片
+    - 每完成一个分片就追加到HLS播放列表（EVENT类型），播放器拿到首个分片即可开始播放
+    - 全部完成后写入 #EXT-X-ENDLIST；同一文本已完成的播放列表直接复用
+    - 分句合成走当前语音后端（AUDIO_BACKEND），占位后端下同样可用
+    """
+
+    def __init__(self, text: str, output_dir: Path, url_prefix: str = "/assets/audios/streams"):
+        self.text = normalize_tts_text(text)
+        self.key = audio_cache_key(self.text, "hls-mp3")
+        self.stream_dir = Path(output_dir) / self.key[:16]
+        self.playlist_url = f"{url_prefix}/{self.key[:16]}/{PLAYLIST_NAME}"
+        self.chunks = split_sentences(self.text)
+        self.segments: List[Tuple[str, float]] = []
+        self.first_segment = threading.Event()
+        self.done = threading.Event()
+        self.error: Optional[str] = None
+        self.first_audio_seconds: Optional[float] = None
+        # 目标分片时长在开始前按字数估算（HLS要求不能变化），按每秒3个字的保守语速
+        self.target_duration = max([math.ceil(len(chunk) / 3) + 1 for chunk in self.chunks] or [1])
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def playlist_path(self) -> Path:
+        return self.stream_dir / PLAYLIST_NAME
+
+    def is_complete_on_disk(self) -> bool:
+        return self.playlist_path.exists() and "#EXT-X-ENDLIST" in self.playlist_path.read_text(encoding="utf-8")
+
+    def _load_playlist(self):
+        """从磁盘上已完成的播放列表读取分片列表（复用时状态中的就绪分片数与时长保持正确）"""
+        duration = None
+        segments = []
+        for line in self.playlist_path.read_text(encoding="utf-8").splitlines():
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",", 1)[0])
+            elif line and not line.startswith("#") and duration is not None:
+                segments.append((line, duration))
+                duration = None
+        self.segments = segments
+
+    def start(self) -> "NarrationStream":
+        """后台线程中开始合成（已完成的播放列表读取分片后直接标记完成）"""
+        if self.is_complete_on_disk():
+            self._load_playlist()
+            # 刷新目录修改时间，复用中的播放列表不会被过期清理
+            os.utime(self.stream_dir)
+            self.first_segment.set()
+            self.done.set()
+            return self
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"narration-{self.key[:8]}", daemon=True)
+            self._thread.start()
+        return self
+
+    def wait_first_segment(self, timeout: Optional[float] = None) -> bool:
+        return self.first_segment.wait(timeout)
+
+    def _run(self):
+        start = time.time()
+        self.stream_dir.mkdir(parents=True, exist_ok=True)
+        self._write_playlist()
+        futures = []
+        try:
+            # 一次性提交所有分句，多个TTS工作进程时可并行合成，发布时保持原顺序
+            backend = get_backend("audio")
+            wav_paths = [self.stream_dir / f".seg_{i:03d}_{uuid.uuid4().hex[:8]}.wav" for i in range(len(self.chunks))]
+            futures = [backend.synthesize(chunk, path) for chunk, path in zip(self.chunks, wav_paths)]
+            for index, (future, wav_path) in enumerate(zip(futures, wav_paths)):
+                try:
+                    synth = future.result()
+                    duration = audio_duration(wav_path)
+                    segment_name = f"seg_{index:03d}.mp3"
+                    encode_audio(wav_path, self.stream_dir / segment_name, "mp3")
+                finally:
+                    wav_path.unlink(missing_ok=True)
+                tts_stats.record(synth["seconds"], duration)
+                self.segments.append((segment_name, duration))
+                self._write_playlist()
+                if index == 0:
+                    self.first_audio_seconds = time.time() - start
+                    print(f"流式旁白首段就绪: {self.playlist_url}（{self.first_audio_seconds:.2f}秒）")
+                    self.first_segment.set()
+            self._write_playlist(ended=True)
+            print(f"流式旁白完成: {self.playlist_url}（{len(self.segments)} 段，耗时 {time.time() - start:.2f}秒）")
+        except Exception as e:
+            self.error = str(e)
+            print(f"流式旁白生成失败: {e}")
+            for future in futures:
+                future.cancel()
+        finally:
+            self.first_segment.set()
+            self.done.set()
+
+    def _write_playlist(self, ended: bool = False):
+        """原子写入HLS播放列表"""
+        target = max([self.target_duration] + [math.ceil(d) for _, d in self.segments])
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{target}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:EVENT"
+        ]
+        for name, duration in self.segments:
+            lines.append(f"#EXTINF:{duration:.3f},")
+            lines.append(name)
+        if ended:
+            lines.append("#EXT-X-ENDLIST")
+        tmp_path = self.playlist_path.with_name(f".{PLAYLIST_NAME}.{uuid.uuid4().hex[:8]}.tmp")
+        tmp_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        os.replace(tmp_path, self.playlist_path)
+
+
+_streams: Dict[str, NarrationStream] = {}
+_streams_lock = threading.Lock()
+
+
+def cleanup_narration_streams(output_dir: Path, ttl: float) -> int:
+    """删除超过 ttl 秒未更新或复用的旁白目录（进行中的除外），返回删除的目录数"""
+    output_dir = Path(output_dir)
+    if ttl <= 0 or not output_dir.exists():
+        return 0
+    with _streams_lock:
+        active = {stream.stream_dir.name for stream in _streams.values()}
+    removed = 0
+    now = time.time()
+    for stream_dir in output_dir.iterdir():
+        if not stream_dir.is_dir() or stream_dir.name in active:
+            continue
+        try:
+            if now - stream_dir.stat().st_mtime <= ttl:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(stream_dir, ignore_errors=True)
+        removed += 1
+    if removed:
+        print(f"清理过期旁白: {removed} 个")
+    return removed
+
+
+def open_narration_stream(text: str, output_dir: Path) -> NarrationStream:
+    """开始（或复用进行中的）流式旁白，顺带清理过期的旁白目录（NARRATION_STREAM_TTL）"""
+    stream = NarrationStream(text, output_dir)
+    with _streams_lock:
+        # 清理已结束的记录，进行中的同一文本直接复用
+        for key in [k for k, s in _streams.items() if s.done.is_set()]:
+            _streams.pop(key)
+        existing = _streams.get(stream.key)
+        if existing is not None:
+            return existing
+        _streams[stream.key] = stream
+    cleanup_narration_streams(output_dir, float(os.getenv("NARRATION_STREAM_TTL", str(7 * 24 * 3600))))
+    return stream.start()
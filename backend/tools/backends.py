@@ -0,0 +1,277 @@
+import asyncio
+import hashlib
+import importlib
+import json
+import math
+import os
+import re
+import struct
+import threading
+import time
+import uuid
+import wave
+import zlib
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+# 后端注册表：类型 -> 名称 -> 工厂（可调用对象或 "module:attr" 字符串，按需导入以避免加载torch等重依赖）
+_REGISTRY: Dict[str, Dict[str, Union[str, Callable[[], Any]]]] = {
+    "image": {
+        "sd": "tools.generate_image:StableDiffusionBackend",
+        "stub": "tools.backends:StubImageBackend",
+    },
+    "audio": {
+        "tts": "tools.generate_audio:TTSAudioBackend",
+        "stub": "tools.backends:StubAudioBackend",
+    },
+    "llm": {
+        "ollama": "utils.ollama_client:OllamaClient",
+        "stub": "tools.backends:StubLLMClient",
+    },
+}
+# 默认后端，可用 IMAGE_BACKEND / AUDIO_BACKEND / LLM_BACKEND 环境变量切换
+DEFAULT_BACKENDS = {"image": "sd", "audio": "tts", "llm": "ollama"}
+
+_instances: Dict[str, Any] = {}
+_instances_lock = threading.Lock()
+
+
+def register_backend(kind: str, name: str, factory: Union[str, Callable[[], Any]]):
+    """注册后端实现（factory 为无参可调用对象或 "module:attr"）"""
+    _REGISTRY.setdefault(kind, {})[name] = factory
+    with _instances_lock:
+        _instances.pop(kind, None)
+
+
+def backend_name(kind: str) -> str:
+    """当前选用的后端名称"""
+    return os.getenv(f"{kind.upper()}_BACKEND", DEFAULT_BACKENDS[kind])
+
+
+def create_backend(kind: str, name: Optional[str] = None) -> Any:
+    """创建一个新的后端实例"""
+    name = name or backend_name(kind)
+    factories = _REGISTRY.get(kind, {})
+    if name not in factories:
+        raise ValueError(f"未知的{kind}后端: {name}，可选: {', '.join(factories)}")
+    factory = factories[name]
+    if isinstance(factory, str):
+        module_name, attr = factory.split(":")
+        factory = getattr(importlib.import_module(module_name), attr)
+    return factory()
+
+
+def get_backend(kind: str) -> Any:
+    """获取进程内共享的后端实例"""
+    with _instances_lock:
+        instance = _instances.get(kind)
+        if instance is None:
+            instance = _instances[kind] = create_backend(kind)
+        return instance
+
+
+def _latency(kind: str) -> float:
+    """占位后端的模拟耗时（秒），STUB_IMAGE_LATENCY / STUB_AUDIO_LATENCY / STUB_LLM_LATENCY"""
+    return float(os.getenv(f"STUB_{kind.upper()}_LATENCY", "0"))
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def write_placeholder_png(path: Path, width: int, height: int, seed_text: str):
+    """生成确定性的渐变占位PNG（纯标准库实现，不依赖PIL）"""
+    digest = _digest(seed_text)
+    top = digest[0:3]
+    bottom = digest[3:6]
+    rows = []
+    for y in range(height):
+        t = y / max(height - 1, 1)
+        color = bytes(int(top[c] * (1 - t) + bottom[c] * t) for c in range(3))
+        rows.append(b"\x00" + color * width)
+    raw = zlib.compress(b"".join(rows), 6)
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    png = (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", raw)
+        + chunk(b"IEND", b"")
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    tmp_path.write_bytes(png)
+    os.replace(tmp_path, path)
+
+
+def write_tone_wav(path: Path, seconds: float, frequency: float = 440.0, sample_rate: int = 16000, silent: bool = False):
+    """生成正弦波（或静音）WAV"""
+    frames = int(seconds * sample_rate)
+    samples = bytearray()
+    for i in range(frames):
+        value = 0 if silent else int(8000 * math.sin(2 * math.pi * frequency * i / sample_rate))
+        samples += struct.pack("<h", value)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(bytes(samples))
+
+
+class StubImageBackend:
+    """占位图片后端：按提示词生成确定性的渐变PNG"""
+
+    def default_profile(self) -> str:
+        return "stub"
+
+    def configure_threads(self, torch_threads: int):
+        pass
+
+    def warmup(self, pipeline_pool=None):
+        pass
+
+    def render_images(self, prompts: List[str], image_paths: List[str], settings: Any, pipeline_pool=None) -> Dict[str, Any]:
+        start = time.time()
+        time.sleep(_latency("image") * len(prompts))
+        for prompt, image_path in zip(prompts, image_paths):
+            write_placeholder_png(Path(image_path), settings.width, settings.height, f"{prompt}|{settings.seed}")
+        return {"seconds": time.time() - start, "steps": settings.steps or 1}
+
+
+class StubAudioBackend:
+    """占位语音后端：按文本长度生成正弦波WAV（STUB_AUDIO_SILENT=1 时生成静音）"""
+
+    chars_per_second = 5.0
+
+    def _write_tone(self, text: str, audio_path: Path) -> float:
+        time.sleep(_latency("audio"))
+        seconds = round(max(1.0, len(text.strip()) / self.chars_per_second), 2)
+        frequency = 220 + _digest(text)[0] * 2
+        write_tone_wav(audio_path, seconds, frequency, silent=os.getenv("STUB_AUDIO_SILENT", "0") == "1")
+        return seconds
+
+    def generate_audio(self, text: str, scene_id: str, output_dir: Path) -> Dict[str, Any]:
+        if not text.strip():
+            return {}
+        audio_path = Path(output_dir) / f"audio_{scene_id}_stub.wav"
+        seconds = self._write_tone(text, audio_path)
+        return {"url": f"/assets/audios/{audio_path.name}", "duration": seconds}
+
+    def synthesize(self, text: str, wav_path: Path) -> Future:
+        """与 TTSAudioBackend.synthesize 接口一致，同步生成后返回已完成的Future"""
+        start = time.time()
+        future: Future = Future()
+        self._write_tone(text, Path(wav_path))
+        future.set_result({"seconds": time.time() - start})
+        return future
+
+
+class StubLLMClient:
+    """占位LLM客户端：与OllamaClient接口一致，根据提示词类型返回固定格式的JSON/CSS"""
+
+    model_names = ["gemma3n:e4b"]
+
+    async def generate(self, model: str, prompt: str, stream: bool = False, no_cache: bool = False,
+                       refresh: bool = False, **kwargs) -> Dict[str, Any]:
+        await asyncio.sleep(_latency("llm"))
+        return {"model": model, "response": self._respond(prompt), "done": True}
+
+    async def generate_stream(self, model: str, prompt: str, no_cache: bool = False, **kwargs):
+        """流式输出：把固定结果切成小段，模拟耗时均匀分布在各段之间"""
+        response = self._respond(prompt)
+        pieces = [response[i:i + 16] for i in range(0, len(response), 16)] or [""]
+        for piece in pieces:
+            await asyncio.sleep(_latency("llm") / len(pieces))
+            yield piece
+
+    async def chat(self, model: str, messages: list, stream: bool = False, no_cache: bool = False,
+                   refresh: bool = False, **kwargs) -> Dict[str, Any]:
+        await asyncio.sleep(_latency("llm"))
+        prompt = "\n".join(m.get("content", "") for m in messages)
+        return {"model": model, "message": {"role": "assistant", "content": self._respond(prompt)}, "done": True}
+
+    async def generate_on_all_endpoints(self, model: str, prompt: str = "", **kwargs) -> Dict[str, Any]:
+        return {"stub": {"model": model, "response": "", "done": True}}
+
+    async def invalidate(self, model: str, prompt: str = None, messages: list = None, **kwargs) -> bool:
+        """占位客户端没有响应缓存"""
+        return False
+
+    def _respond(self, prompt: str) -> str:
+        if "专业的编导" in prompt:
+            return json.dumps(self._script(prompt), ensure_ascii=False)
+        if "专业的导演" in prompt:
+            return json.dumps(self._scene_design(prompt), ensure_ascii=False)
+        if "专业的剪辑师" in prompt:
+            return json.dumps({"issues": [], "suggestions": [], "missing_scenes": [], "fixes": []}, ensure_ascii=False)
+        # 动画代码
+        key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+        return (
+            f"@keyframes stub_{key} {{ 0% {{ opacity: 0; transform: scale(0.98); }} "
+            f"100% {{ opacity: 1; transform: scale(1); }} }}\n"
+            f".scene-animation {{ animation: stub_{key} 2s ease-in-out; }}"
+        )
+
+    def _script(self, prompt: str) -> Dict[str, Any]:
+        content = prompt.split("章节内容：", 1)[-1].split("请按照以下JSON格式", 1)[0].strip()
+        lines = [line.strip() for line in content.split("\n") if line.strip()]
+        key = hashlib.sha256(content.encode("utf-8")).hexdigest()[:8]
+        chunk_size = max(1, len(content) // 3)
+        scenes = []
+        for i in range(3):
+            text = content[i * chunk_size:(i + 1) * chunk_size].strip() or content[:100]
+            scenes.append({
+                "id": f"stub_{key}_{i}",
+                "title": f"场景 {i + 1}",
+                "description": text[:200],
+                "dialogue": text[:100],
+                "emotion": "neutral",
+                "setting": "未指定",
+                "characters": ["主角"],
+                "key_events": ["情节发展"],
+                "duration": 30
+            })
+        return {
+            "chapter_title": lines[0][:50] if lines else "未知章节",
+            "chapter_summary": content[:100],
+            "scenes": scenes
+        }
+
+    def _scene_design(self, prompt: str) -> Dict[str, Any]:
+        match = re.search(r"- 场景ID：(\S+)", prompt) or re.search(r'"scene_id":\s*"([^"]*)"', prompt)
+        scene_id = match.group(1) if match else "stub_scene"
+        description = re.search(r"- 描述：(.*)", prompt)
+        description = description.group(1).strip() if description else ""
+        return {
+            "scene_id": scene_id,
+            "visual_description": description or "一个安静的场景",
+            "image_prompt": f"A cinematic scene, {scene_id}, beautiful lighting, high quality",
+            "dialogue_text": description,
+            "animation_effects": "淡入淡出效果",
+            "camera_angle": "中景",
+            "mood": "neutral",
+            "color_palette": ["#90A4AE", "#78909C", "#607D8B"],
+            "duration": 30
+        }
+
+    async def list_models(self) -> Dict[str, Any]:
+        return {"models": [{"name": name} for name in self.model_names]}
+
+    async def check_model_exists(self, model: str) -> bool:
+        return True
+
+    async def pull_model(self, model: str) -> Dict[str, Any]:
+        return {"status": "success"}
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
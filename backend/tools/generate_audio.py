@@ -1,133 +1,229 @@
-import pyttsx3
-from pathlib import Path
-import ffmpeg  # pip3 install python-ffmpeg
-from pydub import AudioSegment  # 新增：用于获取音频时长 pip3 install audioop-lts
+import multiprocessing as mp
+import os
+import re
+import threading
 import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Any, Optional
+from tools.audio_encode import audio_duration, encode_audio, codec_suffix, default_codec
+from tools.tts_workers import get_tts_pool, shutdown_tts_pool, tts_stats, tts_voice_settings
+from utils.asset_cache import AssetCache
 
-class _TTS:
+_audio_caches: Dict[str, AssetCache] = {}
+_audio_caches_lock = threading.Lock()
+# 缓存键 -> [锁, 引用数]：同一段语音同时未命中时只合成一次，其余调用等待后直接命中缓存
+_key_locks: Dict[str, list] = {}
+_key_locks_lock = threading.Lock()
+
+def get_audio_cache(output_dir: Path) -> AssetCache:
+    """
+    获取语音目录对应的内容寻址缓存（AUDIO_CACHE_DIR / AUDIO_CACHE_MAX_MB 控制缓存目录和容量上限）
+    缓存文件与对外提供的语音目录分开存放，命中或生成后再发布到 output_dir，淘汰不会删除已发布书籍引用的语音
+    """
+    cache_key = str(Path(output_dir).resolve())
+    with _audio_caches_lock:
+        if cache_key not in _audio_caches:
+            max_mb = int(os.getenv("AUDIO_CACHE_MAX_MB", "1024"))
+            _audio_caches[cache_key] = AssetCache(
+                Path(os.getenv("AUDIO_CACHE_DIR", "cache/audios")),
+                namespace="audio",
+                max_bytes=max_mb * 1024 * 1024 if max_mb > 0 else None,
+                publish_dir=output_dir
+            )
+        return _audio_caches[cache_key]
 
-    engine = None
-    rate = None
-    def __init__(self):
-        self.engine = pyttsx3.init(driverName='nsss')
-        self.engine.setProperty('rate', 150)  # 语速（默认200）
-        self.engine.setProperty('volume', 1.0)  # 音量（0.0-1.0）
+@contextmanager
+def _key_lock(key: str):
+    """按缓存键加锁（不再使用的锁随即移除）"""
+    with _key_locks_lock:
+        holder = _key_locks.setdefault(key, [threading.Lock(), 0])
+        holder[1] += 1
+    try:
+        with holder[0]:
+            yield
+    finally:
+        with _key_locks_lock:
+            holder[1] -= 1
+            if holder[1] == 0:
+                _key_locks.pop(key, None)
 
+def normalize_tts_text(text: str) -> str:
+    """规范化朗读文本（合并空白），空白差异不影响缓存命中"""
+    return re.sub(r"\s+", " ", text).strip()
 
-    def start(self, text_, audio_path):
-        # self.engine.save_to_file(text_, str(audio_path))
-        # self.engine.say(text_)
-        self.engine.save_to_file(text_, str(audio_path))
-        self.engine.runAndWait()
+def audio_cache_key(text: str, codec: str, voice_settings: Optional[Dict[str, Any]] = None) -> str:
+    """根据规范化文本、音色、语速、音量和编码计算语音缓存键"""
+    return AssetCache.make_key(text=normalize_tts_text(text), codec=codec, **(voice_settings or tts_voice_settings()))
 
-def generate_audio(text: str, scene_id: str, output_dir: Path) -> str:
+def generate_audio(text: str, scene_id: str, output_dir: Path, codec: Optional[str] = None) -> str:
     """
-    使用pyttsx3生成语音文件
+    使用常驻TTS工作进程（pyttsx3）生成语音文件（相同文本和音色命中缓存时直接返回）
     :param text: 要转换的文本
-    :param scene_id: 场景ID（用于生成唯一文件名）
+    :param scene_id: 场景ID（仅用于日志，文件名由缓存键决定）
     :param output_dir: 输出目录
+    :param codec: 目标编码（mp3 / opus / wav），默认取 AUDIO_CODEC
     :return: 生成的音频文件路径（相对于项目根目录）
     """
-    if not text.strip():
+    text = normalize_tts_text(text)
+    if not text:
         return ""
     
     # 确保输出目录存在
     output_dir.mkdir(parents=True, exist_ok=True)
+    codec = codec or default_codec()
     
-    # 初始化引擎
-    tts = _TTS()
+    # 查询内容寻址缓存
+    cache = get_audio_cache(output_dir)
+    key = audio_cache_key(text, codec)
+    cached = cache.get(key)
+    if cached is not None:
+        return _cached_audio(cache, cached, scene_id)
     
-    # 生成文件名
-    audio_path = output_dir / f"audio_{scene_id}.wav"
-    timestamp = time.strftime("%Y%m%d_%H%M%S")
-    final_mp3_path = output_dir / f"audio_{scene_id}_{timestamp}.mp3"
+    with _key_lock(key):
+        # 等锁期间其他调用可能已经生成了同一段语音
+        cached = cache.get(key)
+        if cached is not None:
+            return _cached_audio(cache, cached, scene_id)
+        return _synthesize_audio(cache, key, text, scene_id, codec)
+
+def _cached_audio(cache: AssetCache, cached: Dict[str, Any], scene_id: str) -> Dict[str, Any]:
+    """把命中的缓存语音发布到语音目录"""
+    print(f"语音缓存命中: {scene_id} -> {cached['file']}")
+    return {
+        "url": f"/assets/audios/{cache.publish(cached).name}",
+        "duration": cached["meta"].get("duration", 0)
+    }
+
+def _synthesize_audio(cache: AssetCache, key: str, text: str, scene_id: str, codec: str):
+    """缓存未命中：TTS合成、转码、写入缓存并发布"""
+    final_path = cache.path_for(key, "audio", codec_suffix(codec))
+    # TTS输出的临时wav只在转码前存在（放在缓存目录，wav编码时可直接重命名）
+    audio_path = cache.cache_dir / f".audio_{scene_id}_{uuid.uuid4().hex[:8]}.wav"
     
     try:
         # 保存语音到文件
-        print(f"正在生成音频: {audio_path}")
-        tts.start(text, audio_path)
-        del(tts)
-
-        # 2. 使用ffmpeg转换为mp3（需要系统安装ffmpeg）
-        (
-            ffmpeg.input(str(audio_path))
-            .output(str(final_mp3_path), acodec='libmp3lame')
-            .overwrite_output()
-            .run()
-        )
-        if final_mp3_path.exists():
-            # 新增：计算音频时长
-            audio = AudioSegment.from_mp3(final_mp3_path)
-            duration = round(audio.duration_seconds, 2)  # 保留2位小数
-            
-            # 清理临时wav文件
-            if audio_path.exists():
-                audio_path.unlink(missing_ok=True)
-                
-            print(f"音频生成成功: {final_mp3_path}（时长：{duration}秒）")
-            return {
-                "url": f"/assets/audios/{final_mp3_path.name}",
-                "duration": duration
-            }
-        else:
-            print(f"MP3文件未生成: {final_mp3_path}")
-            return {}
+        print(f"正在生成音频: {final_path}")
+        synth = get_tts_pool().submit({"text": text, "path": str(audio_path)}).result()
+        
+        # 时长直接从文件头读取，不需要再解码一遍编码后的音频
+        duration = round(audio_duration(audio_path), 2)  # 保留2位小数
+        # 一次ffmpeg调用完成编码（wav编码时直接重命名）
+        encode_audio(audio_path, final_path, codec)
+        tts_stats.record(synth["seconds"], duration)
+        entry = cache.put(key, final_path, {"duration": duration, "codec": codec, "text": text[:100]})
+        
+        print(f"音频生成成功: {final_path}（时长：{duration}秒）")
+        return {
+            "url": f"/assets/audios/{cache.publish(entry).name}",
+            "duration": duration
+        }
     except Exception as e:
         print(f"语音生成失败: {str(e)}")
         return ""
+    finally:
+        # 清理临时wav文件
+        audio_path.unlink(missing_ok=True)
 
-def batch_convert_wav_to_mp3(input_dir: Path, delete_original: bool = False) -> int:
+class TTSAudioBackend:
+    """pyttsx3语音后端（默认）"""
+    
+    def generate_audio(self, text: str, scene_id: str, output_dir: Path):
+        return generate_audio(text, scene_id, output_dir)
+    
+    def synthesize(self, text: str, wav_path: Path) -> Future:
+        """把单段文本提交给TTS工作进程合成为WAV（流式旁白用），Future结果包含合成耗时"""
+        return get_tts_pool().submit({"text": text, "path": str(wav_path)})
+    
+    def stats(self) -> Dict[str, Any]:
+        """语音合成吞吐统计和TTS工作进程状态"""
+        return {
+            "synthesis": tts_stats.report(),
+            "workers": get_tts_pool().stats(),
+            "cache": [cache.stats() for cache in list(_audio_caches.values())]
+        }
+    
+    def shutdown(self):
+        shutdown_tts_pool()
+
+def _convert_wav_to_mp3(wav_path: str, mp3_path: str, delete_original: bool) -> Dict[str, Any]:
+    """进程池任务：转换单个wav（先写临时文件再原子替换），返回耗时和音频时长"""
+    start = time.time()
+    wav_path, mp3_path = Path(wav_path), Path(mp3_path)
+    try:
+        duration = audio_duration(wav_path)
+        size = wav_path.stat().st_size
+        encode_audio(wav_path, mp3_path, "mp3")
+        if not mp3_path.exists() or mp3_path.stat().st_size == 0:
+            raise Exception("MP3文件未生成或为空")
+        if delete_original:
+            wav_path.unlink()
+        return {"ok": True, "seconds": time.time() - start, "duration": duration, "bytes": size}
+    except Exception as e:
+        return {"ok": False, "seconds": time.time() - start, "error": str(e)}
+
+def batch_convert_wav_to_mp3(input_dir: Path, delete_original: bool = False, workers: Optional[int] = None,
+                             force: bool = False) -> int:
     """
-    批量转换指定目录下的wav文件为mp3（增强错误日志版）
+    批量转换指定目录下的wav文件为mp3（多进程并行、增量）
+    :param workers: 进程数，默认使用CPU核数
+    :param force: 为True时忽略已存在的mp3，全部重新转换
+    :return: 转换成功及已是最新的文件数
     """
     if not input_dir.exists() or not input_dir.is_dir():
         print(f"错误：目录不存在 {input_dir}")
         return 0
 
-    wav_files = list(input_dir.glob("*.wav"))
-    success_count = 0
-
+    # 跳过以"."开头的临时文件
+    wav_files = sorted(p for p in input_dir.glob("*.wav") if not p.name.startswith("."))
+    jobs = []
+    skipped = 0
     for wav_path in wav_files:
-        # 新增：验证输入文件是否存在（避免文件被删除后仍处理）
-        if not wav_path.exists():
-            print(f"跳过：文件不存在 {wav_path.name}")
-            continue
-
         mp3_path = wav_path.with_suffix(".mp3")
-        
-        try:
-            # 关键修改：移除quiet=True，显示ffmpeg原始输出
-            # 并捕获stdout/stderr用于错误诊断
-            process = (
-                ffmpeg.input(str(wav_path))
-                .output(str(mp3_path), acodec='libmp3lame')  # Changed parameter
-                .overwrite_output()
-                .run_async(pipe_stdout=True, pipe_stderr=True)
-            )
-            
-            # 获取ffmpeg输出
-            stdout, stderr = process.communicate()
-            if process.returncode != 0:
-                raise Exception(f"FFmpeg错误输出：{stderr.decode('utf-8')}")
-
-            # 验证文件生成
-            if mp3_path.exists() and mp3_path.stat().st_size > 0:
-                success_count += 1
-                print(f"转换成功: {wav_path.name} -> {mp3_path.name}")
-                
-                if delete_original:
-                    wav_path.unlink()
-                    print(f"已删除原始文件: {wav_path.name}")
-            else:
-                raise Exception("MP3文件未生成或为空")
-
-        except Exception as e:
-            # 关键修改：打印完整错误信息（包含ffmpeg的具体报错）
-            print(f"转换失败 {wav_path.name}: {str(e)}")
+        # 增量：mp3已存在且不早于wav时视为最新
+        if not force and mp3_path.exists() and mp3_path.stat().st_size > 0 \
+                and mp3_path.stat().st_mtime >= wav_path.stat().st_mtime:
+            skipped += 1
+            if delete_original:
+                wav_path.unlink(missing_ok=True)
             continue
+        jobs.append((wav_path, mp3_path))
 
-    print(f"批量转换完成，成功 {success_count}/{len(wav_files)} 个文件")
-    return success_count
+    start = time.time()
+    success_count = 0
+    audio_seconds = 0.0
+    input_bytes = 0
+    if jobs:
+        workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as executor:
+            futures = {
+                executor.submit(_convert_wav_to_mp3, str(wav_path), str(mp3_path), delete_original): wav_path
+                for wav_path, mp3_path in jobs
+            }
+            for future in as_completed(futures):
+                wav_path = futures[future]
+                result = future.result()
+                if result["ok"]:
+                    success_count += 1
+                    audio_seconds += result["duration"]
+                    input_bytes += result["bytes"]
+                    print(f"转换成功: {wav_path.name} -> {wav_path.with_suffix('.mp3').name}（{result['seconds']:.2f}秒）")
+                else:
+                    print(f"转换失败 {wav_path.name}: {result['error']}")
+
+    elapsed = time.time() - start
+    print(
+        f"批量转换完成：转换 {success_count}/{len(jobs)} 个，跳过 {skipped} 个已是最新，"
+        f"失败 {len(jobs) - success_count} 个；耗时 {elapsed:.1f}秒"
+    )
+    if success_count and elapsed > 0:
+        print(
+            f"吞吐：{success_count / elapsed:.2f} 文件/秒，{input_bytes / 1024 / 1024 / elapsed:.2f} MB/秒，"
+            f"{audio_seconds / elapsed:.1f} 秒音频/秒"
+        )
+    return success_count + skipped
 
 # 测试方法
 if __name__ == "__main__":
@@ -145,4 +241,4 @@ if __name__ == "__main__":
     # public_audios_dir = Path("../public/assets/audios")  # 根据实际项目结构调整路径
     
     # 执行批量转换（不删除原始文件）
-    # batch_convert_wav_to_mp3(public_audios_dir, delete_original=False)
\ No newline at end of file
+    # batch_convert_wav_to_mp3(public_audios_dir, delete_original=False)
@@ -1,59 +1,225 @@
-from diffusers import StableDiffusionPipeline
-import torch
-from PIL import Image
+import os
+import threading
 import time
+import uuid
+from dataclasses import dataclass, asdict, field
 from pathlib import Path
+from typing import Callable, Dict, List, Tuple, Any
+from tools.backends import get_backend
+from tools.pipeline_pool import PipelinePool, get_pipeline_pool, DEFAULT_MODEL_ID
+from tools.inference_profiles import detect_profile, get_profile, profile_latency
+from utils.asset_cache import AssetCache
 
-def generate_image(prompt: str, scene_id: str, output_dir: Path) -> str:
+def _default_profile() -> str:
+    """当前图片后端的默认推理配置名"""
+    return get_backend("image").default_profile()
+
+@dataclass
+class ImageSettings:
+    """图片采样参数"""
+    seed: int = 42
+    steps: int = 0  # 0 表示使用推理配置的默认步数
+    guidance: float = 5.0
+    width: int = 512
+    height: int = 512
+    profile: str = field(default_factory=_default_profile)  # 推理配置名（参与缓存键）
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+def draft_settings() -> ImageSettings:
+    """草稿模式采样参数：少步数、低分辨率，用于尽快发布可播放章节
+    （IMAGE_DRAFT_STEPS / IMAGE_DRAFT_SIZE 可配置，尺寸需为8的倍数）"""
+    size = int(os.getenv("IMAGE_DRAFT_SIZE", "384")) // 8 * 8
+    return ImageSettings(steps=int(os.getenv("IMAGE_DRAFT_STEPS", "10")), width=size, height=size)
+
+_image_caches: Dict[str, AssetCache] = {}
+_image_caches_lock = threading.Lock()
+
+def get_image_cache(output_dir: Path) -> AssetCache:
+    """
+    获取图片目录对应的内容寻址缓存（IMAGE_CACHE_DIR / IMAGE_CACHE_MAX_MB 控制缓存目录和容量上限）
+    缓存文件与对外提供的图片目录分开存放，命中或生成后再发布到 output_dir，淘汰不会删除已发布书籍引用的图片
     """
-    使用Stable Diffusion生成场景图片并保存到指定目录
+    cache_key = str(Path(output_dir).resolve())
+    with _image_caches_lock:
+        if cache_key not in _image_caches:
+            max_mb = int(os.getenv("IMAGE_CACHE_MAX_MB", "2048"))
+            _image_caches[cache_key] = AssetCache(
+                Path(os.getenv("IMAGE_CACHE_DIR", "cache/images")),
+                namespace="image",
+                max_bytes=max_mb * 1024 * 1024 if max_mb > 0 else None,
+                publish_dir=output_dir
+            )
+        return _image_caches[cache_key]
+
+def image_cache_key(prompt: str, settings: ImageSettings, model_id: str = DEFAULT_MODEL_ID) -> str:
+    """根据提示词、模型和采样参数计算图片缓存键"""
+    return AssetCache.make_key(prompt=prompt.strip(), model=model_id, **settings.to_dict())
+
+def generate_image(prompt: str, scene_id: str, output_dir: Path, pipeline_pool: PipelinePool = None,
+                   settings: ImageSettings = None) -> str:
+    """
+    使用Stable Diffusion生成场景图片并保存到指定目录（相同参数命中缓存时直接返回）
     :param prompt: 图片生成提示词
-    :param scene_id: 场景ID（用于生成唯一文件名）
+    :param scene_id: 场景ID（仅用于日志，文件名由缓存键决定）
     :param output_dir: 图片输出目录
+    :param pipeline_pool: 管线池（默认使用进程内共享的常驻管线池）
+    :param settings: 采样参数
     :return: 生成的图片URL路径（相对于项目根目录）
     """
-    # 加载本地模型（修改为model目录下的模型路径）
-    # local_model_path = "./tools/models/models--stabilityai--stable-diffusion-2-1-base"
-    pipe = StableDiffusionPipeline.from_pretrained(
-        "stabilityai/stable-diffusion-2-1-base",
-        cache_dir="./tools/models", # 指定缓存目录,默认下载到 ~/.cache/huggingface/hub ，可以copy过来
-        # local_model_path,
-        torch_dtype=torch.float16,
-        use_safetensors=True,
-        local_files_only=True  # 禁止网络请求
+    results = generate_images_batch(
+        [(scene_id, prompt)], output_dir, batch_size=1, pipeline_pool=pipeline_pool, settings=settings
     )
+    return results.get(scene_id, "")
+
+def generate_images_batch(
+    items: List[Tuple[str, str]],
+    output_dir: Path,
+    batch_size: int = 4,
+    pipeline_pool: PipelinePool = None,
+    on_batch_done: Callable[[int, int], None] = None,
+    settings: ImageSettings = None
+) -> Dict[str, str]:
+    """
+    按微批次生成多张场景图片（一次UNet前向处理多个提示词，摊薄每步开销）
+    已缓存的图片直接复用，相同提示词只生成一次
+    :param items: (scene_id, prompt) 列表
+    :param output_dir: 图片输出目录
+    :param batch_size: 每个微批次的图片数量
+    :param pipeline_pool: 管线池（默认使用进程内共享的常驻管线池）
+    :param on_batch_done: 每个微批次完成后的回调 (已完成数量, 总数量)
+    :param settings: 采样参数
+    :return: scene_id -> 图片URL路径（失败的场景为空字符串）
+    """
+    settings = settings or ImageSettings()
+    cache = get_image_cache(output_dir)
+    results, jobs = plan_image_jobs(items, cache, settings)
     
-    # 强制使用MPS设备
-    device = "mps" if torch.backends.mps.is_available() else "cpu"
-    pipe = pipe.to(device)
+    done = len(items) - sum(len(job["scene_ids"]) for job in jobs)
+    if done and on_batch_done:
+        on_batch_done(done, len(items))
     
-    # 设置MPS专用参数
-    generator = torch.Generator(device).manual_seed(42)
+    for batch in split_batches(jobs, batch_size):
+        batch_scene_ids = [scene_id for job in batch for scene_id in job["scene_ids"]]
+        try:
+            render_images(
+                [job["prompt"] for job in batch],
+                [job["path"] for job in batch],
+                settings,
+                pipeline_pool
+            )
+            for job in batch:
+                image_url = commit_image_job(cache, job, settings)
+                for scene_id in job["scene_ids"]:
+                    results[scene_id] = image_url
+        except Exception as e:
+            print(f"生成失败 {batch_scene_ids}: {str(e)}")
+            for scene_id in batch_scene_ids:
+                results.setdefault(scene_id, "")
+        
+        done += len(batch_scene_ids)
+        if on_batch_done:
+            on_batch_done(done, len(items))
     
-    try:
-        # 生成图片（保持原有参数）
-        image = pipe(
-            prompt,
-            num_inference_steps=30,
-            guidance_scale=5.0,
-            height=512,
-            width=512,
-            generator=generator
-        ).images[0]
+    return results
+
+def plan_image_jobs(items: List[Tuple[str, str]], cache: AssetCache, settings: ImageSettings) -> Tuple[Dict[str, str], List[Dict[str, Any]]]:
+    """
+    查询缓存并按缓存键去重
+    :return: (已命中缓存的 scene_id -> URL, 待生成任务列表)
+    """
+    results: Dict[str, str] = {}
+    pending: Dict[str, Dict[str, Any]] = {}
+    for scene_id, prompt in items:
+        key = image_cache_key(prompt, settings)
+        if key in pending:
+            pending[key]["scene_ids"].append(scene_id)
+            continue
+        entry = cache.get(key)
+        if entry:
+            print(f"图片缓存命中: {scene_id} -> {entry['file']}")
+            results[scene_id] = f"/assets/images/{cache.publish(entry).name}"
+        else:
+            pending[key] = {
+                "key": key,
+                "prompt": prompt,
+                "path": str(cache.path_for(key, "image", ".png")),
+                "scene_ids": [scene_id]
+            }
+    return results, list(pending.values())
+
+def split_batches(jobs: List[Dict[str, Any]], batch_size: int) -> List[List[Dict[str, Any]]]:
+    """按微批次大小切分任务"""
+    batch_size = max(1, batch_size)
+    return [jobs[start:start + batch_size] for start in range(0, len(jobs), batch_size)]
+
+def render_images(prompts: List[str], image_paths: List[str], settings: ImageSettings, pipeline_pool: PipelinePool = None) -> Dict[str, Any]:
+    """
+    用当前图片后端渲染一个微批次的图片并原子写入指定路径（可在工作进程中调用）
+    :return: {"seconds": 推理耗时, "steps": 实际采样步数}，同时计入推理配置的耗时统计
+    """
+    timing = get_backend("image").render_images(prompts, image_paths, settings, pipeline_pool)
+    profile_latency.record(settings.profile, timing["seconds"], len(prompts), timing["steps"])
+    return timing
+
+class StableDiffusionBackend:
+    """Stable Diffusion图片后端（默认）"""
+    
+    def default_profile(self) -> str:
+        return detect_profile()
+    
+    def configure_threads(self, torch_threads: int):
+        """限制当前进程的torch线程数（工作进程启动时调用）"""
+        if torch_threads > 0:
+            import torch
+            torch.set_num_threads(torch_threads)
+            torch.set_num_interop_threads(1)
+    
+    def warmup(self, pipeline_pool: PipelinePool = None):
+        (pipeline_pool or get_pipeline_pool()).warmup()
+    
+    def render_images(self, prompts: List[str], image_paths: List[str], settings: ImageSettings, pipeline_pool: PipelinePool = None) -> Dict[str, Any]:
+        import torch
         
-        # 保存到指定目录
-        output_dir.mkdir(parents=True, exist_ok=True)  # 确保目录存在
-        timestamp = time.strftime("%Y%m%d_%H%M%S")
-        image_name = f"image_{scene_id}_{timestamp}.png"
-        image_path = output_dir / image_name
-        image.save(image_path)
+        pool = pipeline_pool or get_pipeline_pool()
+        profile = get_profile(settings.profile)
+        steps = settings.steps or profile.steps
         
-        # 返回相对URL路径
-        return f"/assets/images/{image_name}"
+        # 从常驻管线池借用管线（首次使用时加载权重）
+        with pool.acquire(DEFAULT_MODEL_ID, profile) as pipe:
+            # 每张图片使用独立的同种子生成器，保证与单张生成结果一致
+            generators = [torch.Generator(pipe.device.type).manual_seed(settings.seed) for _ in prompts]
+            
+            start = time.time()
+            images = pipe(
+                prompts,
+                num_inference_steps=steps,
+                guidance_scale=settings.guidance,
+                height=settings.height,
+                width=settings.width,
+                generator=generators
+            ).images
+            seconds = time.time() - start
+        
+        for image, image_path in zip(images, image_paths):
+            _save_image(image, Path(image_path))
+        return {"seconds": seconds, "steps": steps}
+
+def commit_image_job(cache: AssetCache, job: Dict[str, Any], settings: ImageSettings) -> str:
+    """把已渲染的图片登记到缓存并返回相对URL路径"""
+    image_path = Path(job["path"])
+    entry = cache.put(job["key"], image_path, {"prompt": job["prompt"], **settings.to_dict()})
     
-    except Exception as e:
-        print(f"生成失败: {str(e)}")
-        return ""
+    # 发布到图片目录并返回相对URL路径
+    return f"/assets/images/{cache.publish(entry).name}"
+
+def _save_image(image, image_path: Path):
+    """原子保存图片（先写临时文件再替换）"""
+    image_path.parent.mkdir(parents=True, exist_ok=True)  # 确保目录存在
+    tmp_path = image_path.with_name(f".{image_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    image.save(tmp_path, format="PNG")
+    os.replace(tmp_path, image_path)
 
 if __name__ == "__main__":
     # 测试配置
@@ -0,0 +1,111 @@
+import multiprocessing as mp
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+# 派生尺寸（按宽度等比缩放），full 保持原尺寸
+VARIANT_WIDTHS = {
+    "thumb": 160,
+    "medium": 320,
+    "full": None
+}
+ENCODE_OPTIONS = {
+    "webp": {"format": "WEBP", "quality": 80, "method": 4},
+    "avif": {"format": "AVIF", "quality": 60}
+}
+
+
+def _avif_supported() -> bool:
+    """当前Pillow是否支持AVIF编码（Pillow 11.2+ 内置，或安装了 pillow-avif-plugin）"""
+    from PIL import features
+    try:
+        if features.check_module("avif"):
+            return True
+    except ValueError:
+        pass
+    try:
+        import pillow_avif  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def build_image_variants(image_path: str, url_prefix: str = "/assets/images") -> Dict[str, Any]:
+    """
+    为一张场景图片生成多尺寸WebP/AVIF派生图（已存在的派生图直接复用）
+    :param image_path: 原始PNG路径
+    :param url_prefix: 派生图URL前缀
+    :return: {"webp": {"thumb": url, ...}, "avif": {...}, "srcset": {"webp": "url 160w, ..."}, "width": .., "height": ..}
+    """
+    from PIL import Image
+    
+    image_path = Path(image_path)
+    encodings = ["webp"] + (["avif"] if _avif_supported() else [])
+    variants: Dict[str, Any] = {encoding: {} for encoding in encodings}
+    srcset: Dict[str, list] = {encoding: [] for encoding in encodings}
+
+    with Image.open(image_path) as source:
+        source = source.convert("RGB")
+        width, height = source.size
+        for size_name, target_width in VARIANT_WIDTHS.items():
+            target_width = min(target_width or width, width)
+            target_height = max(1, round(height * target_width / width))
+            resized = None
+            for encoding in encodings:
+                variant_name = f"{image_path.stem}_{size_name}.{encoding}"
+                variant_path = image_path.with_name(variant_name)
+                if not variant_path.exists():
+                    if resized is None:
+                        resized = source if target_width == width else source.resize((target_width, target_height), Image.LANCZOS)
+                    tmp_path = variant_path.with_name(f".{variant_name}.{uuid.uuid4().hex[:8]}.tmp")
+                    resized.save(tmp_path, **ENCODE_OPTIONS[encoding])
+                    os.replace(tmp_path, variant_path)
+                url = f"{url_prefix}/{variant_name}"
+                variants[encoding][size_name] = url
+                srcset[encoding].append(f"{url} {target_width}w")
+
+    return {
+        **variants,
+        "srcset": {encoding: ", ".join(entries) for encoding, entries in srcset.items()},
+        "width": width,
+        "height": height
+    }
+
+
+_variant_executor: Optional[ProcessPoolExecutor] = None
+_variant_executor_lock = threading.Lock()
+
+
+def get_variant_executor(reset: bool = False) -> ProcessPoolExecutor:
+    """派生图编码进程池（IMAGE_VARIANT_WORKERS 控制进程数）"""
+    global _variant_executor
+    with _variant_executor_lock:
+        if reset and _variant_executor is not None:
+            _variant_executor.shutdown(wait=False, cancel_futures=True)
+            _variant_executor = None
+        if _variant_executor is None:
+            _variant_executor = ProcessPoolExecutor(
+                max_workers=max(1, int(os.getenv("IMAGE_VARIANT_WORKERS", "2"))),
+                mp_context=mp.get_context("spawn")
+            )
+        return _variant_executor
+
+
+def submit_image_variants(image_path: str):
+    """提交派生图任务到进程池，进程池损坏时重建一次"""
+    try:
+        return get_variant_executor().submit(build_image_variants, str(image_path))
+    except BrokenProcessPool:
+        return get_variant_executor(reset=True).submit(build_image_variants, str(image_path))
+
+
+def shutdown_variant_executor():
+    global _variant_executor
+    with _variant_executor_lock:
+        if _variant_executor is not None:
+            _variant_executor.shutdown(wait=False, cancel_futures=True)
+            _variant_executor = None
@@ -0,0 +1,58 @@
+import os
+import threading
+from typing import Dict, Any, Optional
+from utils.worker_pool import ProcessWorkerPool
+
+def init_image_worker(torch_threads: int = 0, warmup: bool = True) -> Dict[str, Any]:
+    """
+    图片工作进程初始化：限制torch线程数并常驻一个管线
+    :param torch_threads: 每个工作进程的torch计算线程数（0表示使用torch默认值）
+    :param warmup: 是否在进程启动时预先加载管线
+    """
+    from tools.backends import get_backend
+    from tools.pipeline_pool import get_pipeline_pool
+    
+    backend = get_backend("image")
+    backend.configure_threads(torch_threads)
+    
+    pool = get_pipeline_pool()
+    if warmup:
+        backend.warmup(pool)
+    return {"pipeline_pool": pool}
+
+def handle_image_job(state: Dict[str, Any], payload: Dict[str, Any]) -> Dict[str, Any]:
+    """在工作进程中渲染一个微批次，返回写入的图片路径和推理耗时"""
+    from tools.generate_image import render_images, ImageSettings
+    
+    timing = render_images(
+        payload["prompts"],
+        payload["paths"],
+        ImageSettings(**payload["settings"]),
+        state["pipeline_pool"]
+    )
+    return {"paths": payload["paths"], **timing}
+
+_image_worker_pool: Optional[ProcessWorkerPool] = None
+_image_worker_pool_lock = threading.Lock()
+
+def get_image_worker_pool() -> Optional[ProcessWorkerPool]:
+    """
+    获取图片工作进程池（IMAGE_WORKERS=0 时返回None，在API进程内线程中生成）
+    环境变量：IMAGE_WORKERS / IMAGE_WORKER_TORCH_THREADS / IMAGE_JOB_TIMEOUT
+    """
+    global _image_worker_pool
+    num_workers = int(os.getenv("IMAGE_WORKERS", "0"))
+    if num_workers <= 0:
+        return None
+    with _image_worker_pool_lock:
+        if _image_worker_pool is None:
+            job_timeout = float(os.getenv("IMAGE_JOB_TIMEOUT", "900"))
+            _image_worker_pool = ProcessWorkerPool(
+                name="image-worker",
+                handler="tools.image_workers:handle_image_job",
+                initializer="tools.image_workers:init_image_worker",
+                init_kwargs={"torch_threads": int(os.getenv("IMAGE_WORKER_TORCH_THREADS", "0"))},
+                num_workers=num_workers,
+                job_timeout=job_timeout if job_timeout > 0 else None
+            )
+        return _image_worker_pool
@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+from dataclasses import dataclass, asdict, replace
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+
+@dataclass(frozen=True)
+class InferenceProfile:
+    """Stable Diffusion推理配置"""
+    name: str
+    device: str
+    dtype: str
+    steps: int = 30                 # 默认采样步数（更快的调度器可以用更少步数）
+    scheduler: Optional[str] = None  # None 保持模型自带调度器；"dpm++" 使用 DPMSolverMultistepScheduler
+    attention_slicing: bool = False
+    channels_last: bool = False
+    intra_op_threads: int = 0       # 0 表示使用torch默认值
+    inter_op_threads: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+PROFILES: Dict[str, InferenceProfile] = {
+    # 原有行为：fp16 + 30步（MPS可用时使用MPS）
+    "legacy": InferenceProfile("legacy", device="auto", dtype="float16"),
+    "cuda-fp16": InferenceProfile("cuda-fp16", device="cuda", dtype="float16", steps=20, scheduler="dpm++"),
+    "mps-fp16": InferenceProfile("mps-fp16", device="mps", dtype="float16", steps=20, scheduler="dpm++",
+                                 attention_slicing=True),
+    # CPU上fp16大多不受支持或很慢，使用fp32/bf16
+    "cpu-fp32": InferenceProfile("cpu-fp32", device="cpu", dtype="float32", steps=20, scheduler="dpm++",
+                                 channels_last=True),
+    "cpu-bf16": InferenceProfile("cpu-bf16", device="cpu", dtype="bfloat16", steps=20, scheduler="dpm++",
+                                 channels_last=True),
+    # 内存紧张的CPU机器：注意力切片降低峰值内存，速度略慢
+    "cpu-lowmem": InferenceProfile("cpu-lowmem", device="cpu", dtype="float32", steps=20, scheduler="dpm++",
+                                   attention_slicing=True),
+}
+
+
+def _cpu_supports_bf16() -> bool:
+    """检测CPU是否有原生bf16指令（AVX512-BF16 / AMX）"""
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            flags = f.read()
+        return "avx512_bf16" in flags or "amx_bf16" in flags
+    except OSError:
+        return False
+
+
+@lru_cache(maxsize=1)
+def detect_profile() -> str:
+    """根据硬件自动选择推理配置（SD_PROFILE 环境变量可强制指定）"""
+    forced = os.getenv("SD_PROFILE", "")
+    if forced:
+        if forced not in PROFILES:
+            raise ValueError(f"未知的推理配置: {forced}，可选: {', '.join(PROFILES)}")
+        return forced
+    import torch
+    if torch.cuda.is_available():
+        return "cuda-fp16"
+    if torch.backends.mps.is_available():
+        return "mps-fp16"
+    return "cpu-bf16" if _cpu_supports_bf16() else "cpu-fp32"
+
+
+def get_profile(name: Optional[str] = None) -> InferenceProfile:
+    """获取推理配置（线程数可由 SD_INTRA_OP_THREADS / SD_INTER_OP_THREADS 覆盖）"""
+    profile = PROFILES[name or detect_profile()]
+    intra = int(os.getenv("SD_INTRA_OP_THREADS", "0"))
+    inter = int(os.getenv("SD_INTER_OP_THREADS", "0"))
+    if intra or inter:
+        profile = replace(
+            profile,
+            intra_op_threads=intra or profile.intra_op_threads,
+            inter_op_threads=inter or profile.inter_op_threads
+        )
+    return profile
+
+
+def available_profiles() -> List[str]:
+    """当前硬件可用的推理配置"""
+    import torch
+    names = []
+    for name, profile in PROFILES.items():
+        if profile.device == "cuda" and not torch.cuda.is_available():
+            continue
+        if profile.device == "mps" and not torch.backends.mps.is_available():
+            continue
+        names.append(name)
+    return names
+
+
+def apply_thread_settings(profile: InferenceProfile):
+    """设置torch的intra-op/inter-op线程数（inter-op只能在首次并行计算前设置）"""
+    import torch
+    if profile.intra_op_threads > 0:
+        torch.set_num_threads(profile.intra_op_threads)
+    if profile.inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(profile.inter_op_threads)
+        except RuntimeError:
+            pass
+
+
+def apply_profile(pipe: Any, profile: InferenceProfile) -> Any:
+    """按推理配置调整已加载的管线"""
+    import torch
+
+    if profile.scheduler == "dpm++":
+        from diffusers import DPMSolverMultistepScheduler
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+    if profile.attention_slicing:
+        pipe.enable_attention_slicing()
+    if profile.channels_last:
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+    return pipe
+
+
+class ProfileLatencyStats:
+    """按推理配置统计生成耗时"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def record(self, profile_name: str, seconds: float, images: int, steps: int):
+        with self._lock:
+            stat = self._stats.setdefault(profile_name, {"batches": 0, "images": 0, "seconds": 0.0, "steps": 0})
+            stat["batches"] += 1
+            stat["images"] += images
+            stat["seconds"] += seconds
+            stat["steps"] += steps * images
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """各配置的平均耗时（每张图、每步）"""
+        with self._lock:
+            return {
+                name: {
+                    "batches": stat["batches"],
+                    "images": stat["images"],
+                    "seconds_per_image": round(stat["seconds"] / stat["images"], 3) if stat["images"] else 0.0,
+                    "ms_per_step": round(stat["seconds"] * 1000 / stat["steps"], 1) if stat["steps"] else 0.0,
+                    "images_per_minute": round(stat["images"] * 60 / stat["seconds"], 2) if stat["seconds"] else 0.0
+                } for name, stat in self._stats.items()
+            }
+
+
+profile_latency = ProfileLatencyStats()
+
+
+def benchmark_profiles(prompt: str, names: Optional[List[str]] = None, batch_size: int = 1) -> Dict[str, Dict[str, float]]:
+    """依次用各推理配置生成图片并报告耗时（首轮为预热，不计入）"""
+    from tools.generate_image import ImageSettings, render_images
+    from tools.pipeline_pool import PipelinePool
+    import tempfile
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in names or available_profiles():
+            pool = PipelinePool(idle_timeout=0)
+            settings = ImageSettings(profile=name)
+            paths = [os.path.join(tmp_dir, f"{name}_{i}.png") for i in range(batch_size)]
+            try:
+                render_images([prompt] * batch_size, paths, replace(settings, steps=2), pool)  # 预热
+                start = time.time()
+                render_images([prompt] * batch_size, paths, settings, pool)
+                seconds = time.time() - start
+                steps = settings.steps or PROFILES[name].steps
+                results[name] = {
+                    "seconds_per_image": round(seconds / batch_size, 3),
+                    "ms_per_step": round(seconds * 1000 / (steps * batch_size), 1)
+                }
+            except Exception as e:
+                results[name] = {"error": str(e)}
+            finally:
+                pool.shutdown()
+            print(f"{name}: {results[name]}")
+    return results
+
+
+if __name__ == "__main__":
+    # 在当前机器上对比各推理配置: python -m tools.inference_profiles
+    print(f"自动选择的推理配置: {detect_profile()}")
+    benchmark_profiles("A cyberpunk cityscape at sunset, 8k ultra realistic")
@@ -0,0 +1,263 @@
+import gc
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple, Any, Optional
+from tools.inference_profiles import InferenceProfile, get_profile, apply_profile, apply_thread_settings
+
+DEFAULT_MODEL_ID = "stabilityai/stable-diffusion-2-1-base"
+MODEL_CACHE_DIR = "./tools/models"  # 指定缓存目录,默认下载到 ~/.cache/huggingface/hub ，可以copy过来
+
+PipelineKey = Tuple[str, str, str, str]
+
+
+def resolve_device(device: Optional[str] = None) -> str:
+    """解析推理设备（未指定或为auto时优先使用MPS，其次CPU）"""
+    if device and device != "auto":
+        return device
+    import torch
+    return "mps" if torch.backends.mps.is_available() else "cpu"
+
+
+class _PipelineEntry:
+    """管线池中的单个常驻管线"""
+
+    def __init__(self, key: PipelineKey, pipe: Any, size_bytes: int):
+        self.key = key
+        self.pipe = pipe
+        self.size_bytes = size_bytes
+        self.loaded_at = time.time()
+        self.last_used = time.time()
+        self.borrowers = 0
+        # 同一个管线不能被多个线程同时推理，借用时串行
+        self.lock = threading.Lock()
+
+
+class PipelinePool:
+    """常驻Stable Diffusion管线池
+
+    - 按 (模型ID, dtype, 设备, 推理配置) 懒加载并复用管线，避免每个场景重复加载权重
+    - 支持显式预热（warmup）
+    - 空闲超过 idle_timeout 秒的管线自动卸载
+    - 常驻管线总内存超过 max_memory_bytes 时按LRU卸载空闲管线
+    """
+
+    def __init__(self, max_memory_bytes: Optional[int] = None, idle_timeout: float = 600):
+        self.max_memory_bytes = max_memory_bytes
+        self.idle_timeout = idle_timeout
+        self._entries: Dict[PipelineKey, _PipelineEntry] = {}
+        self._profiles: Dict[PipelineKey, InferenceProfile] = {}
+        self._lock = threading.RLock()
+        self._loading: Dict[PipelineKey, threading.Event] = {}
+        self._reaper = None
+        self._stop_event = threading.Event()
+        self.load_count = 0
+        self.unload_count = 0
+
+    def _make_key(self, model_id: str, profile: Optional[InferenceProfile]) -> PipelineKey:
+        profile = profile or get_profile()
+        key = (model_id, profile.dtype, resolve_device(profile.device), profile.name)
+        self._profiles[key] = profile
+        return key
+
+    def _load(self, key: PipelineKey) -> _PipelineEntry:
+        """加载管线到指定设备并应用推理配置"""
+        from diffusers import StableDiffusionPipeline
+        import torch
+
+        model_id, dtype, device, profile_name = key
+        profile = self._profiles[key]
+        print(f"加载Stable Diffusion管线: {model_id} ({profile_name}: {dtype}, {device})")
+        apply_thread_settings(profile)
+        start = time.time()
+        pipe = StableDiffusionPipeline.from_pretrained(
+            model_id,
+            cache_dir=MODEL_CACHE_DIR,
+            torch_dtype=getattr(torch, dtype),
+            use_safetensors=True,
+            local_files_only=True  # 禁止网络请求
+        )
+        pipe = apply_profile(pipe.to(device), profile)
+        size_bytes = self._estimate_size(pipe)
+        print(f"管线加载完成，耗时 {time.time() - start:.1f} 秒，约 {size_bytes / 1024 / 1024:.0f} MB")
+        return _PipelineEntry(key, pipe, size_bytes)
+
+    def _estimate_size(self, pipe: Any) -> int:
+        """估算管线权重占用的内存（字节）"""
+        total = 0
+        for component in getattr(pipe, "components", {}).values():
+            parameters = getattr(component, "parameters", None)
+            if not callable(parameters):
+                continue
+            try:
+                for param in parameters():
+                    total += param.numel() * param.element_size()
+            except Exception:
+                continue
+        return total
+
+    def _get_entry(self, key: PipelineKey) -> _PipelineEntry:
+        """获取常驻管线，不存在时加载（同一个key只加载一次）"""
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.borrowers += 1
+                    return entry
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = threading.Event()
+                    self._loading[key] = loading
+                    break
+            # 其他线程正在加载同一个管线，等待其完成后重试
+            loading.wait()
+
+        try:
+            entry = self._load(key)
+            with self._lock:
+                self._entries[key] = entry
+                self.load_count += 1
+                entry.borrowers += 1
+                self._enforce_memory_ceiling(exclude=key)
+            self._ensure_reaper()
+            return entry
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            loading.set()
+
+    @contextmanager
+    def acquire(self, model_id: str = DEFAULT_MODEL_ID, profile: Optional[InferenceProfile] = None):
+        """借用管线（with语句内独占使用；未指定推理配置时按硬件自动选择）"""
+        key = self._make_key(model_id, profile)
+        entry = self._get_entry(key)
+        try:
+            with entry.lock:
+                entry.last_used = time.time()
+                yield entry.pipe
+        finally:
+            with self._lock:
+                entry.borrowers -= 1
+                entry.last_used = time.time()
+
+    def warmup(self, model_id: str = DEFAULT_MODEL_ID, profile: Optional[InferenceProfile] = None) -> PipelineKey:
+        """预热管线（提前加载权重）"""
+        key = self._make_key(model_id, profile)
+        entry = self._get_entry(key)
+        with self._lock:
+            entry.borrowers -= 1
+            entry.last_used = time.time()
+        return key
+
+    def _enforce_memory_ceiling(self, exclude: Optional[PipelineKey] = None):
+        """超过内存上限时按最近最少使用顺序卸载空闲管线"""
+        if not self.max_memory_bytes:
+            return
+        idle_entries = sorted(
+            (e for e in self._entries.values() if e.key != exclude and e.borrowers == 0),
+            key=lambda e: e.last_used
+        )
+        for entry in idle_entries:
+            if self.resident_bytes() <= self.max_memory_bytes:
+                break
+            self._unload_entry(entry)
+        if self.resident_bytes() > self.max_memory_bytes:
+            print(f"⚠️  管线常驻内存 {self.resident_bytes() / 1024 / 1024:.0f} MB 超过上限 "
+                  f"{self.max_memory_bytes / 1024 / 1024:.0f} MB（其余管线正在使用）")
+
+    def _unload_entry(self, entry: _PipelineEntry):
+        """卸载单个管线并释放设备内存"""
+        self._entries.pop(entry.key, None)
+        device = entry.key[2]
+        entry.pipe = None
+        self.unload_count += 1
+        print(f"卸载Stable Diffusion管线: {entry.key[0]} ({entry.key[3]}: {entry.key[1]}, {device})")
+        gc.collect()
+        try:
+            import torch
+            if device.startswith("cuda") and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            elif device == "mps" and hasattr(torch, "mps"):
+                torch.mps.empty_cache()
+        except Exception:
+            pass
+
+    def unload_idle(self, idle_timeout: Optional[float] = None) -> int:
+        """卸载空闲超时的管线，返回卸载数量"""
+        timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.time()
+        count = 0
+        with self._lock:
+            for entry in list(self._entries.values()):
+                if entry.borrowers == 0 and now - entry.last_used >= timeout:
+                    self._unload_entry(entry)
+                    count += 1
+        return count
+
+    def unload_all(self):
+        """卸载所有空闲管线"""
+        self.unload_idle(idle_timeout=0)
+
+    def resident_bytes(self) -> int:
+        """当前常驻管线的估算内存"""
+        return sum(e.size_bytes for e in self._entries.values())
+
+    def _ensure_reaper(self):
+        """启动后台空闲回收线程"""
+        if not self.idle_timeout or (self._reaper and self._reaper.is_alive()):
+            return
+        self._stop_event.clear()
+        self._reaper = threading.Thread(target=self._reap_loop, name="sd-pipeline-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap_loop(self):
+        interval = max(1.0, min(60.0, self.idle_timeout / 4))
+        while not self._stop_event.wait(interval):
+            self.unload_idle()
+            with self._lock:
+                if not self._entries:
+                    return
+
+    def shutdown(self):
+        """停止回收线程并卸载所有管线"""
+        self._stop_event.set()
+        self.unload_all()
+
+    def stats(self) -> Dict[str, Any]:
+        """管线池状态"""
+        with self._lock:
+            return {
+                "resident": [
+                    {
+                        "model_id": e.key[0],
+                        "dtype": e.key[1],
+                        "device": e.key[2],
+                        "profile": e.key[3],
+                        "size_mb": round(e.size_bytes / 1024 / 1024, 1),
+                        "borrowers": e.borrowers,
+                        "idle_seconds": round(time.time() - e.last_used, 1)
+                    } for e in self._entries.values()
+                ],
+                "resident_mb": round(self.resident_bytes() / 1024 / 1024, 1),
+                "max_memory_mb": round(self.max_memory_bytes / 1024 / 1024, 1) if self.max_memory_bytes else None,
+                "load_count": self.load_count,
+                "unload_count": self.unload_count
+            }
+
+
+_pipeline_pool: Optional[PipelinePool] = None
+_pipeline_pool_lock = threading.Lock()
+
+
+def get_pipeline_pool() -> PipelinePool:
+    """获取进程内共享的管线池（环境变量 SD_POOL_MAX_MEMORY_MB / SD_POOL_IDLE_SECONDS 可配置）"""
+    global _pipeline_pool
+    with _pipeline_pool_lock:
+        if _pipeline_pool is None:
+            max_memory_mb = int(os.getenv("SD_POOL_MAX_MEMORY_MB", "0"))
+            _pipeline_pool = PipelinePool(
+                max_memory_bytes=max_memory_mb * 1024 * 1024 if max_memory_mb > 0 else None,
+                idle_timeout=float(os.getenv("SD_POOL_IDLE_SECONDS", "600"))
+            )
+        return _pipeline_pool
@@ -0,0 +1,112 @@
+import os
+import sys
+import threading
+import time
+from typing import Dict, Any, Optional
+from utils.worker_pool import ProcessWorkerPool
+
+def default_tts_driver() -> str:
+    """按平台选择pyttsx3驱动（TTS_DRIVER 可覆盖）：macOS用nsss，Windows用sapi5，Linux用espeak/espeak-ng"""
+    driver = os.getenv("TTS_DRIVER", "")
+    if driver:
+        return driver
+    if sys.platform == "darwin":
+        return "nsss"
+    if sys.platform == "win32":
+        return "sapi5"
+    return "espeak"
+
+class _TTS:
+
+    engine = None
+    rate = None
+    def __init__(self, driver: str, rate: int = 150, volume: float = 1.0, voice: str = ""):
+        import pyttsx3
+        self.engine = pyttsx3.init(driverName=driver)
+        self.engine.setProperty('rate', rate)  # 语速（默认200）
+        self.engine.setProperty('volume', volume)  # 音量（0.0-1.0）
+        if voice:
+            self.engine.setProperty('voice', voice)
+
+
+    def start(self, text_, audio_path):
+        self.engine.save_to_file(text_, str(audio_path))
+        self.engine.runAndWait()
+
+def init_tts_worker(driver: str, rate: int, volume: float, voice: str) -> Dict[str, Any]:
+    """TTS工作进程初始化：引擎只创建一次，后续场景复用"""
+    return {"tts": _TTS(driver, rate, volume, voice)}
+
+def handle_tts_job(state: Dict[str, Any], payload: Dict[str, Any]) -> Dict[str, Any]:
+    """在工作进程中合成一段文本到WAV文件"""
+    start = time.time()
+    state["tts"].start(payload["text"], payload["path"])
+    return {"path": payload["path"], "seconds": time.time() - start}
+
+def tts_voice_settings() -> Dict[str, Any]:
+    """TTS引擎参数（驱动、语速、音量、音色），同时用于初始化工作进程和计算语音缓存键"""
+    return {
+        "driver": default_tts_driver(),
+        "rate": int(os.getenv("TTS_RATE", "150")),
+        "volume": float(os.getenv("TTS_VOLUME", "1.0")),
+        "voice": os.getenv("TTS_VOICE", "")
+    }
+
+class TTSStats:
+    """TTS吞吐统计：合成耗时与合成出的音频时长"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jobs = 0
+        self.synth_seconds = 0.0
+        self.audio_seconds = 0.0
+        self.started_at = time.time()
+    
+    def record(self, synth_seconds: float, audio_seconds: float):
+        with self._lock:
+            self.jobs += 1
+            self.synth_seconds += synth_seconds
+            self.audio_seconds += audio_seconds
+    
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "jobs": self.jobs,
+                "synth_seconds": round(self.synth_seconds, 2),
+                "audio_seconds": round(self.audio_seconds, 2),
+                "avg_latency": round(self.synth_seconds / self.jobs, 3) if self.jobs else 0.0,
+                # 每合成1秒音频所需的耗时（<1表示快于实时）
+                "latency_per_audio_second": round(self.synth_seconds / self.audio_seconds, 3) if self.audio_seconds else 0.0,
+                "audio_seconds_per_minute": round(self.audio_seconds * 60 / (time.time() - self.started_at), 2)
+            }
+
+tts_stats = TTSStats()
+
+_tts_pool: Optional[ProcessWorkerPool] = None
+_tts_pool_lock = threading.Lock()
+
+def get_tts_pool() -> ProcessWorkerPool:
+    """
+    获取常驻TTS工作进程池（跨场景、跨书籍复用引擎）
+    环境变量：TTS_WORKERS / TTS_DRIVER / TTS_RATE / TTS_VOLUME / TTS_VOICE / TTS_JOB_TIMEOUT
+    """
+    global _tts_pool
+    with _tts_pool_lock:
+        if _tts_pool is None:
+            job_timeout = float(os.getenv("TTS_JOB_TIMEOUT", "120"))
+            _tts_pool = ProcessWorkerPool(
+                name="tts-worker",
+                handler="tools.tts_workers:handle_tts_job",
+                initializer="tools.tts_workers:init_tts_worker",
+                init_kwargs=tts_voice_settings(),
+                num_workers=int(os.getenv("TTS_WORKERS", "1")),
+                job_timeout=job_timeout if job_timeout > 0 else None
+            )
+        return _tts_pool
+
+def shutdown_tts_pool():
+    global _tts_pool
+    with _tts_pool_lock:
+        if _tts_pool is not None:
+            _tts_pool.shutdown()
+            _tts_pool = None
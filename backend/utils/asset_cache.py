@@ -0,0 +1,194 @@
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+
+class AssetCache:
+    """内容寻址的持久化素材缓存
+
+    - 以生成参数的哈希作为键，素材文件与索引保存在同一目录
+    - 按最近访问时间（LRU）淘汰，受总大小和条目数上限约束
+    - 可选TTL：创建时间超过 ttl 秒的条目视为过期
+    - 可选发布目录：缓存文件通过硬链接（不支持时复制）发布到对外提供服务的目录，
+      淘汰只删除缓存目录中的文件，已发布书籍引用的素材不受影响
+    - 记录命中/未命中次数；命中只更新内存中的访问时间，索引按批写回磁盘
+    """
+
+    # 命中累计达到该次数或距上次写入超过该秒数时写回索引
+    SAVE_EVERY_HITS = 32
+    SAVE_INTERVAL = 30.0
+
+    def __init__(self, cache_dir: Path, namespace: str, max_bytes: Optional[int] = None, max_entries: Optional[int] = None,
+                 ttl: Optional[float] = None, publish_dir: Optional[Path] = None):
+        self.cache_dir = Path(cache_dir)
+        self.publish_dir = Path(publish_dir) if publish_dir is not None else None
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_path = self.cache_dir / f".{namespace}_cache_index.json"
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.RLock()
+        self._entries: Dict[str, Dict[str, Any]] = self._load_index()
+        self._unsaved_hits = 0
+        self._saved_at = time.time()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def make_key(**params) -> str:
+        """根据生成参数计算缓存键"""
+        payload = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path_for(self, key: str, prefix: str, suffix: str) -> Path:
+        """缓存键对应的素材文件路径"""
+        return self.cache_dir / f"{prefix}_{key[:16]}{suffix}"
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        """读取磁盘索引（损坏时从空索引开始）"""
+        if not self.index_path.exists():
+            return {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("entries", {})
+        except Exception as e:
+            print(f"缓存索引读取失败，重新建立: {e}")
+            return {}
+
+    def _save_index(self):
+        """原子写入磁盘索引"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": self._entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+        self._unsaved_hits = 0
+        self._saved_at = time.time()
+
+    def flush(self):
+        """把命中时更新的访问时间写回磁盘索引"""
+        with self._lock:
+            if self._unsaved_hits:
+                self._save_index()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """查询缓存，命中时返回条目（包含文件名和元数据）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not (self.cache_dir / entry["file"]).exists():
+                # 文件已被外部删除，索引失效
+                self._entries.pop(key, None)
+                entry = None
+            if entry is not None and self.ttl and time.time() - entry["created"] > self.ttl:
+                # 过期条目删除文件
+                self._entries.pop(key, None)
+                (self.cache_dir / entry["file"]).unlink(missing_ok=True)
+                self.expirations += 1
+                self._save_index()
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry["last_access"] = time.time()
+            self._unsaved_hits += 1
+            if self._unsaved_hits >= self.SAVE_EVERY_HITS or time.time() - self._saved_at >= self.SAVE_INTERVAL:
+                self._save_index()
+            return entry
+
+    def publish(self, entry: Dict[str, Any]) -> Path:
+        """
+        把缓存文件发布到发布目录（同名文件已存在时直接复用），返回发布后的路径；
+        未配置发布目录时返回缓存文件本身
+        """
+        source = self.cache_dir / entry["file"]
+        if self.publish_dir is None:
+            return source
+        target = self.publish_dir / entry["file"]
+        if target.exists():
+            return target
+        self.publish_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_name(f".{target.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            # 跨文件系统或不支持硬链接时复制
+            shutil.copy2(source, tmp_path)
+        os.replace(tmp_path, target)
+        return target
+
+    def put(self, key: str, file_path: Path, meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """登记已写入缓存目录的素材文件，并按上限淘汰旧条目"""
+        file_path = Path(file_path)
+        now = time.time()
+        entry = {
+            "file": file_path.name,
+            "size": file_path.stat().st_size if file_path.exists() else 0,
+            "created": now,
+            "last_access": now,
+            "meta": meta or {}
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._evict(keep=key)
+            self._save_index()
+        return entry
+
+    def delete(self, key: str) -> bool:
+        """删除条目及缓存文件（如内容已知有误），返回条目是否存在"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False
+            (self.cache_dir / entry["file"]).unlink(missing_ok=True)
+            self._save_index()
+            return True
+
+    def _evict(self, keep: Optional[str] = None):
+        """按LRU顺序淘汰超出上限的条目并删除缓存目录中的文件（已发布的副本保留）"""
+        ordered = sorted(
+            (k for k in self._entries if k != keep),
+            key=lambda k: self._entries[k]["last_access"]
+        )
+        for key in ordered:
+            if not self._over_limit():
+                break
+            entry = self._entries.pop(key)
+            (self.cache_dir / entry["file"]).unlink(missing_ok=True)
+            self.evictions += 1
+
+    def _over_limit(self) -> bool:
+        if self.max_entries and len(self._entries) > self.max_entries:
+            return True
+        if self.max_bytes and self.total_bytes() > self.max_bytes:
+            return True
+        return False
+
+    def total_bytes(self) -> int:
+        return sum(entry.get("size", 0) for entry in self._entries.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "namespace": self.namespace,
+                "entries": len(self._entries),
+                "size_mb": round(self.total_bytes() / 1024 / 1024, 2),
+                "max_mb": round(self.max_bytes / 1024 / 1024, 2) if self.max_bytes else None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
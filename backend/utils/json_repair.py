@@ -0,0 +1,141 @@
+import json
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+_FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+
+
+def structured_output_enabled() -> bool:
+    """是否使用JSON Schema约束生成（LLM_STRUCTURED_OUTPUT=0 关闭，兼容不支持format schema的旧版Ollama）"""
+    return os.getenv("LLM_STRUCTURED_OUTPUT", "1") == "1"
+
+
+def _strip_fences(text: str) -> str:
+    """去掉 ```json 代码块标记，只保留第一个 { 或 [ 开始的内容"""
+    match = _FENCE.search(text)
+    if match:
+        text = match.group(1)
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    return text[min(starts):] if starts else text
+
+
+def _remove_trailing_commas(text: str) -> str:
+    """删除字符串之外、紧跟在 } 或 ] 之前的逗号"""
+    result = []
+    in_string = False
+    escape = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == ",":
+            rest = text[i + 1:].lstrip()
+            if rest[:1] in ("}", "]"):
+                continue
+        result.append(char)
+    return "".join(result)
+
+
+def _close_truncated(text: str) -> str:
+    """补全被截断的JSON：闭合未结束的字符串，去掉悬空的逗号/冒号，按顺序补齐括号"""
+    stack = []
+    in_string = False
+    escape = False
+    for char in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+
+    if in_string:
+        text += '"'
+    text = text.rstrip()
+    if text.endswith(":"):
+        text += " null"
+    text = text.rstrip(",")
+    return text + "".join(reversed(stack))
+
+
+def repair_json(text: str) -> str:
+    """本地修复模型输出中常见的JSON问题（代码块标记、结尾多余逗号、截断的括号和字符串）"""
+    text = _strip_fences(text.strip())
+    return _remove_trailing_commas(_close_truncated(text))
+
+
+def parse_llm_json(text: str) -> Optional[Any]:
+    """解析模型输出的JSON，直接解析失败时先做本地修复，仍失败返回None"""
+    text = (text or "").strip()
+    if not text:
+        return None
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    repaired = repair_json(text)
+    try:
+        return json.loads(repaired)
+    except json.JSONDecodeError:
+        pass
+    # JSON之后还有多余文字时，只取第一个完整的JSON值
+    try:
+        value, _ = json.JSONDecoder().raw_decode(repaired)
+        return value
+    except json.JSONDecodeError:
+        return None
+
+
+async def generate_json(client, model: str, prompt: str, schema: Optional[Dict[str, Any]] = None,
+                        retries: int = 1, on_response: Optional[Callable[[Dict[str, Any]], None]] = None,
+                        **kwargs) -> Optional[Any]:
+    """
+    结构化生成：把JSON Schema作为Ollama的 format 参数约束输出，解析前先做本地修复，
+    仍无法解析时删除缓存中的这次响应并重新生成（重试不读缓存，成功的结果写回缓存）
+    :param on_response: 每次调用后回调原始响应（可读取 prompt_eval_count 等统计字段）
+    :return: 解析后的JSON，全部失败时返回None
+    """
+    if schema is not None:
+        kwargs["format"] = schema
+    for attempt in range(retries + 1):
+        response = await client.generate(model=model, prompt=prompt, stream=False, refresh=attempt > 0, **kwargs)
+        if on_response:
+            on_response(response)
+        data = parse_llm_json(response.get("response", ""))
+        if data is not None:
+            return data
+        print(f"结构化输出解析失败（第 {attempt + 1} 次）")
+        await client.invalidate(model=model, prompt=prompt, **kwargs)
+    return None
+
+
+async def chat_json(client, model: str, messages: List[Dict[str, str]], schema: Optional[Dict[str, Any]] = None,
+                    retries: int = 1, on_response: Optional[Callable[[Dict[str, Any]], None]] = None,
+                    **kwargs) -> Optional[Any]:
+    """与 generate_json 相同，但走 /api/chat（固定的system消息可在多次调用间复用KV缓存）"""
+    if schema is not None:
+        kwargs["format"] = schema
+    for attempt in range(retries + 1):
+        response = await client.chat(model=model, messages=messages, stream=False, refresh=attempt > 0, **kwargs)
+        if on_response:
+            on_response(response)
+        data = parse_llm_json(response.get("message", {}).get("content", ""))
+        if data is not None:
+            return data
+        print(f"结构化输出解析失败（第 {attempt + 1} 次）")
+        await client.invalidate(model=model, messages=messages, **kwargs)
+    return None
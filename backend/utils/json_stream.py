@@ -0,0 +1,118 @@
+import json
+from typing import Any, Dict, List, Optional
+
+
+class IncrementalJSONParser:
+    """增量JSON解析器
+
+    逐段喂入模型的流式输出，顶层对象中指定数组（默认 "scenes"）的元素对象一闭合就立即解析返回，
+    不必等待整个JSON生成完毕；顶层的字符串/数字字段（如 chapter_title）也会记录到 fields 中。
+    第一个 "{" 之前的内容（如 ```json 代码块标记）会被忽略。
+    """
+
+    def __init__(self, array_key: str = "scenes"):
+        self.array_key = array_key
+        self.buffer = ""
+        self.fields: Dict[str, Any] = {}
+        self.items: List[Dict[str, Any]] = []
+        self._pos = 0
+        self._started = False
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string: Optional[str] = None
+        # 容器栈：("obj" | "arr", 该容器在父对象中的键)
+        self._stack: List[tuple] = []
+        self._key: Optional[str] = None
+        self._expect_value = False
+        self._value_start: Optional[int] = None
+        self._item_start: Optional[int] = None
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """喂入一段文本，返回本次新闭合的数组元素"""
+        self.buffer += text
+        emitted = []
+        buffer = self.buffer
+        while self._pos < len(buffer):
+            pos = self._pos
+            char = buffer[pos]
+            self._pos += 1
+
+            if not self._started:
+                if char == "{":
+                    self._started = True
+                    self._stack.append(("obj", None))
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = buffer[self._string_start:pos + 1]
+                    if self._expect_value and len(self._stack) == 1:
+                        self._set_field(self._last_string)
+                continue
+
+            if not self._stack:
+                continue  # 顶层对象已结束
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif char == ":":
+                if self._stack[-1][0] == "obj" and self._last_string is not None:
+                    self._key = self._decode(self._last_string)
+                    self._expect_value = True
+                    self._value_start = pos + 1
+            elif char in "{[":
+                parent_kind, parent_key = self._stack[-1]
+                key = self._key if parent_kind == "obj" else None
+                if char == "{" and self._in_target_array():
+                    self._item_start = pos
+                self._stack.append(("obj" if char == "{" else "arr", key))
+                self._key = None
+                self._expect_value = False
+            elif char in "}]":
+                if len(self._stack) == 1 and self._expect_value:
+                    self._set_field(buffer[self._value_start:pos])
+                self._stack.pop()
+                self._expect_value = False
+                if char == "}" and self._item_start is not None and self._in_target_array():
+                    item = self._decode(buffer[self._item_start:pos + 1])
+                    self._item_start = None
+                    if isinstance(item, dict):
+                        self.items.append(item)
+                        emitted.append(item)
+            elif char == ",":
+                if len(self._stack) == 1 and self._expect_value:
+                    self._set_field(buffer[self._value_start:pos])
+                self._key = None
+                self._expect_value = False
+        return emitted
+
+    def _in_target_array(self) -> bool:
+        """当前是否正位于顶层对象的目标数组中"""
+        return len(self._stack) == 2 and self._stack[1] == ("arr", self.array_key)
+
+    def _set_field(self, raw: str):
+        raw = raw.strip()
+        if raw and self._key is not None:
+            value = self._decode(raw)
+            if value is not None:
+                self.fields[self._key] = value
+        self._expect_value = False
+
+    @staticmethod
+    def _decode(raw: str) -> Any:
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+
+    @property
+    def complete(self) -> bool:
+        """顶层对象是否已闭合"""
+        return self._started and not self._stack
@@ -0,0 +1,212 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# 调用归属标签（由各Agent在发起LLM请求时设置，asyncio任务创建时自动继承）
+current_llm_agent: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_llm_agent", default=None)
+current_llm_chapter: contextvars.ContextVar[Optional[Any]] = contextvars.ContextVar("current_llm_chapter", default=None)
+current_llm_scene: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_llm_scene", default=None)
+
+# 直方图分桶上界（最后一个桶为 +inf）
+TOKENS_PER_SECOND_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200]
+QUEUE_SECONDS_BUCKETS = [0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60]
+LOAD_SECONDS_BUCKETS = [0.01, 0.1, 0.5, 1, 2, 5, 10, 30]
+
+
+@contextmanager
+def llm_tags(agent: Optional[str] = None, chapter: Optional[Any] = None, scene: Optional[str] = None):
+    """with块内发起的LLM请求带上指定标签（未传的标签沿用外层设置）"""
+    tokens = []
+    for var, value in ((current_llm_agent, agent), (current_llm_chapter, chapter), (current_llm_scene, scene)):
+        if value is not None:
+            tokens.append((var, var.set(value)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class Histogram:
+    """固定分桶直方图"""
+
+    def __init__(self, bounds: List[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.samples = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.samples += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        labels = [f"<={b}" for b in self.bounds] + [f">{self.bounds[-1]}"]
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "count": self.samples,
+            "avg": round(self.total / self.samples, 3) if self.samples else None
+        }
+
+
+class _AgentStats:
+    """单个Agent的累计用量"""
+
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.eval_tokens = 0
+        self.total_seconds = 0.0
+        self.load_seconds = 0.0
+        self.queue_seconds = 0.0
+        self.tokens_per_second = Histogram(TOKENS_PER_SECOND_BUCKETS)
+        self.queue = Histogram(QUEUE_SECONDS_BUCKETS)
+        self.load = Histogram(LOAD_SECONDS_BUCKETS)
+        self.chapters: Dict[str, Dict[str, float]] = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "prompt_tokens": self.prompt_tokens,
+            "eval_tokens": self.eval_tokens,
+            "total_seconds": round(self.total_seconds, 2),
+            "load_seconds": round(self.load_seconds, 2),
+            "queue_seconds": round(self.queue_seconds, 2),
+            "tokens_per_second": self.tokens_per_second.to_dict(),
+            "queue_time": self.queue.to_dict(),
+            "load_time": self.load.to_dict(),
+            "chapters": {
+                chapter: {k: round(v, 2) if isinstance(v, float) else v for k, v in stats.items()}
+                for chapter, stats in self.chapters.items()
+            }
+        }
+
+
+class LLMTelemetry:
+    """LLM调用遥测
+
+    从Ollama响应的计时字段（prompt_eval_count、eval_count、eval_duration、load_duration、total_duration）
+    和客户端排队时间记录每次上游调用，按Agent、章节、场景打标签；
+    按Agent汇总生成速度（tokens/秒）、排队时间、加载时间直方图，保留最近的调用明细用于导出
+    """
+
+    def __init__(self, max_calls: int = 5000):
+        self.calls = deque(maxlen=max_calls)
+        self.agents: Dict[str, _AgentStats] = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    def _tags(self) -> Dict[str, Any]:
+        return {
+            "agent": current_llm_agent.get() or "other",
+            "chapter": current_llm_chapter.get(),
+            "scene": current_llm_scene.get()
+        }
+
+    def record_call(self, path: str, model: str, response: Dict[str, Any], queue_seconds: float, wall_seconds: float):
+        """记录一次上游调用（Ollama的各项耗时单位为纳秒）"""
+        tags = self._tags()
+        eval_count = response.get("eval_count") or 0
+        eval_seconds = (response.get("eval_duration") or 0) / 1e9
+        load_seconds = (response.get("load_duration") or 0) / 1e9
+        total_seconds = (response.get("total_duration") or 0) / 1e9 or wall_seconds
+        tokens_per_second = eval_count / eval_seconds if eval_seconds > 0 else None
+        call = {
+            "time": time.time(),
+            **tags,
+            "path": path,
+            "model": model,
+            "prompt_eval_count": response.get("prompt_eval_count") or 0,
+            "prompt_eval_seconds": round((response.get("prompt_eval_duration") or 0) / 1e9, 3),
+            "eval_count": eval_count,
+            "eval_seconds": round(eval_seconds, 3),
+            "load_seconds": round(load_seconds, 3),
+            "total_seconds": round(total_seconds, 3),
+            "queue_seconds": round(queue_seconds, 3),
+            "wall_seconds": round(wall_seconds, 3),
+            "tokens_per_second": round(tokens_per_second, 2) if tokens_per_second is not None else None
+        }
+        with self._lock:
+            self.calls.append(call)
+            stats = self.agents.setdefault(tags["agent"], _AgentStats())
+            stats.calls += 1
+            stats.prompt_tokens += call["prompt_eval_count"]
+            stats.eval_tokens += eval_count
+            stats.total_seconds += total_seconds
+            stats.load_seconds += load_seconds
+            stats.queue_seconds += queue_seconds
+            if tokens_per_second is not None:
+                stats.tokens_per_second.observe(tokens_per_second)
+            stats.queue.observe(queue_seconds)
+            stats.load.observe(load_seconds)
+            if tags["chapter"] is not None:
+                chapter = stats.chapters.setdefault(str(tags["chapter"]), {"calls": 0, "tokens": 0, "total_seconds": 0.0})
+                chapter["calls"] += 1
+                chapter["tokens"] += call["prompt_eval_count"] + eval_count
+                chapter["total_seconds"] += total_seconds
+
+    def record_error(self):
+        with self._lock:
+            self.agents.setdefault(self._tags()["agent"], _AgentStats()).errors += 1
+
+    def record_cache_hit(self):
+        """命中响应缓存（不消耗推理）"""
+        with self._lock:
+            self.agents.setdefault(self._tags()["agent"], _AgentStats()).cache_hits += 1
+
+    def record_coalesced(self):
+        """与进行中的相同请求合并（不消耗推理）"""
+        with self._lock:
+            self.agents.setdefault(self._tags()["agent"], _AgentStats()).coalesced += 1
+
+    def summary(self, include_calls: bool = False) -> Dict[str, Any]:
+        with self._lock:
+            agents = {name: stats.to_dict() for name, stats in self.agents.items()}
+            total_seconds = sum(stats.total_seconds for stats in self.agents.values())
+            result = {
+                "since": self.started_at,
+                "total_seconds": round(total_seconds, 2),
+                # 各Agent占用的推理时间比例
+                "share": {
+                    name: round(stats.total_seconds / total_seconds, 3) if total_seconds else 0
+                    for name, stats in self.agents.items()
+                },
+                "agents": agents
+            }
+            if include_calls:
+                result["calls"] = list(self.calls)
+        return result
+
+    def dump(self, path: Path) -> Path:
+        """导出汇总和调用明细为JSON（原子写入）"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(include_calls=True), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+        return path
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.agents.clear()
+            self.started_at = time.time()
+
+
+llm_telemetry = LLMTelemetry(max_calls=int(os.getenv("LLM_TELEMETRY_MAX_CALLS", "5000")))
@@ -0,0 +1,246 @@
+import asyncio
+import contextvars
+import functools
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# 流程中用到LLM的阶段，各阶段的 keep_alive 可用 LLM_KEEP_ALIVE_<阶段> 覆盖（如 LLM_KEEP_ALIVE_GENERATING=10m）
+PHASES = ("scripting", "designing", "generating", "editing")
+# 未单独配置的阶段使用 LLM_KEEP_ALIVE；editing 是最后一个用到LLM的阶段，之后模型不必长时间常驻
+PHASE_KEEP_ALIVE = {"editing": "5m"}
+# 这些阶段在补齐缺失的CSS动画后不再调用LLM，内存紧张时可以暂时卸载LLM给图片管线腾内存
+LLM_IDLE_PHASES = ("generating",)
+
+current_llm_phase: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_llm_phase", default=None)
+
+_manager: Optional["ModelResidencyManager"] = None
+
+
+def preload_models() -> List[str]:
+    """需要预热和常驻的模型（LLM_PRELOAD_MODELS，逗号分隔）"""
+    return [m.strip() for m in os.getenv("LLM_PRELOAD_MODELS", "gemma3n:e4b").split(",") if m.strip()]
+
+
+def phase_keep_alive() -> Optional[str]:
+    """当前阶段的 keep_alive（未启用常驻管理时返回None，沿用Ollama默认值）"""
+    if _manager is None:
+        return None
+    return _manager.keep_alive_for(current_llm_phase.get())
+
+
+def observe_llm_response(model: str, response: Dict[str, Any]):
+    """根据响应中的 load_duration 判断本次请求是否触发了模型加载"""
+    if _manager is not None:
+        _manager.observe(model, response)
+
+
+def available_memory_mb() -> Optional[float]:
+    """系统可用内存（MB），优先用psutil，其次读取 /proc/meminfo，都不可用时返回None"""
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1024 / 1024
+    except ImportError:
+        pass
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class ModelResidencyManager:
+    """LLM模型常驻管理
+
+    - 启动时预热模型（空提示词的generate只加载模型，不生成内容）
+    - 按流程阶段设置请求的 keep_alive，避免图片阶段较长时Ollama按默认5分钟卸载模型
+    - 图片生成阶段用完LLM后（由流程调用 release_for_images），若系统可用内存低于 unload_below_mb、
+      没有任务处于用LLM的阶段且调度器中没有该模型的请求，用 keep_alive=0 卸载模型给Stable Diffusion管线腾内存，
+      离开该阶段后在后台重新预热
+    - 记录加载、卸载和被动重新加载（模型被Ollama淘汰后再次请求）事件
+    """
+
+    def __init__(self, client: Any, models: Optional[List[str]] = None, default_keep_alive: str = "30m",
+                 unload_below_mb: float = 0, load_threshold: float = 0.5, pipeline_pool: Any = None):
+        self.client = client
+        self.models = models if models is not None else preload_models()
+        self.default_keep_alive = default_keep_alive
+        self.unload_below_mb = unload_below_mb
+        # load_duration 超过该秒数视为发生了模型加载
+        self.load_threshold = load_threshold
+        self.pipeline_pool = pipeline_pool
+        self.active_phases: Dict[str, int] = {}
+        self.loaded: Dict[str, float] = {}
+        self.unloaded_for_memory = False
+        self.events = deque(maxlen=200)
+        self.counts = {"load": 0, "reload": 0, "unload": 0}
+        self._preload_task: Optional[asyncio.Task] = None
+
+    def keep_alive_for(self, phase: Optional[str]) -> str:
+        if phase is None:
+            return self.default_keep_alive
+        return os.getenv(f"LLM_KEEP_ALIVE_{phase.upper()}", PHASE_KEEP_ALIVE.get(phase, self.default_keep_alive))
+
+    def _record(self, event: str, model: str, **detail):
+        if event in self.counts:
+            self.counts[event] += 1
+        self.events.append({"time": time.time(), "event": event, "model": model, "phase": current_llm_phase.get(), **detail})
+        details = "，".join(f"{k}={v}" for k, v in detail.items())
+        print(f"模型常驻: {event} {model}" + (f"（{details}）" if details else ""))
+
+    def observe(self, model: str, response: Dict[str, Any]):
+        """请求过程中发生了模型加载：之前记录为已加载的，说明期间被Ollama淘汰过"""
+        load_seconds = (response.get("load_duration") or 0) / 1e9
+        if load_seconds < self.load_threshold:
+            return
+        event = "reload" if model in self.loaded else "load"
+        self.loaded[model] = time.time()
+        self._record(event, model, load_seconds=round(load_seconds, 2))
+
+    async def preload(self, models: Optional[List[str]] = None):
+        """在每个Ollama节点上预热模型（失败只打印警告，不影响服务启动）"""
+        for model in models or self.models:
+            start = time.time()
+            results = await self.client.generate_on_all_endpoints(
+                model=model, keep_alive=self.keep_alive_for(current_llm_phase.get())
+            )
+            loaded = {}
+            for endpoint, response in results.items():
+                if isinstance(response, Exception):
+                    print(f"⚠️  模型预热失败 {model} @ {endpoint}: {response}")
+                else:
+                    loaded[endpoint] = round((response.get("load_duration") or 0) / 1e9, 2)
+            if not loaded:
+                continue
+            self.loaded[model] = time.time()
+            self._record("load", model, load_seconds=loaded, seconds=round(time.time() - start, 2))
+
+    async def unload(self, models: Optional[List[str]] = None, reason: str = ""):
+        """在每个Ollama节点上卸载模型（keep_alive=0）"""
+        for model in models or self.models:
+            results = await self.client.generate_on_all_endpoints(model=model, keep_alive=0)
+            failed = {endpoint: error for endpoint, error in results.items() if isinstance(error, Exception)}
+            for endpoint, error in failed.items():
+                print(f"⚠️  模型卸载失败 {model} @ {endpoint}: {error}")
+            if results and len(failed) == len(results):
+                continue
+            self.loaded.pop(model, None)
+            self._record("unload", model, reason=reason)
+
+    def _memory_tight(self) -> Optional[float]:
+        """可用内存低于阈值时返回可用内存（MB），否则返回None"""
+        if self.unload_below_mb <= 0:
+            return None
+        available = available_memory_mb()
+        if available is None or available >= self.unload_below_mb:
+            return None
+        return available
+
+    def _llm_pending(self, models: List[str]) -> int:
+        """调度器中这些模型正在运行和排队的请求数（客户端没有调度器时视为0）"""
+        scheduler = getattr(self.client, "scheduler", None)
+        if scheduler is None:
+            return 0
+        return sum(scheduler.pending(model) for model in models)
+
+    def _enter_phase(self, phase: str):
+        self.active_phases[phase] = self.active_phases.get(phase, 0) + 1
+
+    async def release_for_images(self):
+        """
+        图片生成阶段不再需要LLM时调用：内存紧张时卸载已加载的模型
+        其他任务还处于用LLM的阶段，或调度器中仍有该模型的请求时不卸载，避免模型反复加载
+        """
+        if self.unloaded_for_memory or not self.loaded:
+            return
+        if any(n for p, n in self.active_phases.items() if n and p not in LLM_IDLE_PHASES):
+            return
+        models = list(self.loaded)
+        if self._llm_pending(models):
+            return
+        available = self._memory_tight()
+        if available is None:
+            return
+        resident_mb = self.pipeline_pool.stats()["resident_mb"] if self.pipeline_pool is not None else None
+        self.unloaded_for_memory = True
+        await self.unload(
+            models,
+            reason=f"可用内存 {available:.0f} MB 低于 {self.unload_below_mb:.0f} MB，SD管线常驻 {resident_mb} MB"
+        )
+
+    def _exit_phase(self, phase: str):
+        self.active_phases[phase] = max(0, self.active_phases.get(phase, 0) - 1)
+        if not self.unloaded_for_memory or any(self.active_phases.get(p) for p in LLM_IDLE_PHASES):
+            return
+        # 图片阶段全部结束，后台重新预热，后续的编辑检查不必等待加载
+        self.unloaded_for_memory = False
+        self.preload_in_background()
+
+    def preload_in_background(self) -> asyncio.Task:
+        """后台预热（保留任务引用，结束时打印异常）"""
+        if self._preload_task is None or self._preload_task.done():
+            self._preload_task = asyncio.create_task(self.preload())
+            self._preload_task.add_done_callback(self._preload_done)
+        return self._preload_task
+
+    def _preload_done(self, task: asyncio.Task):
+        """后台预热结束：打印异常（避免 Task exception was never retrieved）"""
+        if self._preload_task is task:
+            self._preload_task = None
+        if not task.cancelled() and task.exception() is not None:
+            print(f"⚠️  后台重新预热失败: {task.exception()}")
+
+    @asynccontextmanager
+    async def phase(self, name: str):
+        """with块内发起的LLM请求使用该阶段的 keep_alive"""
+        token = current_llm_phase.set(name)
+        self._enter_phase(name)
+        try:
+            yield
+        finally:
+            self._exit_phase(name)
+            current_llm_phase.reset(token)
+
+    def wrap(self, name: str, node: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        """把工作流节点包装为在指定阶段中运行"""
+
+        @functools.wraps(node)
+        async def run(*args, **kwargs):
+            async with self.phase(name):
+                return await node(*args, **kwargs)
+
+        return run
+
+    def stats(self) -> Dict[str, Any]:
+        available = available_memory_mb()
+        return {
+            "models": self.models,
+            "loaded": {m: round(time.time() - t, 1) for m, t in self.loaded.items()},
+            "keep_alive": {phase: self.keep_alive_for(phase) for phase in PHASES},
+            "active_phases": {p: n for p, n in self.active_phases.items() if n},
+            "unloaded_for_memory": self.unloaded_for_memory,
+            "unload_below_mb": self.unload_below_mb,
+            "available_memory_mb": round(available, 1) if available is not None else None,
+            "counts": dict(self.counts),
+            "events": list(self.events)[-50:]
+        }
+
+
+def init_model_residency(client: Any, pipeline_pool: Any = None) -> ModelResidencyManager:
+    """
+    创建进程内共享的模型常驻管理器（LLM请求自动带上当前阶段的 keep_alive）
+    环境变量：LLM_PRELOAD_MODELS / LLM_KEEP_ALIVE / LLM_KEEP_ALIVE_<阶段> / LLM_UNLOAD_BELOW_MB
+    """
+    global _manager
+    _manager = ModelResidencyManager(
+        client,
+        default_keep_alive=os.getenv("LLM_KEEP_ALIVE", "30m"),
+        unload_below_mb=float(os.getenv("LLM_UNLOAD_BELOW_MB", "0")),
+        pipeline_pool=pipeline_pool
+    )
+    return _manager
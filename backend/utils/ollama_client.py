@@ -1,25 +1,328 @@
 import aiohttp
 import asyncio
+import contextvars
+import copy
+import itertools
 import json
-from typing import Dict, Any, Optional
+import os
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import Dict, Any, AsyncIterator, List, Optional
+from utils.asset_cache import AssetCache
+from utils.llm_telemetry import llm_telemetry
+from utils.model_residency import observe_llm_response, phase_keep_alive
+from utils.ollama_endpoints import OllamaEndpoint, get_endpoint_pool
+from utils.token_budget import context_window
+
+# 请求优先级（数值越小越先调度）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 5
+PRIORITY_BACKGROUND = 10
+
+# 当前请求所属的任务和优先级，由调用方通过 llm_job() 设置，asyncio任务创建时自动继承
+current_llm_job: contextvars.ContextVar[str] = contextvars.ContextVar("current_llm_job", default="default")
+current_llm_priority: contextvars.ContextVar[int] = contextvars.ContextVar("current_llm_priority", default=PRIORITY_NORMAL)
+
+@contextmanager
+def llm_job(job_id: str, priority: int = PRIORITY_NORMAL):
+    """在with块内发起的LLM请求都归属于该任务（用于公平调度和优先级）"""
+    job_token = current_llm_job.set(job_id)
+    priority_token = current_llm_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_llm_job.reset(job_token)
+        current_llm_priority.reset(priority_token)
+
+class LLMQueueFullError(Exception):
+    """LLM请求队列已满"""
+
+class _Waiter:
+    """排队中的请求"""
+    
+    def __init__(self, seq: int, model: str, job_id: str, priority: int, future: asyncio.Future):
+        self.seq = seq
+        self.model = model
+        self.job_id = job_id
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.time()
+
+class LLMScheduler:
+    """LLM请求调度器
+    
+    - 全局并发上限 + 按模型的并发上限，超出的请求排队
+    - 队列有长度上限，按优先级出队；同优先级下在任务间轮转（公平分享），再按先后顺序
+    - 记录队列深度和排队等待时间
+    """
+    
+    def __init__(self, max_concurrency: int = 4, model_concurrency: Optional[Dict[str, int]] = None,
+                 default_model_concurrency: int = 2, max_queue: int = 256, queue_timeout: Optional[float] = None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.model_concurrency = model_concurrency or {}
+        self.default_model_concurrency = max(1, default_model_concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._seq = itertools.count()
+        self._waiters: List[_Waiter] = []
+        self._running_total = 0
+        self._running_by_model: Dict[str, int] = {}
+        self._running_by_job: Dict[str, int] = {}
+        # 各活跃任务已获得的名额数，用于任务间轮转；新任务从当前最小值起步，避免后来者连续插队
+        self._served_by_job: Dict[str, int] = {}
+        self.max_queue_depth = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._wait_times: List[float] = []
+    
+    def _model_limit(self, model: str) -> int:
+        return self.model_concurrency.get(model, self.default_model_concurrency)
+    
+    def _can_run(self, model: str) -> bool:
+        return (self._running_total < self.max_concurrency
+                and self._running_by_model.get(model, 0) < self._model_limit(model))
+    
+    def _dispatch(self):
+        """按 优先级 -> 任务当前占用 -> 任务已获名额 -> 入队顺序 选择可运行的请求"""
+        while True:
+            candidates = [w for w in self._waiters if not w.future.done() and self._can_run(w.model)]
+            if not candidates:
+                self._waiters = [w for w in self._waiters if not w.future.done()]
+                return
+            waiter = min(candidates, key=lambda w: (
+                w.priority, self._running_by_job.get(w.job_id, 0), self._served(w.job_id), w.seq
+            ))
+            self._waiters.remove(waiter)
+            self._acquire(waiter.model, waiter.job_id)
+            self._record_wait(time.time() - waiter.enqueued_at)
+            waiter.future.set_result(True)
+    
+    def _served(self, job_id: str) -> int:
+        if job_id not in self._served_by_job:
+            self._served_by_job[job_id] = min(self._served_by_job.values(), default=0)
+        return self._served_by_job[job_id]
+    
+    def _acquire(self, model: str, job_id: str):
+        self._served_by_job[job_id] = self._served(job_id) + 1
+        self._running_total += 1
+        self._running_by_model[model] = self._running_by_model.get(model, 0) + 1
+        self._running_by_job[job_id] = self._running_by_job.get(job_id, 0) + 1
+    
+    def _release(self, model: str, job_id: str):
+        self._running_total -= 1
+        self._running_by_model[model] -= 1
+        self._running_by_job[job_id] -= 1
+        if not self._running_by_job[job_id]:
+            self._running_by_job.pop(job_id)
+            if not any(w.job_id == job_id and not w.future.done() for w in self._waiters):
+                self._served_by_job.pop(job_id, None)
+        self.completed += 1
+        self._dispatch()
+    
+    def _record_wait(self, seconds: float):
+        self._wait_times.append(seconds)
+        if len(self._wait_times) > 1000:
+            self._wait_times = self._wait_times[-1000:]
+    
+    @asynccontextmanager
+    async def slot(self, model: str, priority: Optional[int] = None, job_id: Optional[str] = None):
+        """申请一个执行名额（排队直到可运行），with块结束时释放"""
+        priority = current_llm_priority.get() if priority is None else priority
+        job_id = job_id or current_llm_job.get()
+        
+        if not self._waiters and self._can_run(model):
+            self._acquire(model, job_id)
+            self._record_wait(0.0)
+        else:
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise LLMQueueFullError(f"LLM请求队列已满（{self.max_queue}）")
+            waiter = _Waiter(next(self._seq), model, job_id, priority, asyncio.get_running_loop().create_future())
+            self._waiters.append(waiter)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+            self._dispatch()
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.queue_timeout)
+            except BaseException as e:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # 已分配名额但调用方被取消/超时，归还名额
+                    self._release(model, job_id)
+                else:
+                    waiter.future.cancel()
+                    self._dispatch()
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                    raise Exception(f"LLM请求排队超时（{self.queue_timeout}秒）")
+                raise
+        try:
+            yield
+        finally:
+            self._release(model, job_id)
+    
+    def pending(self, model: str) -> int:
+        """指定模型正在运行和排队中的请求数"""
+        queued = sum(1 for w in self._waiters if w.model == model and not w.future.done())
+        return self._running_by_model.get(model, 0) + queued
+    
+    def stats(self) -> Dict[str, Any]:
+        """队列深度、运行数和排队等待时间统计"""
+        waits = sorted(self._wait_times)
+        queued_by_priority: Dict[int, int] = {}
+        for waiter in self._waiters:
+            if not waiter.future.done():
+                queued_by_priority[waiter.priority] = queued_by_priority.get(waiter.priority, 0) + 1
+        return {
+            "queue_depth": sum(queued_by_priority.values()),
+            "max_queue_depth": self.max_queue_depth,
+            "queued_by_priority": queued_by_priority,
+            "running": self._running_total,
+            "running_by_model": {m: n for m, n in self._running_by_model.items() if n},
+            "running_by_job": dict(self._running_by_job),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_timeouts": self.timeouts,
+            "wait_seconds": {
+                "avg": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                "p50": round(waits[len(waits) // 2], 3) if waits else 0.0,
+                "p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+                "max": round(waits[-1], 3) if waits else 0.0
+            }
+        }
+
+def _parse_model_limits(value: str) -> Dict[str, int]:
+    """解析 "model=2,other=1" 形式的按模型并发上限"""
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, limit = item.rsplit("=", 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+_scheduler: Optional[LLMScheduler] = None
+
+def get_llm_scheduler() -> LLMScheduler:
+    """
+    获取进程内共享的LLM调度器
+    环境变量：OLLAMA_MAX_CONCURRENCY / OLLAMA_MODEL_CONCURRENCY / OLLAMA_MAX_QUEUE / OLLAMA_QUEUE_TIMEOUT
+    """
+    global _scheduler
+    if _scheduler is None:
+        queue_timeout = float(os.getenv("OLLAMA_QUEUE_TIMEOUT", "0"))
+        model_limits = _parse_model_limits(os.getenv("OLLAMA_MODEL_CONCURRENCY", ""))
+        _scheduler = LLMScheduler(
+            max_concurrency=int(os.getenv("OLLAMA_MAX_CONCURRENCY", "4")),
+            model_concurrency=model_limits,
+            default_model_concurrency=model_limits.pop("*", 2),
+            max_queue=int(os.getenv("OLLAMA_MAX_QUEUE", "256")),
+            queue_timeout=queue_timeout if queue_timeout > 0 else None
+        )
+    return _scheduler
+
+# 不影响生成结果、不参与缓存键的请求字段
+_UNCACHED_FIELDS = ("stream", "keep_alive")
+
+_llm_caches: Dict[str, AssetCache] = {}
+_llm_caches_lock = threading.Lock()
+
+def get_llm_cache() -> Optional[AssetCache]:
+    """
+    LLM响应的磁盘缓存（OLLAMA_CACHE=1 开启），同一缓存目录在进程内共享一个实例，多个客户端不会互相覆盖索引
+    环境变量：OLLAMA_CACHE_DIR / OLLAMA_CACHE_MAX_MB / OLLAMA_CACHE_TTL
+    """
+    if os.getenv("OLLAMA_CACHE", "0") != "1":
+        return None
+    cache_dir = Path(os.getenv("OLLAMA_CACHE_DIR", "cache/llm"))
+    cache_key = str(cache_dir.resolve())
+    with _llm_caches_lock:
+        if cache_key not in _llm_caches:
+            max_mb = int(os.getenv("OLLAMA_CACHE_MAX_MB", "256"))
+            ttl = float(os.getenv("OLLAMA_CACHE_TTL", str(7 * 24 * 3600)))
+            _llm_caches[cache_key] = AssetCache(
+                cache_dir,
+                namespace="llm",
+                max_bytes=max_mb * 1024 * 1024 if max_mb > 0 else None,
+                ttl=ttl if ttl > 0 else None
+            )
+        return _llm_caches[cache_key]
+
+class OllamaEndpointError(Exception):
+    """Ollama节点返回的非200响应"""
+    
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class _InFlight:
+    """进行中的一次上游请求，相同请求的调用方共享其结果"""
+    
+    def __init__(self, task: asyncio.Task, model: str):
+        self.task = task
+        self.model = model
+        self.started_at = time.time()
+        self.waiters = 0
+        self.followers = 0
 
 class OllamaClient:
     """Ollama客户端"""
     
-    def __init__(self, base_url: str = "http://localhost:11434"):
-        self.base_url = base_url
+    def __init__(self, base_url: Optional[str] = None, scheduler: Optional[LLMScheduler] = None):
+        # 节点池：未指定 base_url 时使用 OLLAMA_HOSTS / OLLAMA_HOST 配置的全部节点
+        self.endpoints = get_endpoint_pool(base_url)
+        self.base_url = self.endpoints.endpoints[0].url
         self.session = None
+        # generate/chat 经调度器限流排队
+        self.scheduler = scheduler or get_llm_scheduler()
+        request_timeout = float(os.getenv("OLLAMA_REQUEST_TIMEOUT", "600"))
+        self.request_timeout = request_timeout if request_timeout > 0 else None
+        # 可选的响应缓存（相同模型、提示词/消息和生成参数直接返回上次结果）
+        self.cache = get_llm_cache()
+        # 合并进行中的相同请求（同一模型、提示词/消息和生成参数只发一次上游请求，OLLAMA_COALESCE=0 关闭）
+        self.coalesce = os.getenv("OLLAMA_COALESCE", "1") == "1"
+        self._inflight: Dict[str, _InFlight] = {}
+        self._request_stats: Dict[str, Dict[str, float]] = {}
     
     async def _get_session(self):
         """获取或创建HTTP会话"""
         if self.session is None:
             self.session = aiohttp.ClientSession()
+            self.endpoints.start_health_checks(self._fetch_tags)
         return self.session
     
-    async def generate(self, model: str, prompt: str, stream: bool = False, **kwargs) -> Dict[str, Any]:
-        """生成文本"""
-        
+    async def _fetch_tags(self, endpoint: OllamaEndpoint) -> Dict[str, Any]:
+        """获取单个节点的模型列表（也用作健康检查）"""
         session = await self._get_session()
+        async with session.get(f"{endpoint.url}/api/tags", timeout=aiohttp.ClientTimeout(total=10)) as response:
+            if response.status != 200:
+                raise OllamaEndpointError(response.status, f"Ollama API错误: {response.status} - {await response.text()}")
+            return await response.json()
+    
+    def _endpoint_failed(self, endpoint: OllamaEndpoint, model: Optional[str], error: Exception) -> str:
+        """
+        处理节点请求失败：连接失败和5xx计入节点失败次数，404（节点上没有该模型）更新模型列表，
+        这几种情况可以换节点重试，返回错误信息；其余错误（如参数错误）直接抛出
+        """
+        if isinstance(error, OllamaEndpointError):
+            if error.status == 404 and model:
+                self.endpoints.forget_model(endpoint, model)
+            elif error.status >= 500:
+                self.endpoints.record_failure(endpoint, str(error))
+            else:
+                raise error
+            return str(error)
+        message = f"连接Ollama失败: {str(error)}"
+        self.endpoints.record_failure(endpoint, message)
+        return message
+    
+    async def generate(self, model: str, prompt: str, stream: bool = False, no_cache: bool = False,
+                       refresh: bool = False, **kwargs) -> Dict[str, Any]:
+        """
+        生成文本（no_cache=True 时跳过响应缓存，用于需要随机结果的调用；
+        refresh=True 时不读缓存但用新结果覆盖缓存，用于上次结果不可用后的重试）
+        """
         
         payload = {
             "model": model,
@@ -27,20 +330,244 @@ class OllamaClient:
             "stream": stream,
             **kwargs
         }
+        return await self._request("/api/generate", payload, no_cache, refresh)
+    
+    async def invalidate(self, model: str, prompt: Optional[str] = None, messages: Optional[list] = None, **kwargs) -> bool:
+        """删除与 generate（传 prompt）或 chat（传 messages）调用参数相同的缓存响应，返回是否删除了条目"""
+        if self.cache is None:
+            return False
+        if messages is not None:
+            path, payload = "/api/chat", {"model": model, "messages": messages, **kwargs}
+        else:
+            path, payload = "/api/generate", {"model": model, "prompt": prompt, **kwargs}
+        return await asyncio.to_thread(self.cache.delete, self._cache_key(path, payload))
+    
+    async def _request(self, path: str, payload: Dict[str, Any], no_cache: bool = False,
+                       refresh: bool = False) -> Dict[str, Any]:
+        """
+        发送推理请求；已有相同请求在进行中时直接等待它的结果（no_cache/refresh 的请求需要新结果，不参与合并）
+        上游请求以独立任务运行，发起方被取消时其余调用方仍能拿到结果，全部调用方都取消后才取消上游请求
+        """
+        self._apply_keep_alive(payload)
+        self._apply_context_window(payload)
+        stats = self._request_stats.setdefault(payload["model"], {"requests": 0, "coalesced": 0, "saved_seconds": 0.0})
+        stats["requests"] += 1
+        if not self.coalesce or no_cache or refresh:
+            return await self._fetch(path, payload, no_cache, refresh)
+        
+        key = self._cache_key(path, payload)
+        flight = self._inflight.get(key)
+        if flight is None:
+            # 上游任务继承发起方的上下文（任务归属和优先级）
+            flight = _InFlight(asyncio.ensure_future(self._fetch(path, payload)), payload["model"])
+            self._inflight[key] = flight
+            flight.task.add_done_callback(lambda _, key=key, flight=flight: self._finish_flight(key, flight))
+        else:
+            flight.followers += 1
+            stats["coalesced"] += 1
+            llm_telemetry.record_coalesced()
         
+        flight.waiters += 1
         try:
-            async with session.post(f"{self.base_url}/api/generate", json=payload) as response:
-                if response.status == 200:
-                    if stream:
-                        return await self._handle_stream_response(response)
-                    else:
-                        return await response.json()
-                else:
-                    error_text = await response.text()
-                    raise Exception(f"Ollama API错误: {response.status} - {error_text}")
+            result = await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+        # 各调用方拿到独立的深拷贝（message、context 等嵌套对象也不共享），互不影响
+        return copy.deepcopy(result)
+    
+    def _finish_flight(self, key: str, flight: _InFlight):
+        """上游请求结束：移出进行中列表，按合并的调用方数量累计节省的推理时间"""
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+        if flight.followers and not flight.task.cancelled() and flight.task.exception() is None:
+            stats = self._request_stats[flight.model]
+            stats["saved_seconds"] += (time.time() - flight.started_at) * flight.followers
+    
+    async def _fetch(self, path: str, payload: Dict[str, Any], no_cache: bool = False,
+                     refresh: bool = False) -> Dict[str, Any]:
+        """查询响应缓存，未命中（或 refresh）时发送推理请求并写入缓存"""
+        if self.cache is None or no_cache:
+            return await self._scheduled_post(path, payload)
+        
+        key = self._cache_key(path, payload)
+        cached = None if refresh else await asyncio.to_thread(self._read_cached, key)
+        if cached is not None:
+            llm_telemetry.record_cache_hit()
+            return cached
+        result = await self._scheduled_post(path, payload)
+        await asyncio.to_thread(self._write_cached, key, result)
+        return result
+    
+    async def generate_stream(self, model: str, prompt: str, no_cache: bool = False, **kwargs) -> AsyncIterator[str]:
+        """
+        流式生成文本，逐段产出模型输出（命中缓存时一次性产出完整结果）
+        整个流期间占用一个调度名额；OLLAMA_REQUEST_TIMEOUT 限制总耗时
+        """
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": True,
+            **kwargs
+        }
+        self._apply_keep_alive(payload)
+        self._apply_context_window(payload)
+        key = self._cache_key("/api/generate", payload) if self.cache is not None and not no_cache else None
+        if key is not None:
+            cached = await asyncio.to_thread(self._read_cached, key)
+            if cached is not None:
+                llm_telemetry.record_cache_hit()
+                yield cached.get("response", "")
+                return
+        
+        pieces = []
+        final: Dict[str, Any] = {}
+        enqueued_at = time.time()
+        async with self.scheduler.slot(model):
+            started_at = time.time()
+            session = await self._get_session()
+            deadline = time.time() + self.request_timeout if self.request_timeout else None
+            tried = set()
+            last_error = None
+            while True:
+                endpoint = self.endpoints.pick(model, tried)
+                if endpoint is None:
+                    llm_telemetry.record_error()
+                    raise Exception(last_error or "没有可用的Ollama节点")
+                tried.add(endpoint.url)
+                endpoint.outstanding += 1
+                endpoint.requests += 1
+                try:
+                    async with session.post(f"{endpoint.url}/api/generate", json=payload) as response:
+                        if response.status != 200:
+                            error_text = await response.text()
+                            raise OllamaEndpointError(response.status, f"Ollama API错误: {response.status} - {error_text}")
+                        while True:
+                            remaining = deadline - time.time() if deadline else None
+                            if remaining is not None and remaining <= 0:
+                                raise asyncio.TimeoutError()
+                            line = await asyncio.wait_for(response.content.readline(), timeout=remaining)
+                            if not line:
+                                break
+                            try:
+                                data = json.loads(line.decode('utf-8'))
+                            except json.JSONDecodeError:
+                                continue
+                            if data.get("response"):
+                                pieces.append(data["response"])
+                                yield data["response"]
+                            if data.get("done", False):
+                                final = data
+                                break
+                    self.endpoints.record_success(endpoint)
+                    llm_telemetry.record_call("/api/generate", model, final, started_at - enqueued_at, time.time() - started_at)
+                    observe_llm_response(model, final)
+                    break
+                except asyncio.TimeoutError:
+                    llm_telemetry.record_error()
+                    raise Exception(f"Ollama请求超时（{self.request_timeout}秒）")
+                except (aiohttp.ClientError, OllamaEndpointError) as e:
+                    last_error = self._endpoint_failed(endpoint, model, e)
+                    # 已经产出部分内容时不能换节点重来
+                    if pieces:
+                        llm_telemetry.record_error()
+                        raise Exception(last_error)
+                    print(f"Ollama节点 {endpoint.url} 请求失败，尝试其他节点: {last_error}")
+                finally:
+                    endpoint.outstanding -= 1
         
-        except aiohttp.ClientError as e:
-            raise Exception(f"连接Ollama失败: {str(e)}")
+        if key is not None and final:
+            await asyncio.to_thread(self._write_cached, key, {**final, "response": "".join(pieces)})
+    
+    @staticmethod
+    def _apply_context_window(payload: Dict[str, Any]):
+        """
+        未显式指定 num_ctx 时使用 OLLAMA_NUM_CTX（所有请求用同一个值，不会因上下文长度变化触发模型重新加载）
+        """
+        num_ctx = context_window()
+        if num_ctx > 0 and "num_ctx" not in payload.get("options", {}):
+            payload["options"] = {**payload.get("options", {}), "num_ctx": num_ctx}
+    
+    @staticmethod
+    def _apply_keep_alive(payload: Dict[str, Any]):
+        """未显式指定 keep_alive 时使用当前流程阶段的设置"""
+        if "keep_alive" not in payload:
+            keep_alive = phase_keep_alive()
+            if keep_alive is not None:
+                payload["keep_alive"] = keep_alive
+    
+    def _cache_key(self, path: str, payload: Dict[str, Any]) -> str:
+        return AssetCache.make_key(path=path, **{k: v for k, v in payload.items() if k not in _UNCACHED_FIELDS})
+    
+    def _read_cached(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        try:
+            with open(self.cache.cache_dir / entry["file"], "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+    
+    def _write_cached(self, key: str, result: Dict[str, Any]):
+        """原子写入响应文件并登记到缓存"""
+        path = self.cache.path_for(key, "llm", ".json")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 每次写入使用唯一的临时文件名，同一键的并发写入不会互相覆盖
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self.cache.put(key, path, {"model": result.get("model", "")})
+    
+    async def _scheduled_post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """经调度器排队后发送推理请求（排队时间不计入请求超时），记录调用遥测"""
+        enqueued_at = time.time()
+        async with self.scheduler.slot(payload["model"]):
+            started_at = time.time()
+            try:
+                result = await asyncio.wait_for(self._post(path, payload), timeout=self.request_timeout)
+            except asyncio.TimeoutError:
+                llm_telemetry.record_error()
+                raise Exception(f"Ollama请求超时（{self.request_timeout}秒）")
+            except Exception:
+                llm_telemetry.record_error()
+                raise
+        llm_telemetry.record_call(path, payload["model"], result, started_at - enqueued_at, time.time() - started_at)
+        observe_llm_response(payload["model"], result)
+        return result
+    
+    async def _post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """发送推理请求：按节点池选择节点，连接失败、5xx或节点上没有该模型时换其他节点重试"""
+        
+        session = await self._get_session()
+        model = payload.get("model")
+        tried = set()
+        last_error = None
+        while True:
+            endpoint = self.endpoints.pick(model, tried)
+            if endpoint is None:
+                raise Exception(last_error or "没有可用的Ollama节点")
+            tried.add(endpoint.url)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            try:
+                async with session.post(f"{endpoint.url}{path}", json=payload) as response:
+                    if response.status != 200:
+                        error_text = await response.text()
+                        raise OllamaEndpointError(response.status, f"Ollama API错误: {response.status} - {error_text}")
+                    if payload.get("stream"):
+                        result = await self._handle_stream_response(response)
+                    else:
+                        result = await response.json()
+                self.endpoints.record_success(endpoint)
+                return result
+            except (aiohttp.ClientError, OllamaEndpointError) as e:
+                last_error = self._endpoint_failed(endpoint, model, e)
+                print(f"Ollama节点 {endpoint.url} 请求失败，尝试其他节点: {last_error}")
+            finally:
+                endpoint.outstanding -= 1
     
     async def _handle_stream_response(self, response) -> Dict[str, Any]:
         """处理流式响应"""
@@ -59,10 +586,9 @@ class OllamaClient:
         
         return {"response": full_response}
     
-    async def chat(self, model: str, messages: list, stream: bool = False, **kwargs) -> Dict[str, Any]:
-        """聊天接口"""
-        
-        session = await self._get_session()
+    async def chat(self, model: str, messages: list, stream: bool = False, no_cache: bool = False,
+                   refresh: bool = False, **kwargs) -> Dict[str, Any]:
+        """聊天接口（no_cache、refresh 与 generate 相同）"""
         
         payload = {
             "model": model,
@@ -70,54 +596,82 @@ class OllamaClient:
             "stream": stream,
             **kwargs
         }
-        
-        try:
-            async with session.post(f"{self.base_url}/api/chat", json=payload) as response:
-                if response.status == 200:
-                    if stream:
-                        return await self._handle_stream_response(response)
-                    else:
-                        return await response.json()
-                else:
-                    error_text = await response.text()
-                    raise Exception(f"Ollama API错误: {response.status} - {error_text}")
-        
-        except aiohttp.ClientError as e:
-            raise Exception(f"连接Ollama失败: {str(e)}")
+        return await self._request("/api/chat", payload, no_cache, refresh)
     
     async def list_models(self) -> Dict[str, Any]:
-        """列出可用模型"""
-        
-        session = await self._get_session()
+        """列出所有节点上可用的模型（合并去重），同时刷新各节点的模型列表"""
         
-        try:
-            async with session.get(f"{self.base_url}/api/tags") as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    error_text = await response.text()
-                    raise Exception(f"Ollama API错误: {response.status} - {error_text}")
-        
-        except aiohttp.ClientError as e:
-            raise Exception(f"连接Ollama失败: {str(e)}")
+        results = await asyncio.gather(*(self._fetch_tags(e) for e in self.endpoints.endpoints), return_exceptions=True)
+        models: Dict[str, Any] = {}
+        errors = []
+        for endpoint, result in zip(self.endpoints.endpoints, results):
+            if isinstance(result, aiohttp.ClientError):
+                result = Exception(f"连接Ollama失败: {str(result)}")
+            if isinstance(result, BaseException):
+                self.endpoints.record_failure(endpoint, str(result))
+                errors.append(result)
+                continue
+            self.endpoints.record_models(endpoint, result)
+            self.endpoints.record_success(endpoint)
+            for m in result.get("models", []):
+                models.setdefault(m.get("name", ""), m)
+        if len(errors) == len(results):
+            raise errors[0]
+        return {"models": list(models.values())}
     
     async def pull_model(self, model: str) -> Dict[str, Any]:
-        """拉取模型"""
+        """在所有可达节点上拉取模型"""
         
         session = await self._get_session()
         
         payload = {"name": model}
+        result = None
+        last_error = None
+        for endpoint in self.endpoints.endpoints:
+            try:
+                async with session.post(f"{endpoint.url}/api/pull", json=payload) as response:
+                    if response.status == 200:
+                        result = await response.json()
+                        endpoint.models = None  # 模型列表已变化，等待下次健康检查刷新
+                    else:
+                        error_text = await response.text()
+                        last_error = Exception(f"Ollama API错误: {response.status} - {error_text}")
+            except aiohttp.ClientError as e:
+                last_error = Exception(f"连接Ollama失败: {str(e)}")
+        if result is None:
+            raise last_error
+        return result
+    
+    async def generate_on_all_endpoints(self, model: str, prompt: str = "", **kwargs) -> Dict[str, Any]:
+        """
+        向每个可用节点（已知没有该模型的除外）各发送一次 generate，用于预热或卸载模型（keep_alive=0）
+        不经过调度器和响应缓存；返回 节点URL -> 响应或异常
+        """
+        payload = {"model": model, "prompt": prompt, "stream": False, **kwargs}
+        self._apply_keep_alive(payload)
+        self._apply_context_window(payload)
+        session = await self._get_session()
+        endpoints = [e for e in self.endpoints.endpoints if not e.ejected and e.has_model(model) is not False]
         
-        try:
-            async with session.post(f"{self.base_url}/api/pull", json=payload) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    error_text = await response.text()
-                    raise Exception(f"Ollama API错误: {response.status} - {error_text}")
+        async def send(endpoint: OllamaEndpoint) -> Dict[str, Any]:
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            try:
+                async with session.post(f"{endpoint.url}/api/generate", json=payload,
+                                        timeout=aiohttp.ClientTimeout(total=self.request_timeout)) as response:
+                    if response.status != 200:
+                        raise OllamaEndpointError(response.status, f"Ollama API错误: {response.status} - {await response.text()}")
+                    result = await response.json()
+                self.endpoints.record_success(endpoint)
+                return result
+            except (aiohttp.ClientError, OllamaEndpointError) as e:
+                self._endpoint_failed(endpoint, model, e)
+                raise
+            finally:
+                endpoint.outstanding -= 1
         
-        except aiohttp.ClientError as e:
-            raise Exception(f"连接Ollama失败: {str(e)}")
+        results = await asyncio.gather(*(send(e) for e in endpoints), return_exceptions=True)
+        return {endpoint.url: result for endpoint, result in zip(endpoints, results)}
     
     async def check_model_exists(self, model: str) -> bool:
         """检查模型是否存在"""
@@ -128,8 +682,25 @@ class OllamaClient:
         except:
             return False
     
+    def stats(self) -> Dict[str, Any]:
+        """客户端统计（调度器队列、响应缓存、各节点状态、各模型合并的重复请求数和节省的推理时间）"""
+        return {
+            "scheduler": self.scheduler.stats(),
+            "cache": self.cache.stats() if self.cache else None,
+            "endpoints": self.endpoints.stats(),
+            "coalescing": {
+                "enabled": self.coalesce,
+                "in_flight": len(self._inflight),
+                "models": {
+                    model: {**stats, "saved_seconds": round(stats["saved_seconds"], 2)}
+                    for model, stats in self._request_stats.items()
+                }
+            }
+        }
+    
     async def close(self):
         """关闭会话"""
+        await self.endpoints.stop_health_checks()
         if self.session:
             await self.session.close()
             self.session = None
@@ -0,0 +1,178 @@
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+DEFAULT_OLLAMA_PORT = 11434
+
+
+def normalize_host(host: str) -> str:
+    """把 OLLAMA_HOST 风格的地址（如 localhost、10.0.0.2:11434）补全为 http://host:port"""
+    host = host.strip().rstrip("/")
+    if "://" not in host:
+        host = f"http://{host}"
+    scheme, rest = host.split("://", 1)
+    if ":" not in rest.split("/", 1)[0]:
+        rest = rest.replace("/", f":{DEFAULT_OLLAMA_PORT}/", 1) if "/" in rest else f"{rest}:{DEFAULT_OLLAMA_PORT}"
+    return f"{scheme}://{rest}"
+
+
+def configured_hosts() -> List[str]:
+    """Ollama节点列表：OLLAMA_HOSTS（逗号分隔）优先，其次 OLLAMA_HOST，默认本机"""
+    hosts = os.getenv("OLLAMA_HOSTS") or os.getenv("OLLAMA_HOST") or "localhost:11434"
+    urls = []
+    for host in hosts.split(","):
+        if host.strip():
+            url = normalize_host(host)
+            if url not in urls:
+                urls.append(url)
+    return urls
+
+
+class OllamaEndpoint:
+    """单个Ollama节点的状态"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.last_error: Optional[str] = None
+        # 节点上已有的模型（None 表示尚未获取）
+        self.models: Optional[Set[str]] = None
+
+    @property
+    def ejected(self) -> bool:
+        return time.time() < self.ejected_until
+
+    def has_model(self, model: str) -> Optional[bool]:
+        return None if self.models is None else model in self.models
+
+
+class EndpointPool:
+    """Ollama节点池
+
+    - 按未完成请求数最少选择节点，优先选择已知装有该模型的节点（模型列表来自 /api/tags）
+    - 被动健康检查：连续失败 failure_threshold 次的节点被摘除 eject_seconds 秒
+    - 主动健康检查：后台定期请求各节点的 /api/tags，恢复的节点立即重新加入并刷新模型列表
+    - 所有节点都被摘除时仍选择最早恢复的节点，不直接拒绝请求
+    """
+
+    def __init__(self, urls: List[str], failure_threshold: int = 3, eject_seconds: float = 30,
+                 health_interval: float = 15):
+        if not urls:
+            raise ValueError("至少需要一个Ollama节点")
+        self.endpoints = [OllamaEndpoint(url) for url in urls]
+        self.failure_threshold = max(1, failure_threshold)
+        self.eject_seconds = eject_seconds
+        self.health_interval = health_interval
+        self._health_task: Optional[asyncio.Task] = None
+
+    def pick(self, model: Optional[str] = None, exclude: Set[str] = frozenset()) -> Optional[OllamaEndpoint]:
+        """选择一个节点，exclude 中的节点（本次请求已失败过的）不再选择；无可选节点时返回None"""
+        candidates = [e for e in self.endpoints if e.url not in exclude]
+        if not candidates:
+            return None
+        available = [e for e in candidates if not e.ejected]
+        if not available:
+            return min(candidates, key=lambda e: e.ejected_until)
+        if model:
+            # 模型亲和：已知有该模型的节点 > 模型列表未知的节点 > 其余节点
+            with_model = [e for e in available if e.has_model(model)]
+            unknown = [e for e in available if e.has_model(model) is None]
+            available = with_model or unknown or available
+        return min(available, key=lambda e: (e.outstanding, e.requests))
+
+    def record_success(self, endpoint: OllamaEndpoint):
+        endpoint.consecutive_failures = 0
+        endpoint.ejected_until = 0.0
+
+    def record_failure(self, endpoint: OllamaEndpoint, error: str):
+        """记录失败，连续失败达到阈值时摘除节点"""
+        endpoint.errors += 1
+        endpoint.consecutive_failures += 1
+        endpoint.last_error = error
+        if endpoint.consecutive_failures >= self.failure_threshold and not endpoint.ejected:
+            endpoint.ejected_until = time.time() + self.eject_seconds
+            endpoint.ejections += 1
+            print(f"⚠️  Ollama节点 {endpoint.url} 连续失败 {endpoint.consecutive_failures} 次，摘除 {self.eject_seconds:.0f} 秒: {error}")
+
+    def record_models(self, endpoint: OllamaEndpoint, tags: Dict[str, Any]):
+        endpoint.models = {m.get("name", "") for m in tags.get("models", [])}
+
+    def forget_model(self, endpoint: OllamaEndpoint, model: str):
+        """节点返回模型不存在时，从该节点的模型列表中移除"""
+        if endpoint.models is None:
+            endpoint.models = set()
+        endpoint.models.discard(model)
+
+    async def check(self, fetch_tags: Callable[[OllamaEndpoint], Awaitable[Dict[str, Any]]]):
+        """主动检查所有节点（含已摘除的），成功即恢复并刷新模型列表"""
+
+        async def check_one(endpoint: OllamaEndpoint):
+            try:
+                tags = await fetch_tags(endpoint)
+            except Exception as e:
+                self.record_failure(endpoint, f"健康检查失败: {e}")
+                return
+            if endpoint.ejected:
+                print(f"✓ Ollama节点 {endpoint.url} 已恢复")
+            self.record_models(endpoint, tags)
+            self.record_success(endpoint)
+
+        await asyncio.gather(*(check_one(e) for e in self.endpoints))
+
+    def start_health_checks(self, fetch_tags: Callable[[OllamaEndpoint], Awaitable[Dict[str, Any]]]):
+        """启动后台主动健康检查（单节点或 health_interval<=0 时不启动）"""
+        if len(self.endpoints) < 2 or self.health_interval <= 0:
+            return
+        if self._health_task and not self._health_task.done():
+            return
+
+        async def loop():
+            while True:
+                await self.check(fetch_tags)
+                await asyncio.sleep(self.health_interval)
+
+        self._health_task = asyncio.create_task(loop())
+
+    async def stop_health_checks(self):
+        if self._health_task:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._health_task = None
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        return [
+            {
+                "url": e.url,
+                "outstanding": e.outstanding,
+                "requests": e.requests,
+                "errors": e.errors,
+                "ejected": e.ejected,
+                "ejected_seconds_left": round(max(0.0, e.ejected_until - now), 1),
+                "ejections": e.ejections,
+                "last_error": e.last_error,
+                "models": sorted(e.models) if e.models is not None else None
+            } for e in self.endpoints
+        ]
+
+
+def get_endpoint_pool(base_url: Optional[str] = None) -> EndpointPool:
+    """
+    创建Ollama节点池（指定 base_url 时只用该节点）
+    环境变量：OLLAMA_HOSTS / OLLAMA_HOST / OLLAMA_FAILURE_THRESHOLD / OLLAMA_EJECT_SECONDS / OLLAMA_HEALTH_INTERVAL
+    """
+    return EndpointPool(
+        [normalize_host(base_url)] if base_url else configured_hosts(),
+        failure_threshold=int(os.getenv("OLLAMA_FAILURE_THRESHOLD", "3")),
+        eject_seconds=float(os.getenv("OLLAMA_EJECT_SECONDS", "30")),
+        health_interval=float(os.getenv("OLLAMA_HEALTH_INTERVAL", "15"))
+    )
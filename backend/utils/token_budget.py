@@ -0,0 +1,109 @@
+import math
+import os
+import re
+from typing import List
+
+# CJK表意文字、日文假名、韩文、全角标点：大多数分词器下约1个字符1个token
+_CJK = re.compile(
+    "[\u2e80-\u2fdf\u3000-\u303f\u3040-\u30ff\u3100-\u318f\u31f0-\u31ff"
+    "\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\ufe30-\ufe4f\uff00-\uffef]"
+)
+# 拉丁字母/数字组成的词：约4个字符1个token
+_WORD = re.compile(r"[A-Za-z0-9_]+")
+# 分句：句末标点（含紧随的引号/括号）之后切分
+_SENTENCE = re.compile(r"[^。！？!?…]*(?:[。！？!?…]+[”’」』）)\"']*|$)")
+
+
+# 未设置 num_ctx 时Ollama使用的上下文长度
+OLLAMA_DEFAULT_NUM_CTX = 2048
+
+
+def context_window() -> int:
+    """
+    请求使用的上下文长度（OLLAMA_NUM_CTX），OllamaClient 会把它作为 options.num_ctx 随每个请求发送；
+    设为0时不发送，按Ollama默认的2048计算
+    """
+    return int(os.getenv("OLLAMA_NUM_CTX", "8192"))
+
+
+def script_output_reserve() -> int:
+    """剧本调用为模型输出预留的token数（SCRIPT_OUTPUT_TOKENS）"""
+    return int(os.getenv("SCRIPT_OUTPUT_TOKENS", "1024"))
+
+
+def script_token_budget(prompt_overhead: int) -> int:
+    """单次剧本调用中章节正文可用的token数 = num_ctx - 提示词模板 - 输出预留"""
+    return (context_window() or OLLAMA_DEFAULT_NUM_CTX) - prompt_overhead - script_output_reserve()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的token数（偏保守）：CJK字符每个计1，拉丁词按4字符1个计，其余非空白符号每个计1
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    rest = _CJK.sub(" ", text)
+    words = _WORD.findall(rest)
+    word_tokens = sum(math.ceil(len(word) / 4) for word in words)
+    symbols = len(re.sub(r"\s", "", _WORD.sub("", rest)))
+    return cjk + word_tokens + symbols
+
+
+def _split_sentences(paragraph: str) -> List[str]:
+    return [s for s in _SENTENCE.findall(paragraph) if s.strip()]
+
+
+def _hard_split(text: str, max_tokens: int) -> List[str]:
+    """没有句末标点的超长文本按字符硬切（二分查找每块能容纳的最长前缀）"""
+    pieces = []
+    start = 0
+    while start < len(text):
+        low, high = start + 1, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if estimate_tokens(text[start:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        pieces.append(text[start:low])
+        start = low
+    return pieces
+
+
+def chunk_text(text: str, max_tokens: int) -> List[str]:
+    """
+    按token预算把长文本切成有序的块：优先在段落边界切分，超长段落按句子切，超长句子按字符切
+    :return: 每块估算token数不超过 max_tokens 的文本列表（保持原顺序）
+    """
+    max_tokens = max(1, max_tokens)
+    # (文本, 所属段落序号)：同一段落切出的句子拼回时不加换行
+    units = []
+    for index, paragraph in enumerate(text.split("\n")):
+        if not paragraph.strip():
+            continue
+        if estimate_tokens(paragraph) <= max_tokens:
+            units.append((paragraph, index))
+            continue
+        for sentence in _split_sentences(paragraph):
+            if estimate_tokens(sentence) <= max_tokens:
+                units.append((sentence, index))
+            else:
+                units.extend((piece, index) for piece in _hard_split(sentence, max_tokens))
+
+    chunks = []
+    current = ""
+    current_tokens = 0
+    last_index = None
+    for unit, index in units:
+        separator = "" if index == last_index else "\n"
+        tokens = estimate_tokens(unit) + len(separator)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens, separator = "", 0, ""
+        current += (separator if current else "") + unit
+        current_tokens += tokens
+        last_index = index
+    if current:
+        chunks.append(current)
+    return chunks
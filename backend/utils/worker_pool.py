@@ -0,0 +1,285 @@
+import asyncio
+import collections
+import importlib
+import itertools
+import multiprocessing as mp
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, Optional
+
+
+class WorkerCrashedError(Exception):
+    """工作进程异常退出（崩溃、OOM被杀等）"""
+
+
+class WorkerTimeoutError(Exception):
+    """任务执行超时，工作进程已被终止"""
+
+
+def _resolve(path: str) -> Callable:
+    """将 "module:function" 解析为可调用对象"""
+    module_name, func_name = path.split(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def _worker_main(worker_id: int, conn, initializer: Optional[str], handler: str, init_kwargs: Dict[str, Any]):
+    """工作进程主循环：初始化一次状态，之后逐个处理任务"""
+    try:
+        state = _resolve(initializer)(**init_kwargs) if initializer else None
+        handle = _resolve(handler)
+    except Exception:
+        conn.send(("init_failed", None, False, traceback.format_exc()))
+        return
+    conn.send(("ready", None, True, None))
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if job is None:
+            break
+        job_id, payload = job
+        try:
+            result = handle(state, payload)
+            conn.send(("done", job_id, True, result))
+        except Exception as e:
+            conn.send(("done", job_id, False, f"{type(e).__name__}: {e}"))
+
+
+class _WorkerHandle:
+    """父进程中对单个工作进程的记录"""
+
+    def __init__(self, worker_id: int, process, conn):
+        self.worker_id = worker_id
+        self.process = process
+        self.conn = conn
+        self.ready = False
+        self.job = None
+        self.started_at = None
+
+
+class ProcessWorkerPool:
+    """常驻多进程任务池
+
+    - 每个工作进程启动时执行一次 initializer（例如加载模型），之后复用
+    - 任务通过队列分发给空闲进程，结果以 concurrent.futures.Future 返回，
+      asyncio 侧可通过 run() 等待
+    - 工作进程崩溃或任务超时只影响当前任务：父进程标记失败并重启该进程
+    """
+
+    def __init__(self, name: str, handler: str, initializer: Optional[str] = None,
+                 init_kwargs: Optional[Dict[str, Any]] = None, num_workers: int = 1,
+                 job_timeout: Optional[float] = None, max_init_failures: int = 3):
+        self.name = name
+        self.handler = handler
+        self.initializer = initializer
+        self.init_kwargs = init_kwargs or {}
+        self.num_workers = max(1, num_workers)
+        self.job_timeout = job_timeout
+        self.max_init_failures = max_init_failures
+        self._ctx = mp.get_context("spawn")  # 避免fork带来的torch线程/锁问题
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._workers: Dict[int, _WorkerHandle] = {}
+        self._job_ids = itertools.count(1)
+        self._monitor = None
+        self._closed = False
+        self._broken: Optional[str] = None
+        self._init_failures = 0
+        self.stats_counters = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "crashed": 0,
+            "timeouts": 0,
+            "restarts": 0
+        }
+
+    def start(self):
+        """启动工作进程和监控线程（首次提交任务时自动调用）"""
+        with self._lock:
+            if self._monitor is not None or self._closed:
+                return
+            for worker_id in range(self.num_workers):
+                self._spawn_worker(worker_id)
+            self._monitor = threading.Thread(target=self._monitor_loop, name=f"{self.name}-monitor", daemon=True)
+            self._monitor.start()
+
+    def _spawn_worker(self, worker_id: int):
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, child_conn, self.initializer, self.handler, self.init_kwargs),
+            name=f"{self.name}-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        self._workers[worker_id] = _WorkerHandle(worker_id, process, parent_conn)
+
+    def submit(self, payload: Any) -> Future:
+        """提交任务，返回Future"""
+        if self._closed:
+            raise RuntimeError(f"{self.name} 已关闭")
+        if self._broken:
+            raise WorkerCrashedError(self._broken)
+        self.start()
+        future = Future()
+        with self._lock:
+            self._pending.append((next(self._job_ids), payload, future))
+            self.stats_counters["submitted"] += 1
+        return future
+
+    async def run(self, payload: Any) -> Any:
+        """在asyncio中提交任务并等待结果（取消会丢弃尚未开始的任务）"""
+        return await asyncio.wrap_future(self.submit(payload))
+
+    def _monitor_loop(self):
+        while not self._closed:
+            conns = {w.conn: w for w in list(self._workers.values())}
+            try:
+                readable = wait(list(conns), timeout=0.1) if conns else []
+            except OSError:
+                readable = []
+            for conn in readable:
+                self._receive(conns[conn])
+            with self._lock:
+                self._check_workers()
+                self._dispatch()
+
+    def _receive(self, worker: _WorkerHandle):
+        """读取工作进程消息"""
+        try:
+            kind, job_id, ok, value = worker.conn.recv()
+        except (EOFError, OSError):
+            return  # 进程已退出，由 _check_workers 处理
+        with self._lock:
+            if kind == "ready":
+                worker.ready = True
+                self._init_failures = 0
+            elif kind == "init_failed":
+                print(f"{self.name} 工作进程 {worker.worker_id} 初始化失败: {value}")
+            elif kind == "done" and worker.job and worker.job[0] == job_id:
+                _, _, future = worker.job
+                worker.job = None
+                worker.started_at = None
+                if ok:
+                    self.stats_counters["completed"] += 1
+                    future.set_result(value)
+                else:
+                    self.stats_counters["failed"] += 1
+                    future.set_exception(Exception(value))
+
+    def _check_workers(self):
+        """处理崩溃和超时的工作进程"""
+        now = time.time()
+        for worker in list(self._workers.values()):
+            timed_out = (
+                worker.job is not None and self.job_timeout
+                and now - worker.started_at > self.job_timeout
+            )
+            if timed_out:
+                worker.process.kill()
+                worker.process.join(timeout=5)
+                self.stats_counters["timeouts"] += 1
+                self._fail_job(worker, WorkerTimeoutError(f"{self.name} 任务超时（{self.job_timeout}秒）"))
+            elif worker.process.is_alive():
+                continue
+            else:
+                if not worker.ready:
+                    # 进程在初始化完成前退出，连续多次则认为任务池不可用
+                    self._init_failures += 1
+                if worker.job is not None:
+                    self.stats_counters["crashed"] += 1
+                    self._fail_job(worker, WorkerCrashedError(
+                        f"{self.name} 工作进程 {worker.worker_id} 异常退出（exitcode={worker.process.exitcode}）"
+                    ))
+            self._restart_worker(worker)
+
+    def _fail_job(self, worker: _WorkerHandle, error: Exception):
+        _, _, future = worker.job
+        worker.job = None
+        self.stats_counters["failed"] += 1
+        future.set_exception(error)
+
+    def _restart_worker(self, worker: _WorkerHandle):
+        worker.conn.close()
+        if self._closed:
+            self._workers.pop(worker.worker_id, None)
+            return
+        if self._init_failures >= self.max_init_failures:
+            self._broken = f"{self.name} 工作进程连续初始化失败 {self._init_failures} 次"
+            self._workers.pop(worker.worker_id, None)
+            if not self._workers:
+                self._fail_pending(WorkerCrashedError(self._broken))
+            return
+        self.stats_counters["restarts"] += 1
+        self._spawn_worker(worker.worker_id)
+
+    def _dispatch(self):
+        """把待处理任务分配给空闲进程"""
+        for worker in self._workers.values():
+            if not self._pending:
+                return
+            if not worker.ready or worker.job is not None:
+                continue
+            while self._pending:
+                job_id, payload, future = self._pending.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue  # 已取消
+                try:
+                    worker.conn.send((job_id, payload))
+                except (OSError, ValueError) as e:
+                    future.set_exception(WorkerCrashedError(f"{self.name} 任务发送失败: {e}"))
+                    break
+                worker.job = (job_id, payload, future)
+                worker.started_at = time.time()
+                break
+
+    def _fail_pending(self, error: Exception):
+        while self._pending:
+            _, _, future = self._pending.popleft()
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+    def shutdown(self, timeout: float = 5):
+        """停止所有工作进程，未完成的任务标记失败"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._fail_pending(RuntimeError(f"{self.name} 已关闭"))
+            workers = list(self._workers.values())
+        if self._monitor:
+            self._monitor.join(timeout=1)
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        deadline = time.time() + timeout
+        for worker in workers:
+            worker.process.join(timeout=max(0, deadline - time.time()))
+            if worker.process.is_alive():
+                worker.process.kill()
+            if worker.job is not None:
+                self._fail_job(worker, RuntimeError(f"{self.name} 已关闭"))
+            worker.conn.close()
+        self._workers.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """任务池状态"""
+        with self._lock:
+            return {
+                "name": self.name,
+                "workers": self.num_workers,
+                "alive": sum(1 for w in self._workers.values() if w.process.is_alive()),
+                "busy": sum(1 for w in self._workers.values() if w.job is not None),
+                "queued": len(self._pending),
+                "broken": self._broken,
+                **self.stats_counters
+            }